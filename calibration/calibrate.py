@@ -69,7 +69,7 @@ def sigmoid_fit(calibration, fit_name, params, graph = True):
     standard_deviations = calibration_data["standard_deviations"]
     measured_data = calibration_data["measured_data"]
 
-    for i in range(16):
+    for i in range(len(medians)):
         paramsig, paramlin = curve_fit(sigmoid, measured_data[i], medians[i], p0 = [62721, 62721, 0, -1], maxfev=1000000000)
         coefficients.append(np.array(paramsig).tolist())
     print(coefficients)
@@ -87,7 +87,7 @@ def linear_fit(calibration, fit_name, params, graph = True):
     standard_deviations = calibration_data["standard_deviations"]
     measured_data = calibration_data["measured_data"]
 
-    for i in range(16):
+    for i in range(len(medians)):
         paramlin, cov = curve_fit(linear, medians[i], measured_data[i])
         coefficients.append(paramlin.tolist())
 
@@ -119,7 +119,7 @@ def three_dimension_fit(calibration, fit_name, params, graph = True):
             y_datas = param_data['medians']
         z_datas = param_data['measured_data']
 
-    for i in range(16):
+    for i in range(len(z_datas)):
         x_data = np.array(x_datas[i])
         y_data = np.array(y_datas[i])
         z_data = np.array(z_datas[i])
@@ -149,20 +149,22 @@ def three_dimension_fit(calibration, fit_name, params, graph = True):
 
 def graph_2d_data(func, measured_data, medians, standard_deviations, coefficients, fit_name, fit_type, space_min, space_max, space_step):
     linear_space = np.linspace(space_min, space_max, space_step)
-    fig, ax = plt.subplots(4, 4)
+    rows, columns = subplot_grid(len(coefficients))
+    fig, ax = plt.subplots(rows, columns, squeeze=False)
     fig.suptitle("Fit Name: " + fit_name)
-    for i in range(16):
-        ax[i // 4, (i % 4)].plot(measured_data[i], medians[i], 'o', markersize=3, color='black')
-        ax[i //4, (i % 4)].errorbar(measured_data[i], medians[i], yerr=standard_deviations[i], fmt='none')
-        ax[i // 4, (i % 4)].plot(linear_space, func(linear_space, *coefficients[i]), markersize = 1.5, label = None)
-        ax[i // 4, (i % 4)].set_title('Vial: ' + str(i))
-        ax[i // 4, (i % 4)].ticklabel_format(style='sci', axis='y', scilimits=(0,0))
+    for i in range(len(coefficients)):
+        ax[i // columns, (i % columns)].plot(measured_data[i], medians[i], 'o', markersize=3, color='black')
+        ax[i // columns, (i % columns)].errorbar(measured_data[i], medians[i], yerr=standard_deviations[i], fmt='none')
+        ax[i // columns, (i % columns)].plot(linear_space, func(linear_space, *coefficients[i]), markersize = 1.5, label = None)
+        ax[i // columns, (i % columns)].set_title('Vial: ' + str(i))
+        ax[i // columns, (i % columns)].ticklabel_format(style='sci', axis='y', scilimits=(0,0))
     plt.subplots_adjust(hspace = 0.6)
     plt.show()
 
 def graph_3d_data(func, datas, coefficients, fit_name):
     fig = plt.figure()
     fig.suptitle("Fit Name: " + fit_name)
+    rows, columns = subplot_grid(len(datas))
     for i, data in enumerate(datas):
         x_data = data[0]
         y_data = data[1]
@@ -172,7 +174,7 @@ def graph_3d_data(func, datas, coefficients, fit_name):
         X, Y = np.meshgrid(x_space, y_space)
         Z = func(np.array([X, Y]), *coefficients[i])
 
-        ax = fig.add_subplot(4, 4, i + 1, projection = '3d')
+        ax = fig.add_subplot(rows, columns, i + 1, projection = '3d')
 
         ax.plot_surface(X, Y, Z, rstride=1, cstride=1, linewidth=1, antialiased=True, alpha=0.5)
 
@@ -184,6 +186,14 @@ def graph_3d_data(func, datas, coefficients, fit_name):
 
     plt.show()
 
+def subplot_grid(n_vials):
+    """
+        Rows and columns of a near-square grid with a plot per vial (4 x 4 for a 16-vial box).
+    """
+    columns = int(np.ceil(np.sqrt(n_vials)))
+    rows = int(np.ceil(n_vials / columns))
+    return rows, columns
+
 def process_vial_data(calibration, param = None):
     """
         Data is structed as a list of lists. Each element in the outer list is a vial.
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+"""
+Backtests custom_script control strategies against a simulated culture,
+faster than real time and with many parameter combinations in parallel.
+
+    python3 experiment/backtest.py --seed-from template/data --hours 48 \\
+        --grid lower=0.2,0.3 --grid upper=0.5,0.8 --grid PUMP_WAIT=3,10
+
+Each configuration runs the custom script's functions through a real
+EvolverNamespace, fed by simulator.py's culture model instead of a box, on
+a virtual clock advancing --step seconds per broadcast. Grid keys in lower
+case are vial_configuration entries of eVOLVER_parameters.json (lower,
+upper, rate, startOD, startTime, stir, temp); upper case ones are module
+settings of the custom script (e.g. OD_VALUES_TO_AVERAGE, PUMP_WAIT,
+BOLUS).
+
+With --seed-from, each vial starts at the first OD of that experiment's
+OD files and grows at the median of its recorded growth rates; the reading
+noise is estimated from the OD files too.
+
+Reports per configuration the dilutions, media used and the OD tracking
+error: the RMS distance of the true OD from the [lower, upper] band,
+ignoring the first --settle hours.
+"""
+
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import argparse
+import itertools
+import tempfile
+import contextlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'template'))
+import eVOLVER
+import binstore
+from eVOLVER import EvolverNamespace
+from supervisor import load_script
+from geometry import DeviceGeometry
+from simulator import CultureModel, SimulatedEvolver
+
+NAMESPACE = '/dpu-evolver'
+# entries of each vial's configuration in eVOLVER_parameters.json
+VIAL_KEYS = ['lower', 'upper', 'rate', 'startOD', 'startTime', 'stir', 'temp']
+VIAL_DEFAULTS = {'lower': 0.2, 'upper': 0.4, 'rate': 0.5, 'startOD': 0,
+                 'startTime': 0, 'stir': 8, 'temp': 30}
+
+class VirtualLink:
+    """
+    Connects a namespace to a SimulatedEvolver in place of the socket:
+    commands are applied to the simulation right away, calibration
+    requests are answered before the next broadcast.
+    """
+
+    # read by socketIO_client's namespaces for their log name
+    _url = 'backtest'
+
+    def __init__(self, evolver):
+        self.evolver = evolver
+        self.calibrations_requested = False
+
+    def emit(self, event, *args, **kw):
+        if event == 'command':
+            self.evolver.command(args[0])
+        elif event == 'getactivecal':
+            self.calibrations_requested = True
+
+    def deliver(self, namespace):
+        if self.calibrations_requested:
+            self.calibrations_requested = False
+            namespace.on_activecalibrations(
+                self.evolver.active_calibrations())
+
+def read_series(exp_dir, parameter, vial, directory=None):
+    file_path = os.path.join(exp_dir, directory or parameter,
+                             'vial{0}_{1}.txt'.format(vial, parameter))
+    bin_path = binstore.binary_path(file_path)
+    if os.path.exists(bin_path):
+        return np.array(binstore.load(bin_path))
+    if os.path.exists(file_path):
+        return binstore.read_text_rows(file_path)
+    return np.empty((0, 2))
+
+def seed_from(exp_dir, geometry, od=0.05, max_rate=0.8, noise=0.002):
+    """
+    Initial OD and growth rate (1/h) of each vial and the OD reading noise
+    from an experiment's data directory. Vials without data keep the given
+    defaults.
+    """
+    initial_od = geometry.per_vial(od).copy()
+    rates = geometry.per_vial(max_rate).copy()
+    noises = []
+    for x in geometry.vials:
+        series = read_series(exp_dir, 'OD', x)
+        values = series[:, 1][np.isfinite(series[:, 1])]
+        if values.size:
+            initial_od[x] = max(values[0], 0.001)
+        if values.size > 2:
+            # robust estimate of the reading to reading noise
+            steps = np.abs(np.diff(values))
+            noises.append(np.median(steps) * 1.4826 / np.sqrt(2))
+        growth = read_series(exp_dir, 'gr', x, directory='growthrate')
+        positive = growth[:, 1][growth[:, 1] > 0] if growth.size else []
+        if len(positive):
+            rates[x] = np.median(positive)
+    if noises:
+        noise = float(np.median(noises))
+    return {'od': initial_od.tolist(), 'max_rate': rates.tolist(),
+            'noise': noise}
+
+def parse_grid(entries):
+    """
+    Turns ['lower=0.2,0.3', 'PUMP_WAIT=3,10'] into a list of dicts, one per
+    combination.
+    """
+    keys, values = [], []
+    for entry in entries:
+        key, _, choices = entry.partition('=')
+        keys.append(key)
+        values.append([json.loads(c) for c in choices.split(',')])
+    return [dict(zip(keys, combination))
+            for combination in itertools.product(*values)]
+
+def experiment_params(config, mode, geometry):
+    vial = dict(VIAL_DEFAULTS)
+    vial.update((key, value) for key, value in config.items()
+                if key in VIAL_KEYS)
+    return {'function': mode, 'ip': 'backtest',
+            'vial_configuration': [dict(vial) for x in geometry.vials]}
+
+def run_config(job):
+    """
+    Runs one configuration and returns its report. Runs in a worker
+    process.
+    """
+    config, options, seed = job
+    exp_dir = tempfile.mkdtemp(prefix='evolver_backtest_')
+    started = time.perf_counter()
+    try:
+        # the namespace prints every broadcast
+        with open(os.devnull, 'w') as devnull, \
+                contextlib.redirect_stdout(devnull):
+            result = simulate(config, options, seed, exp_dir)
+    finally:
+        shutil.rmtree(exp_dir, ignore_errors=True)
+    result['seconds'] = time.perf_counter() - started
+    return result
+
+def simulate(config, options, seed, exp_dir):
+    script = load_script(options['script'], 'custom_script_backtest')
+    for key, value in config.items():
+        if key not in VIAL_KEYS:
+            if not hasattr(script, key):
+                raise ValueError('%s is not a setting of %s' %
+                                 (key, options['script']))
+            setattr(script, key, value)
+    geometry = DeviceGeometry.from_config(getattr(script, 'GEOMETRY', None))
+    params = experiment_params(config, options['mode'], geometry)
+    vial = params['vial_configuration'][0]
+    temp = float(np.mean(script.TEMP_INITIAL))
+
+    # grows at the seeded rate at the experiment's temperature
+    model = CultureModel(geometry, od=seed['od'], max_rate=seed['max_rate'],
+                         volume=getattr(script, 'VOLUME', 25),
+                         optimal_temp=temp, ambient_temp=temp,
+                         seed=options['seed'])
+    evolver = SimulatedEvolver(model, noise=seed['noise'])
+    link = VirtualLink(evolver)
+    namespace = EvolverNamespace(link, NAMESPACE)
+    namespace.configure(exp_dir, script)
+    start_time = time.time()
+    namespace.initialize_exp(geometry.vials, params,
+                             os.path.join(exp_dir, 'backtest.log'), True, 0,
+                             'backtest', always_yes=True)
+    namespace.start_time = start_time
+    namespace.use_blank = False
+
+    steps = int(options['hours'] * 3600 / options['step'])
+    ods = np.empty((steps, geometry.n_vials))
+    for i in range(steps):
+        link.deliver(namespace)
+        data = evolver.broadcast(options['step'])
+        ods[i] = model.od
+        namespace.on_broadcast(data, received_at=start_time + model.time)
+    namespace.writer.close()
+
+    settled = ods[int(options['settle'] * 3600 / options['step']):]
+    lower, upper = float(vial['lower']), float(vial['upper'])
+    outside = np.maximum(lower - settled, 0) + np.maximum(settled - upper, 0)
+    return {'config': config,
+            'dilutions': int(model.dilutions.sum()),
+            'media_ml': float(model.media_used.sum()),
+            'tracking_error': float(np.sqrt(np.mean(outside**2)))
+            if settled.size else float('nan'),
+            'mean_od': float(np.mean(settled)) if settled.size
+            else float('nan'),
+            'broadcasts': steps}
+
+def print_results(results):
+    print('{0:<40} {1:>9} {2:>10} {3:>9} {4:>8} {5:>8}'.format(
+        'configuration', 'dilutions', 'media (mL)', 'OD error', 'mean OD',
+        'time (s)'))
+    for result in results:
+        label = ' '.join('%s=%s' % item for item in result['config'].items())
+        print('{0:<40} {1:9d} {2:10.1f} {3:9.4f} {4:8.3f} {5:8.1f}'.format(
+            label or 'defaults', result['dilutions'], result['media_ml'],
+            result['tracking_error'], result['mean_od'], result['seconds']))
+
+def write_results(path, results):
+    keys = sorted({key for result in results for key in result['config']})
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(keys + ['dilutions', 'media_ml', 'tracking_error',
+                                'mean_od', 'broadcasts', 'seconds'])
+        for result in results:
+            writer.writerow([result['config'].get(key) for key in keys] +
+                            [result['dilutions'], result['media_ml'],
+                             result['tracking_error'], result['mean_od'],
+                             result['broadcasts'], result['seconds']])
+
+def get_options():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--script',
+                        default=os.path.join(eVOLVER.SAVE_PATH,
+                                             'custom_script.py'),
+                        help='Custom script to backtest (default: '
+                             '%(default)s)')
+    parser.add_argument('--mode', default=None,
+                        help='Operation mode (default: the script\'s '
+                             'OPERATION_MODE)')
+    parser.add_argument('--grid', action='append', default=[],
+                        metavar='KEY=V1,V2,...',
+                        help='Values to try for a setting, every '
+                             'combination is run (can be repeated)')
+    parser.add_argument('--seed-from', default=None,
+                        help='Data directory of an experiment to take '
+                             'initial ODs, growth rates and noise from')
+    parser.add_argument('--hours', type=float, default=24,
+                        help='Simulated hours per configuration (default: '
+                             '%(default)s)')
+    parser.add_argument('--step', type=float, default=20,
+                        help='Simulated seconds between broadcasts (default: '
+                             '%(default)s)')
+    parser.add_argument('--settle', type=float, default=2,
+                        help='Hours ignored by the tracking error (default: '
+                             '%(default)s)')
+    parser.add_argument('-j', '--workers', type=int, default=None,
+                        help='Processes to run configurations in (default: '
+                             'one per CPU)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed of the reading noise (default: '
+                             '%(default)s)')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Also write the results to this CSV file')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    options = get_options()
+    script = load_script(options.script, 'custom_script_backtest')
+    mode = options.mode or script.OPERATION_MODE
+    geometry = DeviceGeometry.from_config(getattr(script, 'GEOMETRY', None))
+    if options.seed_from is not None:
+        seed = seed_from(options.seed_from, geometry)
+    else:
+        seed = {'od': 0.05, 'max_rate': 0.8, 'noise': 0.002}
+    run_options = {'script': os.path.abspath(options.script), 'mode': mode,
+                   'hours': options.hours, 'step': options.step,
+                   'settle': options.settle, 'seed': options.seed}
+    configs = parse_grid(options.grid)
+    print('%d configurations of %s, %g simulated hours each' %
+          (len(configs), mode, options.hours))
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(options.workers) as executor:
+        results = list(executor.map(run_config, [(config, run_options, seed)
+                                                 for config in configs]))
+    elapsed = time.perf_counter() - start
+    print_results(results)
+    simulated = len(configs) * options.hours * 3600
+    print('%.1f s, %.0fx real time' % (elapsed, simulated / elapsed))
+    if options.output is not None:
+        write_results(options.output, results)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Checks the vectorized chemostat (chemostat.ChemostatEngine) against the
+per-vial loop custom_script.chemostat and update_chemo used to run, on
+simulated cultures whose dilution rates are changed now and then, and
+times both.
+
+    python3 experiment/benchmark_chemostat.py -n 5000 --vials 64
+
+Both controllers see the same OD readings; the first broadcast where the
+recurring pump commands or the chemo_config records differ is reported.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'template'))
+from geometry import DeviceGeometry, INFLUX, EFFLUX
+from statestore import parse_row
+from chemostat import ChemostatEngine
+from benchmark_turbidostat import Controller, by_file
+
+VOLUME = 25
+BOLUS = 0.5
+
+def legacy_chemostat(eVOLVER, vials, elapsed_time, rate_config, flow_rate,
+                     start_time, start_OD, OD_values_to_average,
+                     bolus=BOLUS):
+    # the per-vial loop from custom_script.chemostat, kept for comparison
+    period_config = eVOLVER.geometry.zeros()
+    bolus_in_s = eVOLVER.geometry.zeros()
+    for x in vials:
+        data = eVOLVER.recent_data('OD', x, OD_values_to_average)
+        average_OD = 0
+
+        if data.size != 0:
+            od_values_from_file = data[:,1]
+            average_OD = float(np.median(od_values_from_file))
+
+            chemo_config = eVOLVER.state.last('chemo_config', x)
+            last_chemophase = chemo_config[1]
+            last_chemorate = chemo_config[2]
+
+            if ((elapsed_time > start_time[x]) and (average_OD > start_OD[x])):
+
+                bolus_in_s[x] = bolus/flow_rate[x]
+
+                if rate_config[x] > 0:
+                    period_config[x] = (3600*bolus)/((rate_config[x])*VOLUME)
+                else:
+                    period_config[x] = 0
+
+                if  (last_chemorate != period_config[x]):
+                    eVOLVER.state.append('chemo_config', x, elapsed_time,
+                                         (last_chemophase+1),
+                                         period_config[x])
+    return bolus_in_s, period_config
+
+def legacy_update_chemo(geometry, current_pump, vials, bolus_in_s,
+                        period_config):
+    # the formatting and comparison update_chemo used to do every broadcast
+    value = geometry.message()
+    slots = []
+    for x in vials:
+        influx = geometry.pump_slot(x, INFLUX)
+        efflux = geometry.pump_slot(x, EFFLUX)
+        slots.extend((influx, efflux))
+        if period_config[x] == 0:
+            value[influx] = '0|0'
+            value[efflux] = '0|0'
+        else:
+            value[influx] = '%.2f|%d' % (bolus_in_s[x], period_config[x])
+            value[efflux] = '%.2f|%d' % (bolus_in_s[x] * 2, period_config[x])
+    if any(value[slot] != current_pump[slot] for slot in slots):
+        return value
+    return None
+
+def update_chemo(geometry, engine, current_pump, vials, bolus_in_s,
+                 period_config):
+    # what update_chemo does now
+    values = engine.pump_values(vials, bolus_in_s, period_config)
+    slots = engine.slots(vials)
+    current = np.asarray(current_pump, dtype=object)[slots]
+    if not (values[slots] != current).any():
+        return None
+    value = geometry.message()
+    for slot in slots:
+        value[slot] = values[slot]
+    return value
+
+def apply(current_pump, value):
+    # the box leaves the '--' slots of a command as they are
+    if value is not None:
+        for slot, setting in enumerate(value):
+            if setting != '--':
+                current_pump[slot] = setting
+
+def run(options):
+    geometry = DeviceGeometry(options.vials)
+    rng = np.random.default_rng(options.seed)
+    vials = geometry.vials
+    rate_config = rng.choice([0, 0.1, 0.25, 0.5, 1.0], geometry.n_vials)
+    flow_rate = rng.uniform(0.9, 1.2, geometry.n_vials)
+    start_time = rng.choice([0, 0.5, 2], geometry.n_vials)
+    start_OD = rng.choice([0, 0.1, 0.3], geometry.n_vials)
+    growth = rng.uniform(0.3, 1.2, geometry.n_vials)
+    step = options.step / 3600
+
+    legacy, engine = Controller(geometry), Controller(geometry)
+    for controller in (legacy, engine):
+        for x in vials:
+            # rows written by initialize_exp for a new experiment
+            controller.state._last[('chemo_config', x)] = parse_row('0,0,0')
+            controller.state._count[('chemo_config', x)] = 2
+    chemostat = ChemostatEngine(geometry)
+    legacy_pump = geometry.message('0')
+    engine_pump = geometry.message('0')
+    od = rng.uniform(0.02, 0.1, geometry.n_vials)
+    legacy_time = engine_time = 0.0
+    commands = 0
+    for i in range(options.broadcasts):
+        elapsed_time = round(i * step, 4)
+        if i and i % options.change_every == 0:
+            # someone changes the rate of a vial in the GUI
+            x = rng.integers(geometry.n_vials)
+            rate_config = rate_config.copy()
+            rate_config[x] = rng.choice([0, 0.1, 0.25, 0.5, 1.0])
+        readings = od + rng.normal(0, options.noise, geometry.n_vials)
+        readings[rng.random(geometry.n_vials) < 0.002] = np.nan
+        legacy.buffers['OD'].append(elapsed_time, readings)
+        engine.buffers['OD'].append(elapsed_time, readings)
+
+        started = time.perf_counter()
+        bolus_in_s, period_config = legacy_chemostat(
+            legacy, vials, elapsed_time, rate_config, flow_rate, start_time,
+            start_OD, options.window)
+        legacy_command = legacy_update_chemo(geometry, legacy_pump, vials,
+                                             bolus_in_s, period_config)
+        legacy_time += time.perf_counter() - started
+        started = time.perf_counter()
+        bolus_in_s, period_config = chemostat.run(
+            engine, vials, elapsed_time, rate_config, flow_rate, start_time,
+            start_OD, BOLUS, VOLUME, window=options.window)
+        engine_command = update_chemo(geometry, chemostat, engine_pump, vials,
+                                      bolus_in_s, period_config)
+        engine_time += time.perf_counter() - started
+
+        if (legacy_command != engine_command or
+                by_file(legacy.state.appends) !=
+                by_file(engine.state.appends)):
+            return i, legacy, engine, legacy_command, engine_command
+        commands += legacy_command is not None
+        apply(legacy_pump, legacy_command)
+        apply(engine_pump, engine_command)
+        # continuous dilution at the running vials' rates
+        od *= np.exp((growth - np.where(period_config > 0, rate_config, 0)) *
+                     step)
+
+    print('%d broadcasts of %d vials, %d records, %d commands: identical' %
+          (options.broadcasts, geometry.n_vials, len(legacy.state.appends),
+           commands))
+    print('per-vial loop: %8.3f ms per broadcast' %
+          (legacy_time / options.broadcasts * 1e3))
+    print('vectorized:    %8.3f ms per broadcast (%.1fx)' %
+          (engine_time / options.broadcasts * 1e3,
+           legacy_time / engine_time))
+    return None
+
+def get_options():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', '--broadcasts', type=int, default=5000,
+                        help='Broadcasts to simulate (default: %(default)s)')
+    parser.add_argument('--vials', type=int, default=16,
+                        help='Number of vials (default: %(default)s)')
+    parser.add_argument('--step', type=float, default=20,
+                        help='Seconds between broadcasts (default: '
+                             '%(default)s)')
+    parser.add_argument('--window', type=int, default=6,
+                        help='ODs in the median (default: %(default)s)')
+    parser.add_argument('--change-every', type=int, default=500,
+                        help='Broadcasts between rate changes (default: '
+                             '%(default)s)')
+    parser.add_argument('--noise', type=float, default=0.005,
+                        help='Standard deviation of the OD readings '
+                             '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed (default: %(default)s)')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    mismatch = run(get_options())
+    if mismatch is not None:
+        i, legacy, engine, legacy_command, engine_command = mismatch
+        print('FAIL: the controllers differ at broadcast %d' % i)
+        print('per-vial loop: %s' % legacy_command)
+        print('vectorized:    %s' % engine_command)
+        changed = [(a, b) for a, b in zip(by_file(legacy.state.appends),
+                                          by_file(engine.state.appends))
+                   if a != b]
+        print('first different record: %s' % (changed[:1],))
+        sys.exit(1)
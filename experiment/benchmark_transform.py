@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Compares the vectorized calibration transform (calibrations.Calibration)
+against the per-vial loop eVOLVER.transform_data used to run, on synthetic
+sigmoid/3d OD and linear temperature calibrations.
+
+    python3 experiment/benchmark_transform.py -n 20000
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'template'))
+from calibrations import Calibration, SIGMOID, THREE_DIMENSION
+
+N_VIALS = 16
+
+def make_fits():
+    sigmoid = {'type': SIGMOID, 'params': ['od_135'],
+               'coefficients': [[62721, 1500, 1.2, -1.5]] * N_VIALS}
+    three_d = {'type': THREE_DIMENSION, 'params': ['od_90', 'od_135'],
+               'coefficients': [[0.1, 1e-5, 2e-5, 1e-10, -1e-10, 1e-10]] *
+                               N_VIALS}
+    linear = {'type': 'linear', 'params': ['temp'],
+              'coefficients': [[-0.0113, 55.1]] * N_VIALS}
+    return sigmoid, three_d, linear
+
+def legacy_transform(od_cal, temp_cal, od_data, od_data_2, temp_data):
+    # the per-vial loop from transform_data, kept here for comparison
+    od_data = od_data.copy()
+    temp_data = temp_data.copy()
+    for x in range(N_VIALS):
+        od_coefficients = od_cal['coefficients'][x]
+        temp_coefficients = temp_cal['coefficients'][x]
+        try:
+            if od_cal['type'] == SIGMOID:
+                od_data[x] = np.real(od_coefficients[2] -
+                                     ((np.log10((od_coefficients[1] -
+                                                 od_coefficients[0]) /
+                                                (float(od_data[x]) -
+                                                 od_coefficients[0])-1)) /
+                                      od_coefficients[3]))
+                if not np.isfinite(od_data[x]):
+                    od_data[x] = 'NaN'
+            elif od_cal['type'] == THREE_DIMENSION:
+                od_data[x] = np.real(od_coefficients[0] +
+                                     (od_coefficients[1]*od_data[x]) +
+                                     (od_coefficients[2]*od_data_2[x]) +
+                                     (od_coefficients[3]*(od_data[x]**2)) +
+                                     (od_coefficients[4]*od_data[x]*od_data_2[x]) +
+                                     (od_coefficients[5]*(od_data_2[x]**2)))
+        except ValueError:
+            od_data[x] = 'NaN'
+        try:
+            temp_data[x] = (float(temp_data[x]) *
+                            temp_coefficients[0]) + temp_coefficients[1]
+        except ValueError:
+            temp_data[x] = 'NaN'
+    return od_data, temp_data
+
+def vectorized_transform(od_cal, temp_cal, od_data, od_data_2, temp_data):
+    return (od_cal.apply(od_data, od_data_2), temp_cal.apply(temp_data))
+
+def run(label, func, od_cal, temp_cal, readings, repeat):
+    start = time.perf_counter()
+    for i in range(repeat):
+        od_data, od_data_2, temp_data = readings[i % len(readings)]
+        func(od_cal, temp_cal, od_data, od_data_2, temp_data)
+    elapsed = time.perf_counter() - start
+    print('{0:<28} {1:8.2f} us/broadcast'.format(label,
+                                                 elapsed / repeat * 1e6))
+    return elapsed
+
+def get_options():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', '--repeat', type=int, default=5000,
+                        help='Broadcasts to transform (default: %(default)s)')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    options = get_options()
+    sigmoid, three_d, linear = make_fits()
+    rng = np.random.default_rng(0)
+    readings = [(rng.uniform(20000, 60000, N_VIALS),
+                 rng.uniform(20000, 60000, N_VIALS),
+                 rng.uniform(1500, 2500, N_VIALS)) for _ in range(64)]
+
+    for od_fit in (sigmoid, three_d):
+        od_cal, temp_cal = Calibration(od_fit), Calibration(linear)
+        legacy_od, legacy_temp = legacy_transform(od_fit, linear, *readings[0])
+        new_od, new_temp = vectorized_transform(od_cal, temp_cal, *readings[0])
+        assert np.allclose(legacy_od, new_od, equal_nan=True)
+        assert np.allclose(legacy_temp, new_temp, equal_nan=True)
+
+        print('{0} OD calibration, {1} broadcasts'.format(od_fit['type'],
+                                                          options.repeat))
+        with np.errstate(all='ignore'):
+            before = run('per-vial loop', legacy_transform, od_fit, linear,
+                         readings, options.repeat)
+        after = run('vectorized', vectorized_transform, od_cal, temp_cal,
+                    readings, options.repeat)
+        print('speedup: {0:.1f}x\n'.format(before / after))
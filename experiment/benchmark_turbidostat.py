@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""
+Checks the vectorized turbidostat (turbidostat.TurbidostatEngine) against
+the per-vial loop custom_script.turbidostat used to run, decision for
+decision, on simulated growth curves, and times both.
+
+    python3 experiment/benchmark_turbidostat.py -n 5000 --vials 64
+
+Both controllers see the same OD readings of cultures diluted by their
+(identical) decisions; the first broadcast where the pump messages, the
+ODset/pump_log records (in the order of each file) or the growth-rate
+calls differ is reported.
+"""
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'template'))
+from geometry import DeviceGeometry, INFLUX, EFFLUX
+from ringbuffer import VialRingBuffer
+from statestore import parse_row
+from turbidostat import TurbidostatEngine
+
+VOLUME = 25
+TIME_OUT = 5
+
+class MemoryState:
+    """
+    StateStore without files: the last row and row count of each record,
+    and every append, in order.
+    """
+
+    def __init__(self, n_vials):
+        self._last = {}
+        self._count = {}
+        self.appends = []
+        for x in range(n_vials):
+            # rows written by initialize_exp for a new experiment
+            self._last[('ODset', x)] = parse_row('0,0')
+            self._count[('ODset', x)] = 2
+            self._last[('pump_log', x)] = parse_row('0,0')
+            self._count[('pump_log', x)] = 2
+
+    def last(self, parameter, vial):
+        return self._last[(parameter, vial)]
+
+    def count(self, parameter, vial):
+        return self._count[(parameter, vial)]
+
+    def append(self, parameter, vial, *values):
+        line = ','.join(str(v) for v in values)
+        self.appends.append((parameter, vial, line))
+        self._last[(parameter, vial)] = parse_row(line)
+        self._count[(parameter, vial)] += 1
+
+class GrowthRates:
+    def __init__(self, calls):
+        self.calls = calls
+
+    def reset(self, vial, start_time):
+        self.calls.append(('reset', vial, start_time))
+
+class Controller:
+    """
+    The parts of EvolverNamespace the turbidostat uses.
+    """
+
+    def __init__(self, geometry):
+        self.geometry = geometry
+        self.state = MemoryState(geometry.n_vials)
+        self.calls = []
+        self.growth_rates = GrowthRates(self.calls)
+        self.buffers = {'OD': VialRingBuffer(geometry.n_vials, 128)}
+        self.turbidostat = TurbidostatEngine(geometry.n_vials)
+
+    def calc_growth_rate(self, vial, gr_start, elapsed_time):
+        self.calls.append(('growth_rate', vial, gr_start, elapsed_time))
+
+    def recent_data(self, parameter, vial, window=10):
+        return self.buffers[parameter].window(vial, window)
+
+    def rolling_median(self, parameter, vials, window=10, skipna=False,
+                       n_sigmas=None):
+        return self.buffers[parameter].median(vials, window, skipna,
+                                              n_sigmas)
+
+def legacy_turbidostat(eVOLVER, vials, elapsed_time, lower_thresh,
+                       upper_thresh, flow_rate, OD_values_to_average,
+                       pump_wait, time_out=TIME_OUT,
+                       stop_after_n_curves=np.inf):
+    # the per-vial loop from custom_script.turbidostat, kept for comparison
+    MESSAGE = eVOLVER.geometry.message()
+    for x in vials:
+        ODsettime, ODset = eVOLVER.state.last('ODset', x)
+        num_curves = eVOLVER.state.count('ODset', x)/2;
+
+        data = eVOLVER.recent_data('OD', x, OD_values_to_average)
+        average_OD = 0
+
+        collecting_more_curves = (num_curves <= (stop_after_n_curves + 2))
+
+        if data.size != 0:
+            od_values_from_file = data[:,1]
+            average_OD = float(np.median(od_values_from_file))
+
+            if (average_OD > upper_thresh[x]) and (ODset != lower_thresh[x]):
+                eVOLVER.state.append('ODset', x, elapsed_time, lower_thresh[x])
+                ODset = lower_thresh[x]
+                eVOLVER.calc_growth_rate(x, ODsettime, elapsed_time)
+
+            if (average_OD < (lower_thresh[x] + (upper_thresh[x] - lower_thresh[x]) / 3)) and (ODset != upper_thresh[x]):
+                eVOLVER.state.append('ODset', x, elapsed_time, upper_thresh[x])
+                ODset = upper_thresh[x]
+                eVOLVER.growth_rates.reset(x, elapsed_time)
+
+            if average_OD > ODset and collecting_more_curves:
+
+                time_in = - (np.log(lower_thresh[x]/average_OD)*VOLUME)/flow_rate[x]
+
+                if time_in > 20:
+                    time_in = 20
+
+                time_in = round(time_in, 2)
+
+                last_pump = eVOLVER.state.last('pump_log', x)[0]
+                if ((elapsed_time - last_pump)*60) >= pump_wait:
+                    MESSAGE[eVOLVER.geometry.pump_slot(x, INFLUX)] = str(time_in)
+                    MESSAGE[eVOLVER.geometry.pump_slot(x, EFFLUX)] = str(time_in + time_out)
+
+                    eVOLVER.state.append('pump_log', x, elapsed_time, time_in)
+
+    if MESSAGE != eVOLVER.geometry.message():
+        return MESSAGE
+    return None
+
+def by_file(records):
+    # the vectorized controller writes all ODset records before the
+    # pump_log ones, only the order within each file has to match
+    return sorted(records, key=lambda record: record[:2])
+
+def dilute(od, message, geometry, flow_rate):
+    # a dilution of time_in seconds replaces that much of the volume
+    if message is None:
+        return
+    for x in geometry.vials:
+        time_in = message[geometry.pump_slot(x, INFLUX)]
+        if time_in != '--':
+            od[x] *= np.exp(-float(time_in) * flow_rate[x] / VOLUME)
+
+def run(options):
+    geometry = DeviceGeometry(options.vials)
+    rng = np.random.default_rng(options.seed)
+    vials = geometry.vials
+    # unused vials (9999) and a few vials at other thresholds
+    lower = geometry.per_vial(0.2).tolist()
+    upper = geometry.per_vial(0.4).tolist()
+    for x in vials[1::5]:
+        lower[x], upper[x] = 0.3, 0.6
+    lower[-1] = upper[-1] = 9999
+    flow_rate = rng.uniform(0.9, 1.2, geometry.n_vials)
+    rates = rng.uniform(0.3, 1.2, geometry.n_vials)
+    step = options.step / 3600
+
+    legacy, engine = Controller(geometry), Controller(geometry)
+    od = rng.uniform(0.02, 0.1, geometry.n_vials)
+    legacy_time = engine_time = 0.0
+    for i in range(options.broadcasts):
+        elapsed_time = round(i * step, 4)
+        readings = od + rng.normal(0, options.noise, geometry.n_vials)
+        # occasional failed readings
+        readings[rng.random(geometry.n_vials) < 0.002] = np.nan
+        legacy.buffers['OD'].append(elapsed_time, readings)
+        engine.buffers['OD'].append(elapsed_time, readings)
+
+        started = time.perf_counter()
+        legacy_message = legacy_turbidostat(
+            legacy, vials, elapsed_time, lower, upper, flow_rate,
+            options.window, options.pump_wait)
+        legacy_time += time.perf_counter() - started
+        started = time.perf_counter()
+        engine_message = engine.turbidostat.run(
+            engine, vials, elapsed_time, lower, upper, flow_rate, VOLUME,
+            window=options.window, pump_wait=options.pump_wait,
+            time_out=TIME_OUT)
+        engine_time += time.perf_counter() - started
+
+        if (legacy_message != engine_message or
+                by_file(legacy.state.appends) !=
+                by_file(engine.state.appends) or
+                by_file(legacy.calls) != by_file(engine.calls)):
+            return i, legacy, engine, legacy_message, engine_message
+        dilute(od, legacy_message, geometry, flow_rate)
+        od *= np.exp(rates * step)
+
+    print('%d broadcasts of %d vials, %d records, %d dilutions: identical' %
+          (options.broadcasts, geometry.n_vials, len(legacy.state.appends),
+           sum(1 for r in legacy.state.appends if r[0] == 'pump_log')))
+    print('per-vial loop: %8.3f ms per broadcast' %
+          (legacy_time / options.broadcasts * 1e3))
+    print('vectorized:    %8.3f ms per broadcast (%.1fx)' %
+          (engine_time / options.broadcasts * 1e3,
+           legacy_time / engine_time))
+    return None
+
+def get_options():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('-n', '--broadcasts', type=int, default=5000,
+                        help='Broadcasts to simulate (default: %(default)s)')
+    parser.add_argument('--vials', type=int, default=16,
+                        help='Number of vials (default: %(default)s)')
+    parser.add_argument('--step', type=float, default=20,
+                        help='Seconds between broadcasts (default: '
+                             '%(default)s)')
+    parser.add_argument('--window', type=int, default=6,
+                        help='ODs in the median (default: %(default)s)')
+    parser.add_argument('--pump-wait', type=float, default=3,
+                        help='Minutes between dilutions (default: '
+                             '%(default)s)')
+    parser.add_argument('--noise', type=float, default=0.005,
+                        help='Standard deviation of the OD readings '
+                             '(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed (default: %(default)s)')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    mismatch = run(get_options())
+    if mismatch is not None:
+        i, legacy, engine, legacy_message, engine_message = mismatch
+        print('FAIL: the controllers differ at broadcast %d' % i)
+        print('per-vial loop: %s' % legacy_message)
+        print('vectorized:    %s' % engine_message)
+        changed = [(a, b) for a, b in
+                   zip(by_file(legacy.state.appends + legacy.calls),
+                       by_file(engine.state.appends + engine.calls))
+                   if a != b]
+        print('first different record: %s' % (changed[:1],))
+        sys.exit(1)
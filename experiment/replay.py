@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+Replays broadcasts recorded with eVOLVER.py --record through
+EvolverNamespace as fast as possible, with no socket, and reports the
+broadcast rate, per-stage latency and the commands the DPU sent.
+
+    python3 experiment/replay.py broadcasts.jsonl.gz --min-rate 200 \\
+        --max-p95 transform=0.002 --expect-commands commands.jsonl
+
+Data is written to a fresh temporary experiment directory. Commands are
+captured instead of emitted; --save-commands keeps them so a later run can
+check it makes the same decisions with --expect-commands. Exits with status
+1 if any threshold is missed.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'template'))
+import eVOLVER
+from eVOLVER import EvolverNamespace
+from supervisor import load_script
+from recording import read_recording, BROADCAST, CALIBRATIONS
+
+NAMESPACE = '/dpu-evolver'
+
+class CommandCapture:
+    """
+    Takes the place of the SocketIO connection of a namespace, keeping the
+    commands it sends. Each command is tagged with the number of the
+    broadcast being handled (-1 before the first).
+    """
+
+    # read by socketIO_client's namespaces for their log name
+    _url = 'replay'
+
+    def __init__(self):
+        self.broadcast = -1
+        self.commands = []
+        self.requests = 0
+
+    def emit(self, event, *args, **kw):
+        if event == 'command':
+            # encode now, the namespace may reuse the dict
+            self.commands.append(json.dumps([self.broadcast, args[0]],
+                                            sort_keys=True, default=str))
+        else:
+            self.requests += 1
+
+    def digest(self):
+        return hashlib.sha1('\n'.join(self.commands).encode()).hexdigest()
+
+    def by_param(self):
+        counts = {}
+        for line in self.commands:
+            param = json.loads(line)[1]['param']
+            counts[param] = counts.get(param, 0) + 1
+        return counts
+
+def load_records(path):
+    records = list(read_recording(path))
+    if not any(event == BROADCAST for _, event, _ in records):
+        raise ValueError('no broadcasts recorded in %s' % path)
+    return records
+
+def create_namespace(exp_dir, script, options, capture):
+    namespace = EvolverNamespace(capture, NAMESPACE)
+    namespace.configure(exp_dir, script)
+    namespace.apply_options(options)
+    return namespace
+
+def replay(records, namespace, capture, experiment_params=None):
+    """
+    Runs the records through the namespace at their recorded arrival
+    times. Returns the seconds spent handling broadcasts.
+    """
+    start_time = next(t for t, event, _ in records if event == BROADCAST)
+    namespace.start_time = namespace.initialize_exp(
+        namespace.geometry.vials, experiment_params,
+        os.path.join(namespace.exp_dir, 'replay.log'), True, 0, 'replay',
+        always_yes=True)
+    # time the experiment as recorded
+    namespace.start_time = start_time
+    # no blank, same as a recording started without one
+    namespace.use_blank = False
+
+    elapsed = 0.0
+    for received_at, event, data in records:
+        if event == CALIBRATIONS:
+            namespace.on_activecalibrations(data)
+            continue
+        if event != BROADCAST:
+            continue
+        capture.broadcast += 1
+        started = time.perf_counter()
+        namespace.on_broadcast(data, received_at=received_at)
+        elapsed += time.perf_counter() - started
+    namespace.writer.close()
+    return elapsed
+
+def check(report, options):
+    """
+    Returns the thresholds the replay missed.
+    """
+    failures = []
+    if options.min_rate is not None and report['rate'] < options.min_rate:
+        failures.append('%.1f broadcasts/s, expected at least %g' %
+                        (report['rate'], options.min_rate))
+    for limit in options.max_p95:
+        stage, seconds = limit.rsplit('=', 1)
+        summary = report['stages'].get(stage)
+        if summary is None:
+            failures.append('no %s stage timed' % stage)
+        elif summary['p95'] > float(seconds):
+            failures.append('%s p95 %.6f s, expected at most %s s' %
+                            (stage, summary['p95'], seconds))
+    if options.expect_commands is not None:
+        with open(options.expect_commands) as f:
+            expected = f.read().splitlines()
+        if expected != report['commands']:
+            changed = next((i for i, (a, b) in
+                            enumerate(zip(expected, report['commands']))
+                            if a != b), min(len(expected),
+                                            len(report['commands'])))
+            failures.append('commands differ from %s from command %d on '
+                            '(%d expected, %d sent)' %
+                            (options.expect_commands, changed,
+                             len(expected), len(report['commands'])))
+    return failures
+
+def print_report(report):
+    print('%d broadcasts in %.3f s, %.1f broadcasts/s' %
+          (report['broadcasts'], report['elapsed'], report['rate']))
+    print('{0:<32} {1:>10} {2:>10} {3:>10}'.format('stage (ms)', 'p50', 'p95',
+                                                   'max'))
+    for stage, summary in report['stages'].items():
+        print('{0:<32} {1:10.3f} {2:10.3f} {3:10.3f}'.format(
+            stage, summary['p50'] * 1e3, summary['p95'] * 1e3,
+            summary['max'] * 1e3))
+    counts = ', '.join('%s: %d' % item
+                       for item in sorted(report['by_param'].items()))
+    print('%d commands (%s), digest %s' % (len(report['commands']),
+                                          counts or 'none',
+                                          report['digest']))
+
+def get_options():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('recording',
+                        help='Broadcast log written with eVOLVER.py --record')
+    parser.add_argument('--script',
+                        default=os.path.join(eVOLVER.SAVE_PATH,
+                                             'custom_script.py'),
+                        help='Custom script to run (default: %(default)s)')
+    parser.add_argument('--params', default=None,
+                        help='eVOLVER_parameters.json of the experiment')
+    parser.add_argument('--calibrations', default=None,
+                        help='Directory with od_cal.json, temp_cal.json and '
+                             'pump_cal.json, for recordings without the '
+                             'active calibrations')
+    parser.add_argument('--keep', default=None,
+                        help='Replay into this new directory and keep it, '
+                             'instead of a temporary one')
+    parser.add_argument('--save-commands', default=None,
+                        help='Write the commands sent to this file')
+    parser.add_argument('--expect-commands', default=None,
+                        help='Fail unless the commands sent match this file '
+                             '(from --save-commands)')
+    parser.add_argument('--min-rate', type=float, default=None,
+                        help='Fail below this many broadcasts per second')
+    parser.add_argument('--max-p95', action='append', default=[],
+                        metavar='STAGE=SECONDS',
+                        help='Fail if the 95th percentile of a stage is '
+                             'slower, e.g. total=0.01 (can be repeated)')
+    eVOLVER.add_run_options(parser)
+    parser.set_defaults(io_queue_size=0)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    options = get_options()
+    records = load_records(options.recording)
+    experiment_params = None
+    if options.params is not None:
+        with open(options.params) as f:
+            experiment_params = json.load(f)
+
+    exp_dir = options.keep or tempfile.mkdtemp(prefix='evolver_replay_')
+    os.makedirs(exp_dir, exist_ok=True)
+    try:
+        if options.calibrations is not None:
+            for name in (eVOLVER.OD_CAL_FILE, eVOLVER.TEMP_CAL_FILE,
+                         eVOLVER.PUMP_CAL_FILE):
+                shutil.copy(os.path.join(options.calibrations, name), exp_dir)
+        script = load_script(options.script, 'custom_script_replay')
+        capture = CommandCapture()
+        namespace = create_namespace(exp_dir, script, options, capture)
+        elapsed = replay(records, namespace, capture, experiment_params)
+    finally:
+        if options.keep is None:
+            shutil.rmtree(exp_dir, ignore_errors=True)
+
+    broadcasts = capture.broadcast + 1
+    stages = namespace.metrics.summary()
+    # arrival lag is meaningless for recorded broadcasts
+    stages.pop('receive', None)
+    report = {'broadcasts': broadcasts, 'elapsed': elapsed,
+              'rate': broadcasts / elapsed if elapsed else float('inf'),
+              'stages': stages, 'commands': capture.commands,
+              'by_param': capture.by_param(), 'digest': capture.digest()}
+    print_report(report)
+    if options.save_commands is not None:
+        with open(options.save_commands, 'w') as f:
+            f.write(''.join(line + '\n' for line in capture.commands))
+
+    failures = check(report, options)
+    for failure in failures:
+        print('FAIL: %s' % failure)
+    sys.exit(1 if failures else 0)
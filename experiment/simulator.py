@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for an eVOLVER box, serving the /dpu-evolver socket.io
+namespace so eVOLVER.py and calibrate.py can run without hardware.
+
+    python3 experiment/simulator.py --port 8081 --interval 0.05 --step 20
+
+Each broadcast advances a culture model by --step simulated seconds: logistic
+growth at a temperature dependent rate, dilution by pump commands (one-off
+and chemostat 'bolus|period' ones) and heating towards the temperature set
+point. Readings are turned into raw od_135/od_90/temp counts through the
+simulator's own calibrations, which it hands out like the real server does
+(getactivecal, getcalibration, getcalibrationnames, setfitcalibration).
+
+--interval sets the wall-clock seconds between broadcasts, far below the 20 s
+of real hardware if need be. Note that eVOLVER.py times the experiment by
+the wall clock, so its elapsed time runs slower than the simulated one.
+
+Needs python-socketio and aiohttp (poetry install --with dev). socketIO-client
+0.7 (used by the DPU) speaks the socket.io 1.x/2.x protocol, served by
+python-socketio < 5.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import numpy as np
+
+try:
+    import socketio
+    from aiohttp import web
+except ImportError:
+    socketio = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                'template'))
+from geometry import DeviceGeometry, INFLUX, INFLUX_2
+
+NAMESPACE = '/dpu-evolver'
+# raw temperature value that switches a vial's heater off
+TEMP_OFF = 4095
+
+logger = logging.getLogger('simulator')
+
+# default fits the simulator reports as active, one row per vial
+OD_SIGMOID = [62721, 1500, 1.2, -1.5]
+OD_90_SIGMOID = [60000, 2000, 1.0, -1.8]
+TEMP_LINEAR = [-0.0113, 55.1]
+# mL/s for every pump slot
+FLOW_RATE = 1.0
+# OD standards of the synthetic calibration runs
+OD_STANDARDS = [0.0, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.8, 1.0, 1.2, 1.5,
+                2.0]
+TEMP_STANDARDS = [25.0, 30.0, 35.0, 40.0, 45.0]
+
+def sigmoid_raw(od, c):
+    """
+    Raw photodiode counts of an OD through a sigmoid fit, the inverse of
+    calibrations.Calibration.apply.
+    """
+    return c[0] + (c[1] - c[0]) / (1 + 10**((c[2] - od) * c[3]))
+
+def linear_raw(value, c):
+    return (value - c[1]) / c[0]
+
+class CultureModel:
+    """
+    The cultures of a box as arrays with one entry per vial: OD, volume,
+    temperature and the pump, heater and stirrer settings. advance() runs
+    it forward in simulated seconds.
+
+    Growth is logistic, at max_rate (1/h) scaled by a Gaussian of the
+    distance to optimal_temp. Influx pumps dilute the culture by the volume
+    they add; the efflux pump takes the volume back to volume.
+    """
+
+    def __init__(self, geometry, od=0.05, volume=25.0, flow_rate=FLOW_RATE,
+                 max_rate=0.8, capacity=2.0, optimal_temp=37.0,
+                 temp_width=8.0, ambient_temp=25.0, temp_tau=600.0,
+                 seed=None):
+        self.geometry = geometry
+        self.volume = volume
+        # mL/s per pump slot
+        self.flow_rate = np.broadcast_to(
+            np.asarray(flow_rate, dtype=np.float64),
+            geometry.message_size).copy()
+        self.max_rate = geometry.per_vial(max_rate)
+        self.capacity = geometry.per_vial(capacity)
+        self.optimal_temp = optimal_temp
+        self.temp_width = temp_width
+        self.ambient_temp = ambient_temp
+        self.temp_tau = temp_tau
+        self.rng = np.random.default_rng(seed)
+
+        self.od = geometry.per_vial(od).copy()
+        self.temp = geometry.per_vial(ambient_temp).copy()
+        # NaN where the heater is off
+        self.temp_setpoint = geometry.per_vial(np.nan)
+        self.stir = geometry.zeros()
+        # chemostat pumping per slot: seconds per bolus and period
+        self.bolus = np.zeros(geometry.message_size)
+        self.period = np.zeros(geometry.message_size)
+        self.next_bolus = np.zeros(geometry.message_size)
+        self.time = 0.0
+        self.dilutions = geometry.zeros(dtype=np.int64)
+        self.media_used = geometry.zeros()
+
+    def growth_rate(self):
+        """
+        Current specific growth rate of each vial, in 1/h.
+        """
+        return self.max_rate * np.exp(-((self.temp - self.optimal_temp) /
+                                        self.temp_width)**2)
+
+    def advance(self, seconds):
+        """
+        Runs the cultures forward, applying the chemostat boluses due in the
+        meantime.
+        """
+        if seconds <= 0:
+            return
+        end = self.time + seconds
+        # heat towards the set point (or cool to ambient)
+        target = np.where(np.isnan(self.temp_setpoint), self.ambient_temp,
+                          self.temp_setpoint)
+        self.temp = target + (self.temp - target) * np.exp(-seconds /
+                                                           self.temp_tau)
+        # logistic growth, exact over the step
+        rate = self.growth_rate() * seconds / 3600
+        with np.errstate(divide='ignore', over='ignore'):
+            self.od = self.capacity / (1 + (self.capacity / self.od - 1) *
+                                       np.exp(-rate))
+        self.od[~np.isfinite(self.od)] = 0.0
+
+        active = self.period > 0
+        if active.any():
+            due = active & (self.next_bolus <= end)
+            # number of boluses each slot pumps in this step
+            counts = np.zeros(self.geometry.message_size)
+            counts[due] = np.floor((end - self.next_bolus[due]) /
+                                   self.period[due]) + 1
+            self.next_bolus[due] += counts[due] * self.period[due]
+            self._pump(self.bolus * counts)
+        self.time = end
+
+    def pump(self, seconds):
+        """
+        Runs each pump slot for the given seconds (one value per slot).
+        """
+        self._pump(np.asarray(seconds, dtype=np.float64))
+
+    def _pump(self, seconds):
+        added = np.zeros(self.geometry.n_vials)
+        for channel in (INFLUX, INFLUX_2):
+            if channel not in self.geometry.pump_channels:
+                continue
+            slots = self.geometry.pump_slots(channel)
+            added += seconds[slots] * self.flow_rate[slots]
+        diluted = added > 0
+        self.od[diluted] *= self.volume / (self.volume + added[diluted])
+        self.dilutions[diluted] += 1
+        self.media_used += added
+
+    def set_chemostat(self, slot, bolus, period):
+        self.bolus[slot] = bolus
+        self.period[slot] = period
+        self.next_bolus[slot] = self.time + period
+
+    def measure(self, noise=0.0):
+        """
+        Returns OD and temperature as read by the box, with Gaussian noise
+        (noise is the standard deviation of OD, in OD units).
+        """
+        od = self.od
+        if noise > 0:
+            od = od + self.rng.normal(0, noise, od.size)
+        return np.clip(od, 0, None), self.temp.copy()
+
+class SimulatedEvolver:
+    """
+    The eVOLVER server side of the /dpu-evolver namespace: keeps the
+    parameter configuration the DPU reads from broadcasts, applies its
+    commands to a CultureModel and serves calibrations.
+    """
+
+    def __init__(self, model, calibrations=None, noise=0.002):
+        self.model = model
+        self.noise = noise
+        geometry = model.geometry
+        n = geometry.n_vials
+        self.config = {
+            'od_90': self._param(['1000'], n + 1),
+            'od_135': self._param(['1000'], n + 1),
+            'temp': self._param([str(TEMP_OFF)] * n, n + 1),
+            'stir': self._param(['8'] * n, n + 1),
+            'pump': self._param(geometry.message(), geometry.message_size + 1,
+                                recurring=False),
+        }
+        if calibrations is None:
+            calibrations = default_calibrations(geometry)
+        self.calibrations = {c['name']: c for c in calibrations}
+        self.broadcasts = 0
+        self.commands = 0
+        self.apply_config()
+
+    @staticmethod
+    def _param(value, fields, recurring=True):
+        return {'fields_expected_incoming': fields,
+                'fields_expected_outgoing': fields,
+                'recurring': recurring, 'value': list(value)}
+
+    def active_fit(self, calibration_type):
+        for calibration in self.calibrations.values():
+            if calibration.get('calibrationType') != calibration_type:
+                continue
+            for fit in calibration.get('fits', []):
+                if fit.get('active'):
+                    return fit
+        return None
+
+    def active_calibrations(self):
+        """
+        The calibrations with an active fit, as sent in 'activecalibrations'.
+        """
+        return [c for c in self.calibrations.values()
+                if any(f.get('active') for f in c.get('fits', []))]
+
+    def apply_config(self):
+        """
+        Hands the recurring stir and temperature settings to the model.
+        """
+        self.model.stir = np.asarray(self.config['stir']['value'],
+                                     dtype=np.float64)
+        raw = np.asarray(self.config['temp']['value'], dtype=np.float64)
+        fit = self.active_fit('temperature')
+        c = np.asarray(fit['coefficients'], dtype=np.float64).T
+        setpoint = raw * c[0] + c[1]
+        setpoint[raw >= TEMP_OFF] = np.nan
+        self.model.temp_setpoint = setpoint
+
+    def command(self, data):
+        """
+        Applies a 'command' message. '--' slots leave the current value.
+        """
+        param = data.get('param')
+        entry = self.config.get(param)
+        if entry is None:
+            logger.warning('command for unknown parameter %s', param)
+            return
+        value = list(data.get('value', []))
+        self.commands += 1
+        if param == 'pump':
+            self._pump_command(value, data.get('recurring', False))
+            return
+        current = entry['value']
+        if len(value) != len(current):
+            logger.warning('%s command with %d values, expected %d',
+                           param, len(value), len(current))
+            return
+        entry['value'] = [old if new == '--' else str(new)
+                          for old, new in zip(current, value)]
+        self.apply_config()
+
+    def _pump_command(self, value, recurring):
+        size = self.model.geometry.message_size
+        if len(value) != size:
+            logger.warning('pump command with %d values, expected %d',
+                           len(value), size)
+            return
+        current = self.config['pump']['value']
+        if not recurring:
+            seconds = np.zeros(size)
+            for slot, slot_value in enumerate(value):
+                if slot_value in ('--', None):
+                    continue
+                seconds[slot] = float(slot_value)
+                if seconds[slot] == 0:
+                    # e.g. stop_all_pumps, also ends chemostat pumping
+                    self.model.set_chemostat(slot, 0, 0)
+                    current[slot] = '--'
+            self.model.pump(seconds)
+            return
+        # chemostat: 'bolus seconds|period seconds' per slot
+        for slot, slot_value in enumerate(value):
+            if slot_value == '--':
+                continue
+            bolus, period = (float(v) for v in str(slot_value).split('|'))
+            self.model.set_chemostat(slot, bolus, period)
+            current[slot] = slot_value
+
+    def broadcast(self, seconds):
+        """
+        Advances the model and returns the next broadcast payload.
+        """
+        self.model.advance(seconds)
+        od, temp = self.model.measure(self.noise)
+        data = {'od_135': self._raw(od, 'od', OD_SIGMOID),
+                'od_90': self._raw(od, None, OD_90_SIGMOID),
+                'temp': self._raw(temp, 'temperature', TEMP_LINEAR)}
+        self.broadcasts += 1
+        return {'data': data, 'config': self.config,
+                'ip': 'simulator', 'timestamp': time.time()}
+
+    def _raw(self, values, calibration_type, default):
+        fit = self.active_fit(calibration_type) if calibration_type else None
+        if fit is None:
+            c = np.tile(default, (len(values), 1)).T
+            fit_type = 'sigmoid' if len(default) == 4 else 'linear'
+        else:
+            c = np.asarray(fit['coefficients'], dtype=np.float64).T
+            fit_type = fit['type']
+        if fit_type == 'sigmoid':
+            raw = sigmoid_raw(values, c)
+        else:
+            raw = linear_raw(values, c)
+        # the box reports integer counts
+        return [str(int(round(v))) for v in np.clip(raw, 0, 65535)]
+
+    def calibration_names(self):
+        return [{'name': name, 'calibrationType': c.get('calibrationType')}
+                for name, c in self.calibrations.items()]
+
+    def set_fit(self, name, fit):
+        calibration = self.calibrations.get(name)
+        if calibration is None:
+            logger.warning('setfitcalibration for unknown calibration %s',
+                           name)
+            return
+        fits = [f for f in calibration.setdefault('fits', [])
+                if f.get('name') != fit.get('name')]
+        fits.append(fit)
+        calibration['fits'] = fits
+
+def default_calibrations(geometry, replicates=3, seed=0):
+    """
+    Active OD, temperature and pump calibrations, and raw calibration
+    runs for calibrate.py to fit.
+    """
+    rng = np.random.default_rng(seed)
+    n = geometry.n_vials
+
+    def raw_runs(param, standards, to_raw, spread):
+        vial_data = []
+        for x in range(n):
+            points = []
+            for standard in standards:
+                raw = to_raw(standard)
+                points.append([int(r) for r in
+                               raw + rng.normal(0, spread, replicates)])
+            vial_data.append(points)
+        return {'param': param, 'vialData': vial_data}
+
+    od = {'name': 'sim_od', 'calibrationType': 'od',
+          'measuredData': [OD_STANDARDS] * n,
+          'raw': [raw_runs('od_135', OD_STANDARDS,
+                           lambda od: sigmoid_raw(od, OD_SIGMOID), 50),
+                  raw_runs('od_90', OD_STANDARDS,
+                           lambda od: sigmoid_raw(od, OD_90_SIGMOID), 50)],
+          'fits': [{'name': 'sim_od_fit', 'type': 'sigmoid',
+                    'params': ['od_135'], 'coefficients': [OD_SIGMOID] * n,
+                    'timeFit': time.time(), 'active': True}]}
+    temp = {'name': 'sim_temp', 'calibrationType': 'temperature',
+            'measuredData': [TEMP_STANDARDS] * n,
+            'raw': [raw_runs('temp', TEMP_STANDARDS,
+                             lambda t: linear_raw(t, TEMP_LINEAR), 5)],
+            'fits': [{'name': 'sim_temp_fit', 'type': 'linear',
+                      'params': ['temp'], 'coefficients': [TEMP_LINEAR] * n,
+                      'timeFit': time.time(), 'active': True}]}
+    pump = {'name': 'sim_pump', 'calibrationType': 'pump',
+            'measuredData': [], 'raw': [],
+            'fits': [{'name': 'sim_pump_fit', 'type': 'constant',
+                      'params': ['pump'],
+                      'coefficients': [FLOW_RATE] * geometry.message_size,
+                      'timeFit': time.time(), 'active': True}]}
+    return [od, temp, pump]
+
+def create_server(evolver):
+    """
+    Returns the socket.io server answering the DPU on /dpu-evolver.
+    """
+    sio = socketio.AsyncServer(async_mode='aiohttp')
+
+    @sio.on('connect', namespace=NAMESPACE)
+    async def on_connect(sid, environ):
+        logger.info('client %s connected', sid)
+
+    @sio.on('disconnect', namespace=NAMESPACE)
+    async def on_disconnect(sid):
+        logger.info('client %s disconnected', sid)
+
+    @sio.on('command', namespace=NAMESPACE)
+    async def on_command(sid, data):
+        logger.debug('command: %s', data)
+        evolver.command(data)
+
+    @sio.on('getactivecal', namespace=NAMESPACE)
+    async def on_getactivecal(sid, data):
+        await sio.emit('activecalibrations', evolver.active_calibrations(),
+                       room=sid, namespace=NAMESPACE)
+
+    @sio.on('getcalibrationnames', namespace=NAMESPACE)
+    async def on_getcalibrationnames(sid, data):
+        await sio.emit('calibrationnames', evolver.calibration_names(),
+                       room=sid, namespace=NAMESPACE)
+
+    @sio.on('getcalibration', namespace=NAMESPACE)
+    async def on_getcalibration(sid, data):
+        calibration = evolver.calibrations.get(data.get('name'))
+        await sio.emit('calibration', calibration, room=sid,
+                       namespace=NAMESPACE)
+
+    @sio.on('setfitcalibration', namespace=NAMESPACE)
+    async def on_setfitcalibration(sid, data):
+        evolver.set_fit(data['name'], data['fit'])
+
+    return sio
+
+async def broadcast_loop(sio, evolver, interval, step, count=None):
+    """
+    Emits a broadcast every interval seconds, each advancing the model by
+    step simulated seconds. Stops after count broadcasts if given.
+    """
+    start = time.perf_counter()
+    next_at = time.monotonic()
+    while count is None or evolver.broadcasts < count:
+        await sio.emit('broadcast', evolver.broadcast(step),
+                       namespace=NAMESPACE)
+        if evolver.broadcasts % 1000 == 0:
+            rate = evolver.broadcasts / (time.perf_counter() - start)
+            logger.info('%d broadcasts, %.1f per second, %d commands',
+                        evolver.broadcasts, rate, evolver.commands)
+        # keep the rate steady, without catching up after stalls
+        next_at = max(next_at + interval, time.monotonic())
+        await asyncio.sleep(next_at - time.monotonic())
+
+async def serve(evolver, host, port, interval, step, count=None):
+    sio = create_server(evolver)
+    app = web.Application()
+    sio.attach(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print('eVOLVER simulator on %s:%d, a broadcast every %g s' %
+          (host, port, interval))
+    try:
+        await broadcast_loop(sio, evolver, interval, step, count)
+    finally:
+        await runner.cleanup()
+
+def load_calibrations(path):
+    with open(path) as f:
+        return json.load(f)
+
+def get_options():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='Address to listen on (default: %(default)s)')
+    parser.add_argument('-p', '--port', type=int, default=8081,
+                        help='Port to listen on (default: %(default)s)')
+    parser.add_argument('--vials', type=int, default=16,
+                        help='Number of vials (default: %(default)s)')
+    parser.add_argument('--interval', type=float, default=20,
+                        help='Wall-clock seconds between broadcasts '
+                             '(default: %(default)s)')
+    parser.add_argument('--step', type=float, default=None,
+                        help='Simulated seconds per broadcast (default: '
+                             'same as --interval)')
+    parser.add_argument('-n', '--broadcasts', type=int, default=None,
+                        help='Stop after this many broadcasts')
+    parser.add_argument('--od', type=float, default=0.05,
+                        help='Initial OD of every vial (default: '
+                             '%(default)s)')
+    parser.add_argument('--max-rate', type=float, default=0.8,
+                        help='Growth rate at the optimal temperature, in 1/h '
+                             '(default: %(default)s)')
+    parser.add_argument('--noise', type=float, default=0.002,
+                        help='Standard deviation of OD readings '
+                             '(default: %(default)s)')
+    parser.add_argument('--calibrations', default=None,
+                        help='JSON list of calibrations to serve instead of '
+                             'the simulated ones')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the reading noise')
+    parser.add_argument('-v', '--verbose', action='count', default=0,
+                        help='Log commands (default: INFO)')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    options = get_options()
+    logging.basicConfig(format='%(asctime)s - %(name)s - [%(levelname)s] '
+                        '- %(message)s',
+                        level=logging.DEBUG if options.verbose else
+                        logging.INFO)
+    if socketio is None:
+        print('The simulator needs python-socketio and aiohttp')
+        sys.exit(2)
+
+    geometry = DeviceGeometry(options.vials)
+    model = CultureModel(geometry, od=options.od, max_rate=options.max_rate,
+                         seed=options.seed)
+    calibrations = None
+    if options.calibrations is not None:
+        calibrations = load_calibrations(options.calibrations)
+    evolver = SimulatedEvolver(model, calibrations, noise=options.noise)
+    step = options.step if options.step is not None else options.interval
+    try:
+        asyncio.run(serve(evolver, options.host, options.port,
+                          options.interval, step, options.broadcasts))
+    except KeyboardInterrupt:
+        pass
+    print('%d broadcasts, %d commands, %d dilutions' %
+          (evolver.broadcasts, evolver.commands, model.dilutions.sum()))
@@ -0,0 +1,298 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+
+logger = logging.getLogger('eVOLVER')
+
+# server events handled on the event loop, in the order they arrive
+LOOP_EVENTS = ['broadcast', 'activecalibrations']
+
+# what to do with a broadcast when newer ones are already queued
+PROCESS_ALL = 'all'
+COALESCE = 'coalesce'
+BACKLOG_POLICIES = [PROCESS_ALL, COALESCE]
+
+# seconds the transport thread waits for packets at a time
+WAIT_SECONDS = 1
+# longest wait for the transport thread to close the connection
+CLOSE_TIMEOUT = 10
+
+class AsyncEvolverClient:
+    """
+    Runs an EvolverNamespace from an asyncio event loop instead of polling
+    socketIO.wait(seconds=0.1) and a stdin reader thread.
+
+    The socket.io transport blocks in its own thread and hands broadcasts
+    and calibrations to the loop as they arrive. Stdin commands from the
+    GUI (stop-script, pause-script, continue-script, reload-params) are
+    read when stdin becomes readable. Nothing runs while there is nothing
+    to do.
+
+    Broadcasts are timestamped on receipt. If processing falls behind and
+    newer broadcasts are already queued, the 'coalesce' backlog policy
+    only saves the data of the stale ones (namespace.on_broadcast is
+    called with control=False) so the control loop catches up with the
+    latest readings. Lag and processing time are logged per broadcast.
+
+    Only the transport thread closes the connection, between two short
+    socketIO.wait() calls: a wait() whose connection was closed under it
+    opens a new one before returning. Broadcasts still queued when the
+    client disconnects (pause, stop) are dropped.
+    """
+
+    def __init__(self, socketIO, namespace, stdin=None,
+                 backlog_policy=COALESCE, read_stdin=True):
+        if backlog_policy not in BACKLOG_POLICIES:
+            raise ValueError('unknown backlog policy %s' % backlog_policy)
+        self.backlog_policy = backlog_policy
+        self.socketIO = socketIO
+        self.namespace = namespace
+        self.stdin = stdin if stdin is not None else sys.stdin
+        # only one client per process can own stdin
+        self.read_stdin = read_stdin
+        self.paused = False
+        self._loop = None
+        self._events = None
+        self._listening = threading.Event()
+        self._listening.set()
+        # set once the connection is closed after a disconnect()
+        self._closed = threading.Event()
+        self._transport_thread = None
+        self._stdin_thread = None
+        self._periodic = []
+        self._timers = []
+        self._queued_broadcasts = 0
+        self.broadcasts = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_processing = 0.0
+        for event in LOOP_EVENTS:
+            handler = getattr(namespace, 'on_' + event)
+            namespace.on(event, self._forward(event, handler))
+
+    async def run(self):
+        """
+        Handles server events and stdin commands until cancelled (e.g. by
+        Ctrl-C). Exceptions raised by the namespace callbacks propagate.
+        """
+        self._loop = asyncio.get_running_loop()
+        self._events = asyncio.Queue()
+        self._queued_broadcasts = 0
+        self._start_transport()
+        self._start_stdin()
+        for interval, callback in self._periodic:
+            self._schedule(interval, callback)
+        try:
+            while True:
+                event, handler, args, received_at = await self._events.get()
+                if event == 'broadcast':
+                    self._queued_broadcasts -= 1
+                    if self.paused or not self.connected:
+                        # arrived before the connection was closed
+                        self.dropped += 1
+                        continue
+                    self._broadcast(handler, args, received_at)
+                else:
+                    handler(*args)
+        finally:
+            self._stop_stdin()
+            for timer in self._timers:
+                timer.cancel()
+            self._timers = []
+            self._loop = None
+
+    @property
+    def connected(self):
+        return self._listening.is_set()
+
+    def call_every(self, interval, callback):
+        """
+        Runs callback every interval seconds on the event loop while run()
+        is active.
+        """
+        self._periodic.append((interval, callback))
+        if self._loop is not None:
+            self._schedule(interval, callback)
+
+    def _schedule(self, interval, callback):
+        def tick():
+            self._timers.remove(handle)
+            self._schedule(interval, callback)
+            callback()
+        handle = self._loop.call_later(interval, tick)
+        self._timers.append(handle)
+
+    def pause(self):
+        self.paused = True
+        self.namespace.stop_exp()
+        self.disconnect()
+
+    def resume(self):
+        self.paused = False
+        self.connect()
+
+    def connect(self):
+        if self._listening.is_set():
+            return
+        # a disconnect still being done by the transport thread goes first
+        if not self._closed.wait(CLOSE_TIMEOUT):
+            logger.warning('connection still not closed after %d s',
+                           CLOSE_TIMEOUT)
+        self._closed.clear()
+        self.socketIO.connect()
+        self._listening.set()
+
+    def disconnect(self):
+        """
+        Stops listening and drops the queued broadcasts. The transport
+        thread, if running, closes the connection when its current wait
+        returns.
+        """
+        self._listening.clear()
+        self._drop_broadcasts()
+        if self._transport_thread is None:
+            self._close()
+
+    def metrics(self):
+        processed = self.broadcasts
+        return {'broadcasts': processed,
+                'coalesced': self.coalesced,
+                'dropped': self.dropped,
+                'queued': self._queued_broadcasts,
+                'last_lag': self.last_lag,
+                'max_lag': self.max_lag,
+                'mean_processing': (self.total_processing / processed
+                                    if processed else 0.0)}
+
+    def handle_message(self, message):
+        if 'stop-script' in message:
+            logger.info('Stop message received - halting all pumps');
+            self.namespace.stop_exp()
+            self.disconnect()
+        if 'pause-script' in message:
+            print('Pausing experiment', flush = True)
+            logger.info('Pausing experiment in dpu')
+            self.pause()
+        if 'continue-script' in message:
+            print('Restarting experiment', flush = True)
+            logger.info('Restarting experiment')
+            self.resume()
+        if 'reload-params' in message:
+            logger.info('Reloading experiment parameters')
+            self.namespace.reload_params()
+
+    def _forward(self, event, handler):
+        # called on the transport thread
+        def forward(*args):
+            received_at = time.time()
+            loop = self._loop
+            if loop is None:
+                logger.warning('%s received while not running, dropping',
+                               event)
+                return
+            try:
+                loop.call_soon_threadsafe(self._enqueue, event, handler,
+                                          args, received_at)
+            except RuntimeError:
+                logger.warning('%s received while shutting down, dropping',
+                               event)
+        return forward
+
+    def _enqueue(self, event, handler, args, received_at):
+        if event == 'broadcast':
+            self._queued_broadcasts += 1
+        self._events.put_nowait((event, handler, args, received_at))
+
+    def _drop_broadcasts(self):
+        if self._events is None:
+            return
+        kept = []
+        while not self._events.empty():
+            item = self._events.get_nowait()
+            if item[0] == 'broadcast':
+                self._queued_broadcasts -= 1
+                self.dropped += 1
+            else:
+                kept.append(item)
+        for item in kept:
+            self._events.put_nowait(item)
+
+    def _broadcast(self, handler, args, received_at):
+        lag = time.time() - received_at
+        control = not (self.backlog_policy == COALESCE and
+                       self._queued_broadcasts > 0)
+        start = time.monotonic()
+        handler(*args, received_at=received_at, control=control)
+        processing = time.monotonic() - start
+        self.broadcasts += 1
+        if not control:
+            self.coalesced += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_processing += processing
+        logger.info('broadcast lag %.3f s, processed in %.3f s, %d waiting, '
+                    '%d of %d coalesced', lag, processing,
+                    self._queued_broadcasts, self.coalesced, self.broadcasts)
+
+    def _start_transport(self):
+        if self._transport_thread is not None:
+            return
+        # the thread logs in the context run() was started in
+        context = contextvars.copy_context()
+        self._transport_thread = threading.Thread(target=context.run,
+                                                  args=(self._listen,),
+                                                  name='eVOLVER-socketio')
+        self._transport_thread.daemon = True
+        self._transport_thread.start()
+
+    def _listen(self):
+        while True:
+            # sleeps while disconnected (paused or stopped)
+            self._listening.wait()
+            while self._listening.is_set():
+                self.socketIO.wait(seconds=WAIT_SECONDS)
+            self._close()
+
+    def _close(self):
+        self.socketIO.disconnect()
+        self._closed.set()
+
+    def _start_stdin(self):
+        if not self.read_stdin:
+            return
+        try:
+            self._loop.add_reader(self.stdin.fileno(), self._read_stdin)
+        except (NotImplementedError, AttributeError, ValueError, OSError):
+            # e.g. Windows event loops can't watch pipes, use a thread
+            if self._stdin_thread is None:
+                self._stdin_thread = threading.Thread(target=self._stdin_lines,
+                                                      name='eVOLVER-stdin')
+                self._stdin_thread.daemon = True
+                self._stdin_thread.start()
+
+    def _stop_stdin(self):
+        if not self.read_stdin:
+            return
+        try:
+            self._loop.remove_reader(self.stdin.fileno())
+        except (NotImplementedError, AttributeError, ValueError, OSError):
+            pass
+
+    def _read_stdin(self):
+        line = self.stdin.readline()
+        if not line:
+            # stdin closed, nothing more to listen for
+            self._stop_stdin()
+            return
+        self.handle_message(line)
+
+    def _stdin_lines(self):
+        for line in self.stdin:
+            loop = self._loop
+            if loop is not None:
+                loop.call_soon_threadsafe(self.handle_message, line)
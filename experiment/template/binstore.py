@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+Append-only binary storage for per-vial time series.
+
+Each series lives next to its text counterpart as vialN_<param>.bin: a
+16 byte header followed by fixed-width little-endian float64
+(time, value) records, so a whole file can be memory-mapped as an (n, 2)
+array without parsing. The command line converts experiment data between
+the text and binary layouts:
+
+    python3 binstore.py to-binary data
+    python3 binstore.py to-text data -p OD temp
+
+Files that already hold data in the target layout are left alone unless
+--force is given. Converting to text keeps the header lines of the existing
+text file, written when the experiment started.
+"""
+
+import os
+import re
+import sys
+import logging
+import argparse
+import numpy as np
+
+MAGIC = b'EVBIN\x00\x00\x01'
+HEADER_SIZE = 16
+RECORD_DTYPE = np.dtype('<f8')
+RECORD_SIZE = 2 * RECORD_DTYPE.itemsize
+
+TEXT_EXTENSION = '.txt'
+BINARY_EXTENSION = '.bin'
+
+logger = logging.getLogger('eVOLVER')
+
+def binary_path(text_path):
+    return os.path.splitext(text_path)[0] + BINARY_EXTENSION
+
+def text_path(bin_path):
+    return os.path.splitext(bin_path)[0] + TEXT_EXTENSION
+
+def header():
+    return MAGIC + b'\x00' * (HEADER_SIZE - len(MAGIC))
+
+def check_header(path, data):
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('%s is not an eVOLVER binary series' % path)
+
+def to_records(rows):
+    return np.ascontiguousarray(rows, dtype=RECORD_DTYPE).reshape(-1, 2)
+
+def append_rows(path, rows):
+    """
+    Appends (time, value) rows to a binary series, creating it if needed.
+    """
+    records = to_records(rows)
+    with open(path, 'ab') as f:
+        if f.tell() == 0:
+            f.write(header())
+        f.write(records.tobytes())
+
+def repair(path):
+    """
+    Truncates a record cut short by a crash mid-write.
+    """
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return
+    if size < HEADER_SIZE:
+        if size:
+            logger.warning('dropping incomplete header of %s', path)
+            os.truncate(path, 0)
+        return
+    extra = (size - HEADER_SIZE) % RECORD_SIZE
+    if extra:
+        logger.warning('dropping incomplete last record of %s', path)
+        os.truncate(path, size - extra)
+
+def load(path, mmap=True):
+    """
+    Returns the series as an (n, 2) float64 array of (time, value) rows.
+    With mmap the array is a read-only view of the file, nothing is
+    copied until it is used.
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        check_header(path, f.read(HEADER_SIZE))
+    n = max(size - HEADER_SIZE, 0) // RECORD_SIZE
+    if n == 0:
+        return np.empty((0, 2), dtype=RECORD_DTYPE)
+    if mmap:
+        return np.memmap(path, dtype=RECORD_DTYPE, mode='r',
+                         offset=HEADER_SIZE, shape=(n, 2))
+    with open(path, 'rb') as f:
+        f.seek(HEADER_SIZE)
+        return np.fromfile(f, dtype=RECORD_DTYPE, count=2 * n).reshape(n, 2)
+
+def load_tail(path, n):
+    """
+    Returns the last n rows of the series (fewer if it is shorter).
+    """
+    size = os.path.getsize(path)
+    total = max(size - HEADER_SIZE, 0) // RECORD_SIZE
+    n = min(n, total)
+    with open(path, 'rb') as f:
+        check_header(path, f.read(HEADER_SIZE))
+        f.seek(HEADER_SIZE + (total - n) * RECORD_SIZE)
+        return np.fromfile(f, dtype=RECORD_DTYPE, count=2 * n).reshape(n, 2)
+
+def parse_row(line):
+    """
+    Returns the (time, value) row of a text line, None for headers and
+    malformed lines.
+    """
+    values = line.strip().split(',')
+    if len(values) != 2:
+        return None
+    try:
+        return float(values[0]), float(values[1])
+    except ValueError:
+        return None
+
+def read_text_rows(path):
+    # headers and malformed lines are skipped, like the readers of the
+    # text files do
+    rows = []
+    with open(path) as f:
+        for line in f:
+            row = parse_row(line)
+            if row is not None:
+                rows.append(row)
+    return np.asarray(rows, dtype=RECORD_DTYPE).reshape(-1, 2)
+
+def read_text_header(path):
+    """
+    Returns the lines of a text series before its first row.
+    """
+    lines = []
+    with open(path) as f:
+        for line in f:
+            if parse_row(line) is not None:
+                break
+            lines.append(line.rstrip('\n'))
+    return lines
+
+def has_rows(path):
+    """
+    Whether a text or binary series exists and holds at least one row.
+    """
+    if not os.path.exists(path):
+        return False
+    if path.endswith(BINARY_EXTENSION):
+        return os.path.getsize(path) >= HEADER_SIZE + RECORD_SIZE
+    return len(read_text_rows(path)) > 0
+
+def text_to_binary(src, dst=None):
+    dst = dst or binary_path(src)
+    rows = read_text_rows(src)
+    tmp_path = dst + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(header())
+        f.write(to_records(rows).tobytes())
+    os.replace(tmp_path, dst)
+    return len(rows)
+
+def binary_to_text(src, dst=None, header_lines=None):
+    dst = dst or text_path(src)
+    rows = load(src, mmap=False)
+    tmp_path = dst + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for line in header_lines or []:
+            f.write(line + '\n')
+        for elapsed_time, value in rows.tolist():
+            f.write('{0},{1}\n'.format(elapsed_time, value))
+    os.replace(tmp_path, dst)
+    return len(rows)
+
+def series_files(exp_dir, extension, parameters=None):
+    pattern = re.compile(r'^vial(\d+)_(.+)' + re.escape(extension) + '$')
+    for parameter in sorted(os.listdir(exp_dir)):
+        directory = os.path.join(exp_dir, parameter)
+        if not os.path.isdir(directory):
+            continue
+        if parameters is not None and parameter not in parameters:
+            continue
+        for file_name in sorted(os.listdir(directory)):
+            match = pattern.match(file_name)
+            if match and match.group(2) == parameter:
+                yield int(match.group(1)), parameter, os.path.join(directory,
+                                                                 file_name)
+
+def convert(exp_dir, to_binary=True, parameters=None, force=False):
+    """
+    Converts every vialN_<param> series in an experiment directory. Series
+    whose target file already holds rows are skipped unless force is set.
+    Returns the number of files converted and the list of skipped targets.
+    """
+    converted = 0
+    skipped = []
+    extension = TEXT_EXTENSION if to_binary else BINARY_EXTENSION
+    for vial, parameter, path in series_files(exp_dir, extension, parameters):
+        dst = binary_path(path) if to_binary else text_path(path)
+        if not force and has_rows(dst):
+            print('{0}: already has data, skipping'.format(dst))
+            skipped.append(dst)
+            continue
+        if to_binary:
+            rows = text_to_binary(path, dst)
+        else:
+            # the header written when the experiment started, if any
+            header_lines = None
+            if os.path.exists(dst):
+                header_lines = read_text_header(dst)
+            rows = binary_to_text(path, dst, header_lines=header_lines)
+        print('{0}: {1} rows'.format(path, rows))
+        converted += 1
+    return converted, skipped
+
+def get_options():
+    parser = argparse.ArgumentParser(
+        description='Convert eVOLVER experiment data between the text and '
+                    'binary layouts')
+    parser.add_argument('direction', choices=['to-binary', 'to-text'])
+    parser.add_argument('exp_dir', help='Experiment data directory')
+    parser.add_argument('-p', '--params', nargs='+', default=None,
+                        help='Parameters to convert (default: all)')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='Overwrite files that already hold data')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    options = get_options()
+    if not os.path.isdir(options.exp_dir):
+        print('No such experiment directory: %s' % options.exp_dir)
+        sys.exit(2)
+    n, skipped = convert(options.exp_dir, options.direction == 'to-binary',
+                         options.params, options.force)
+    print('Converted {0} files'.format(n))
+    if skipped:
+        print('Skipped {0} files that already hold data, use --force to '
+              'overwrite them'.format(len(skipped)))
+        sys.exit(1)
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import logging
+import numpy as np
+
+SIGMOID = 'sigmoid'
+LINEAR = 'linear'
+THREE_DIMENSION = '3d'
+# calibrate.py's pump fit, one flow rate per vial (see flow_rate()); it
+# does not convert readings
+CONSTANT = 'constant'
+
+# number of coefficients each fit type needs per vial
+N_COEFFICIENTS = {SIGMOID: 4, LINEAR: 2, THREE_DIMENSION: 6, CONSTANT: 1}
+
+logger = logging.getLogger('eVOLVER')
+
+class Calibration:
+    """
+    A calibration fit (as stored in od_cal.json/temp_cal.json) with its
+    coefficients parsed once into a (vials x coefficients) float array.
+
+    Vials with missing or malformed coefficients get a row of NaN, so they
+    come out as NaN from apply() instead of raising.
+    """
+
+    def __init__(self, fit):
+        self.fit = fit
+        self.type = fit['type']
+        self.params = fit['params']
+        self.coefficients = self._parse_coefficients(fit['coefficients'])
+
+    def _parse_coefficients(self, coefficients):
+        width = N_COEFFICIENTS.get(self.type, 0)
+        parsed = np.full((len(coefficients), width), np.nan)
+        for x, row in enumerate(coefficients):
+            if not isinstance(row, (list, tuple)):
+                row = [row]
+            try:
+                row = np.asarray(row, dtype=np.float64)
+            except (TypeError, ValueError):
+                logger.error('malformed %s calibration coefficients for '
+                             'vial %d', self.type, x)
+                continue
+            if row.size < width:
+                logger.error('expected %d %s calibration coefficients for '
+                             'vial %d, got %d', width, self.type, x, row.size)
+                continue
+            parsed[x] = row[:width]
+        return parsed
+
+    def apply(self, raw, raw_2=None, vials=None):
+        """
+        Converts raw readings into calibrated values for all vials at once.
+        raw_2 is the second parameter, only used by 3d fits. Any vial whose
+        result is not finite is set to NaN.
+        """
+        if self.type == CONSTANT:
+            raise ValueError('constant calibrations are pump flow rates, '
+                             'they cannot convert readings')
+        if vials is None:
+            vials = np.arange(len(raw))
+        c = self.coefficients[vials].T
+        x = np.asarray(raw, dtype=np.float64)[vials]
+
+        with np.errstate(all='ignore'):
+            if self.type == SIGMOID:
+                result = c[2] - np.log10((c[1] - c[0]) / (x - c[0]) - 1) / c[3]
+            elif self.type == LINEAR:
+                result = x * c[0] + c[1]
+            elif self.type == THREE_DIMENSION:
+                if raw_2 is None:
+                    logger.error('3d calibration requires a second parameter')
+                    return np.full(len(x), np.nan)
+                y = np.asarray(raw_2, dtype=np.float64)[vials]
+                result = (c[0] + c[1] * x + c[2] * y + c[3] * x**2 +
+                          c[4] * x * y + c[5] * y**2)
+            else:
+                logger.error('calibration not of supported type %s!',
+                             self.type)
+                return np.full(len(x), np.nan)
+
+        result[~np.isfinite(result)] = np.nan
+        return result
+
+    def invert(self, values, vials=None):
+        """
+        Converts calibrated values (one per entry in vials) back to raw
+        values. Linear (e.g. temperature) and sigmoid fits can be inverted;
+        vials whose result is not finite are set to NaN.
+        """
+        if self.type not in (LINEAR, SIGMOID):
+            raise ValueError('cannot invert a %s calibration' % self.type)
+        if vials is None:
+            vials = np.arange(len(values))
+        c = self.coefficients[vials].T
+        values = np.asarray(values, dtype=np.float64)
+        with np.errstate(all='ignore'):
+            if self.type == LINEAR:
+                result = (values - c[1]) / c[0]
+            else:
+                result = c[0] + (c[1] - c[0]) / (1 + 10**((c[2] - values) *
+                                                          c[3]))
+        result[~np.isfinite(result)] = np.nan
+        return result
+
+class CalibrationStore:
+    """
+    Keeps the active calibrations in memory, keyed by calibration type
+    ('od', 'temperature', 'pump'). Calibrations pushed by the server go
+    through set(), which also persists them to disk. The files are only
+    read again if their mtime changes (checked at most every
+    check_interval seconds), e.g. when edited by hand.
+    """
+
+    def __init__(self, paths, check_interval=30):
+        self.paths = paths
+        self.check_interval = check_interval
+        self._calibrations = {}
+        self._mtimes = {}
+        self._flow_rate = None
+        self._last_check = None
+
+    def set(self, calibration_type, fit):
+        file_path = self.paths[calibration_type]
+        with open(file_path, 'w') as f:
+            json.dump(fit, f)
+        self._store(calibration_type, fit, os.stat(file_path).st_mtime)
+
+    def get(self, calibration_type):
+        self.refresh()
+        return self._calibrations.get(calibration_type)
+
+    def has_all(self):
+        self.refresh()
+        return all(t in self._calibrations for t in self.paths)
+
+    def flow_rate(self):
+        self.refresh()
+        return self._flow_rate
+
+    def refresh(self, force=False):
+        now = time.time()
+        if (not force and self._last_check is not None and
+                now - self._last_check < self.check_interval):
+            return
+        self._last_check = now
+        for calibration_type, file_path in self.paths.items():
+            try:
+                mtime = os.stat(file_path).st_mtime
+            except OSError:
+                self._forget(calibration_type)
+                continue
+            if self._mtimes.get(calibration_type) == mtime:
+                continue
+            try:
+                with open(file_path) as f:
+                    fit = json.load(f)
+            except ValueError:
+                logger.error('could not parse calibration file %s',
+                             file_path)
+                self._forget(calibration_type)
+                continue
+            logger.info('loaded %s calibration from %s', calibration_type,
+                        file_path)
+            self._store(calibration_type, fit, mtime)
+
+    def _store(self, calibration_type, fit, mtime):
+        if fit.get('type') == CONSTANT and calibration_type != 'pump':
+            logger.error('constant fits are only for pump calibrations, '
+                         'ignoring the %s calibration', calibration_type)
+            self._forget(calibration_type)
+            return
+        self._calibrations[calibration_type] = Calibration(fit)
+        self._mtimes[calibration_type] = mtime
+        if calibration_type == 'pump':
+            self._flow_rate = np.asarray(fit['coefficients'],
+                                         dtype=np.float64)
+
+    def _forget(self, calibration_type):
+        self._calibrations.pop(calibration_type, None)
+        self._mtimes.pop(calibration_type, None)
+        if calibration_type == 'pump':
+            self._flow_rate = None
@@ -0,0 +1,65 @@
+import os
+import json
+import logging
+
+logger = logging.getLogger('eVOLVER')
+
+# bump when the layout of the checkpoint changes
+VERSION = 1
+
+class Checkpoint:
+    """
+    The state needed to resume an experiment (start time, OD blank and the
+    in-memory controller state, see EvolverNamespace.save_variables), kept
+    in one small versioned JSON file.
+
+    save() writes a temporary file and renames it over the checkpoint, so a
+    crash mid-write leaves the previous checkpoint intact. Saving the same
+    content twice in a row only writes once.
+    """
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self._last = None
+
+    def save(self, state):
+        """
+        Writes state (a JSON serializable dict). Returns False if it was
+        unchanged since the last save or load.
+        """
+        state = dict(state, version=VERSION)
+        data = json.dumps(state, sort_keys=True,
+                          separators=(',', ':')).encode()
+        if data == self._last:
+            return False
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+        self._last = data
+        return True
+
+    def load(self):
+        """
+        Returns the saved state, or None if there is no usable checkpoint.
+        """
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            state = json.loads(data)
+        except ValueError:
+            logger.error('could not read checkpoint %s', self.path)
+            return None
+        if state.get('version') != VERSION:
+            logger.error('checkpoint %s has version %s, expected %s',
+                         self.path, state.get('version'), VERSION)
+            return None
+        self._last = data
+        return state
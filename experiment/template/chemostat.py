@@ -0,0 +1,164 @@
+import logging
+import numpy as np
+
+from geometry import INFLUX, EFFLUX
+
+logger = logging.getLogger('eVOLVER')
+
+class ChemostatEngine:
+    """
+    The chemostat of custom_script.py for all its vials at once.
+
+    Each vial's last chemo_config record (time, phase and period) is kept
+    in arrays, read once from the control-state files; a record is only
+    appended when a vial's period changes. Bolus times and periods are
+    computed for every vial in one go and only again when the rates, flow
+    rates, bolus or volume change.
+
+    The recurring pump command is kept as it was last formatted, one
+    '<bolus s>|<period s>' string per pump slot, and only the slots of
+    vials whose bolus or period changed are formatted again.
+    """
+
+    def __init__(self, geometry):
+        self.geometry = geometry
+        n_vials = geometry.n_vials
+        self.last_set = np.zeros(n_vials)
+        self.last_phase = np.zeros(n_vials)
+        self.last_rate = np.zeros(n_vials)
+        self._loaded = np.zeros(n_vials, dtype=bool)
+        # bolus times and periods of the last settings
+        self._settings = None
+        self._bolus_in_s = None
+        self._period = None
+        # pump command as last formatted, and what it was formatted from
+        self.values = np.array(geometry.message(), dtype=object)
+        self._formatted_bolus = np.full(n_vials, np.nan)
+        self._formatted_period = np.full(n_vials, np.nan)
+        self._influx = geometry.pump_slots(INFLUX)
+        self._efflux = geometry.pump_slots(EFFLUX)
+
+    def load(self, state, vials):
+        """
+        Reads the chemo_config of vials not seen yet from the control-state
+        records.
+        """
+        for x in vials:
+            # plain ints, vials end up in the checkpoint as record keys
+            x = int(x)
+            if self._loaded[x]:
+                continue
+            self.last_set[x], self.last_phase[x], self.last_rate[x] = \
+                state.last('chemo_config', x)[:3]
+            self._loaded[x] = True
+
+    def forget(self, vials=None):
+        """
+        Reads the state of vials again on next use, e.g. after their files
+        were replaced.
+        """
+        if vials is None:
+            self._loaded[:] = False
+        else:
+            self._loaded[np.asarray(vials, dtype=np.intp)] = False
+
+    def schedule(self, rate_config, flow_rate, bolus, volume):
+        """
+        Returns the bolus time (s) and dilution period (s) of every vial:
+        bolus / flow rate and 3600 * bolus / (rate * volume), 0 for vials
+        with no dilution rate.
+        """
+        settings = (np.array(rate_config, dtype=np.float64),
+                    np.array(flow_rate, dtype=np.float64), bolus, volume)
+        if self._settings is not None and _same(settings, self._settings):
+            return self._bolus_in_s, self._period
+        rates = settings[0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bolus_in_s = bolus / settings[1]
+            # scale dilution rate by bolus size and volume
+            period = np.where(rates > 0, (3600 * bolus) / (rates * volume),
+                              0.0)
+        self._settings = settings
+        self._bolus_in_s, self._period = bolus_in_s, period
+        return bolus_in_s, period
+
+    def run(self, eVOLVER, vials, elapsed_time, rate_config, flow_rate,
+            start_time, start_OD, bolus, volume, window=6, n_sigmas=None):
+        """
+        Runs one control step for vials, recording period changes, and
+        returns the bolus times and periods (0 for vials that haven't
+        started) to pass to EvolverNamespace.update_chemo. n_sigmas is as
+        for TurbidostatEngine.run.
+        """
+        bolus_in_s = eVOLVER.geometry.zeros()
+        period_config = eVOLVER.geometry.zeros()
+        vials = np.asarray(vials, dtype=np.intp)
+        if vials.size == 0:
+            return bolus_in_s, period_config
+        self.load(eVOLVER.state, vials)
+
+        average_OD, enough = eVOLVER.rolling_median('OD', vials, window,
+                                                    n_sigmas=n_sigmas)
+        for x in vials[~enough]:
+            logger.debug('not enough OD measurements for vial %d', x)
+
+        # once start time has passed and culture hits start OD
+        with np.errstate(invalid='ignore'):
+            started = (enough &
+                       (elapsed_time > np.asarray(start_time)[vials]) &
+                       (average_OD > np.asarray(start_OD)[vials]))
+        running = vials[started]
+        all_bolus_in_s, all_period = self.schedule(rate_config, flow_rate,
+                                                   bolus, volume)
+        bolus_in_s[running] = all_bolus_in_s[running]
+        period_config[running] = all_period[running]
+
+        changed = running[self.last_rate[running] != period_config[running]]
+        for x in changed.tolist():
+            print('Chemostat updated in vial {0}'.format(x))
+            logger.info('chemostat initiated for vial %d, period %.2f',
+                        x, period_config[x])
+            # note that this changes chemophase
+            phase = self.last_phase[x] + 1
+            eVOLVER.state.append('chemo_config', x, elapsed_time, phase,
+                                 period_config[x])
+            self.last_set[x] = elapsed_time
+            self.last_phase[x] = phase
+            self.last_rate[x] = period_config[x]
+        return bolus_in_s, period_config
+
+    def pump_values(self, vials, bolus_in_s, period_config):
+        """
+        The recurring pump command for vials as an array of slot strings
+        ('0|0' stops a vial's pumps), formatting only vials whose bolus or
+        period changed since they were last formatted. Other slots hold
+        whatever they were last formatted to.
+        """
+        vials = np.asarray(vials, dtype=np.intp)
+        bolus_in_s = np.asarray(bolus_in_s, dtype=np.float64)[vials]
+        period = np.asarray(period_config, dtype=np.float64)[vials]
+        stale = ((bolus_in_s != self._formatted_bolus[vials]) |
+                 (period != self._formatted_period[vials]))
+        for x, seconds, period_s in zip(vials[stale], bolus_in_s[stale],
+                                        period[stale]):
+            # stop pumps if period is zero
+            if period_s == 0:
+                influx = efflux = '0|0'
+            else:
+                influx = '%.2f|%d' % (seconds, period_s)
+                efflux = '%.2f|%d' % (seconds * 2, period_s)
+            self.values[self._influx[x]] = influx
+            self.values[self._efflux[x]] = efflux
+            self._formatted_bolus[x] = seconds
+            self._formatted_period[x] = period_s
+        return self.values
+
+    def slots(self, vials):
+        vials = np.asarray(vials, dtype=np.intp)
+        return np.concatenate((self._influx[vials], self._efflux[vials]))
+
+def _same(settings, other):
+    rates, flow_rate, bolus, volume = settings
+    return (np.array_equal(rates, other[0], equal_nan=True) and
+            np.array_equal(flow_rate, other[1], equal_nan=True) and
+            bolus == other[2] and volume == other[3])
@@ -0,0 +1,109 @@
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger('eVOLVER')
+
+# slot value meaning "leave this vial/channel as it is"
+KEEP = '--'
+PUMP = 'pump'
+
+class CommandBatcher:
+    """
+    Collects the commands produced while handling a broadcast and sends
+    them in one go at the end of it, instead of one emit per call.
+
+    Between begin() and flush(), commands for the same parameter (and
+    recurring flag) are merged slot by slot, later values winning over
+    earlier ones except where they are '--'. On flush, recurring commands
+    that match the configuration the server reported in the broadcast are
+    dropped, and pump commands go out before the others. Outside a
+    broadcast, commands are sent right away.
+
+    One-off and recurring (chemostat) commands are never merged with each
+    other, the server only keeps running the recurring ones.
+    """
+
+    def __init__(self, send):
+        self.send = send
+        # None outside a broadcast
+        self._pending = None
+        self._acknowledged = {}
+        self.sent = 0
+        self.merged = 0
+        self.dropped = 0
+
+    def begin(self, config=None):
+        """
+        Starts collecting. config is the broadcast's 'config' field, the
+        values the server currently runs with.
+        """
+        self._pending = OrderedDict()
+        self._acknowledged = {}
+        for param, entry in (config or {}).items():
+            if isinstance(entry, dict) and 'value' in entry:
+                self._acknowledged[param] = entry['value']
+
+    def submit(self, command):
+        if self._pending is None:
+            self._send(command)
+            return
+        key = (command['param'], command.get('recurring', False))
+        pending = self._pending.get(key)
+        if pending is None:
+            self._pending[key] = dict(command, value=list(command['value']))
+        else:
+            self._pending[key] = merge(pending, command)
+            self.merged += 1
+
+    def send_now(self, command):
+        """
+        Sends a command right away, dropping any collected ones for the
+        same parameter (e.g. to stop all pumps).
+        """
+        if self._pending is not None:
+            for key in [key for key in self._pending
+                        if key[0] == command['param']]:
+                del self._pending[key]
+        self._send(command)
+
+    def flush(self):
+        pending, self._pending = self._pending, None
+        if not pending:
+            return
+        # pumps first, otherwise in the order they were submitted
+        commands = sorted(pending.items(), key=lambda item: item[0][0] != PUMP)
+        for (param, recurring), command in commands:
+            if recurring and self._is_acknowledged(command):
+                self.dropped += 1
+                logger.debug('%s already configured, not sending %s',
+                             param, command)
+                continue
+            self._send(command)
+
+    def metrics(self):
+        return {'sent': self.sent, 'merged': self.merged,
+                'dropped': self.dropped}
+
+    def _is_acknowledged(self, command):
+        current = self._acknowledged.get(command['param'])
+        if current is None or len(current) != len(command['value']):
+            return False
+        return all(value == KEEP or str(value) == str(configured)
+                   for value, configured in zip(command['value'], current))
+
+    def _send(self, command):
+        self.sent += 1
+        self.send(command)
+
+def merge(first, second):
+    """
+    Overlays the slots of second that aren't '--' onto first.
+    """
+    if len(first['value']) != len(second['value']):
+        return dict(second, value=list(second['value']))
+    value = list(first['value'])
+    for i, slot in enumerate(second['value']):
+        if slot != KEEP:
+            value[i] = slot
+    immediate = first.get('immediate', False) or second.get('immediate', False)
+    return dict(second, value=value, immediate=immediate)
@@ -0,0 +1,185 @@
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+import binstore
+
+logger = logging.getLogger('eVOLVER')
+
+class DataWriter:
+    """
+    Appends rows to the experiment data files through handles that stay
+    open, instead of an open/append/close per vial and parameter.
+
+    Rows are queued by write() (text rows) or write_record() (binary
+    (time, value) records to .bin files, see binstore.py) and reach the
+    files on flush(), one write per file. flush_interval is the minimum
+    number of seconds between flushes (0 flushes on every call, i.e. once
+    per broadcast). fsync_interval is the minimum number of seconds between
+    fsyncs of the flushed files (None never fsyncs, 0 fsyncs on every
+    flush). With an IOThread the flushed rows are written in the
+    background.
+
+    Code reading a data file back from disk should call flush_file() on it
+    first, as rows may still be queued.
+    """
+
+    def __init__(self, flush_interval=0, fsync_interval=None,
+                 max_open_files=256, io=None):
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_open_files = max_open_files
+        # optional IOThread doing the actual writes
+        self.io = io
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+        self._pending = OrderedDict()
+        self._unsynced = set()
+        # files whose rows were dropped by the IOThread, see take_dropped()
+        self._dropped = set()
+        self._last_flush = None
+        self._last_fsync = None
+
+    def write(self, path, text):
+        # open now so a missing directory shows up at the caller
+        if path not in self._files:
+            with self._lock:
+                self._open(path)
+        self._pending.setdefault(path, []).append(text)
+
+    def write_record(self, path, elapsed_time, value):
+        if path not in self._files:
+            with self._lock:
+                self._open(path)
+        self._pending.setdefault(path, []).append((elapsed_time, value))
+
+    def flush(self, force=False):
+        now = time.time()
+        if (not force and self.flush_interval and self._last_flush is not None
+                and now - self._last_flush < self.flush_interval):
+            return
+        self._last_flush = now
+        fsync = self.fsync_interval is not None and (
+            force or self._last_fsync is None or
+            now - self._last_fsync >= self.fsync_interval)
+        if fsync:
+            self._last_fsync = now
+        batch = list(self._pending.items())
+        self._pending = OrderedDict()
+        if not batch and not fsync:
+            return
+        if self.io is not None:
+            if not self.io.submit(self._write_batch, batch, fsync):
+                self._dropped.update(path for path, rows in batch)
+        else:
+            self._write_batch(batch, fsync)
+
+    def pending(self, path):
+        """
+        Whether rows of path are queued and not flushed yet.
+        """
+        return path in self._pending
+
+    def take_dropped(self):
+        """
+        Returns the files that lost rows to a dropped write since the last
+        call, whose contents no longer match what was written to them.
+        """
+        dropped, self._dropped = self._dropped, set()
+        return dropped
+
+    def flush_file(self, path):
+        if self.io is not None:
+            self.io.drain()
+        if path in self._pending:
+            self._write_batch([(path, self._pending.pop(path))], False)
+
+    def close(self):
+        # a failed background write is raised by drain(), after the files
+        # are closed
+        try:
+            self.flush(force=True)
+            if self.io is not None:
+                self.io.drain()
+        finally:
+            with self._lock:
+                for f in self._files.values():
+                    f.close()
+                self._files.clear()
+                self._unsynced.clear()
+
+    def _write_batch(self, batch, fsync):
+        with self._lock:
+            for path, rows in batch:
+                f = self._open(path)
+                if 'b' in f.mode:
+                    f.write(binstore.to_records(rows).tobytes())
+                else:
+                    f.write(''.join(rows))
+                f.flush()
+                self._unsynced.add(path)
+            if fsync:
+                self._fsync()
+
+    def _fsync(self):
+        for path in self._unsynced:
+            f = self._files.get(path)
+            if f is not None:
+                os.fsync(f.fileno())
+        self._unsynced.clear()
+
+    def _open(self, path):
+        f = self._files.get(path)
+        if f is not None:
+            self._files.move_to_end(path)
+            return f
+        while len(self._files) >= self.max_open_files:
+            self._close_oldest()
+        if path.endswith(binstore.BINARY_EXTENSION):
+            binstore.repair(path)
+            f = open(path, 'ab')
+            if f.tell() == 0:
+                f.write(binstore.header())
+        else:
+            repair_partial_line(path)
+            f = open(path, 'a')
+        self._files[path] = f
+        return f
+
+    def _close_oldest(self):
+        path, f = self._files.popitem(last=False)
+        if path in self._unsynced and self.fsync_interval is not None:
+            os.fsync(f.fileno())
+        self._unsynced.discard(path)
+        f.close()
+
+def repair_partial_line(path):
+    """
+    Drops a trailing incomplete row left behind by a crash mid-write, so
+    the next row does not get glued onto it.
+    """
+    try:
+        f = open(path, 'rb+')
+    except FileNotFoundError:
+        return
+    with f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b'\n':
+            return
+        position = size
+        while position > 0:
+            step = min(512, position)
+            position -= step
+            f.seek(position)
+            newline = f.read(step).rfind(b'\n')
+            if newline != -1:
+                position += newline + 1
+                break
+        logger.warning('dropping incomplete last row of %s', path)
+        f.truncate(position)
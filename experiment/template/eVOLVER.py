@@ -7,33 +7,66 @@ import pickle
 import shutil
 import logging
 import argparse
+import asyncio
 import numpy as np
 import json
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 from scipy import stats
 from socketIO_client import SocketIO, BaseNamespace
-from nbstreamreader import NonBlockingStreamReader as NBSR
+from calibrations import CalibrationStore
+from ringbuffer import VialRingBuffer, read_tail, read_since
+from rollingstats import hampel
+from datawriter import DataWriter
+import binstore
+from growthrate import GrowthRateEstimator
+from statestore import StateStore
+from checkpoint import Checkpoint
+from commands import CommandBatcher
+import logsetup
+from recording import BroadcastRecorder, BROADCAST, CALIBRATIONS
+from modes import ModeRegistry, VialConfig, ParamsFile
+from modes import group_vials, script_modes
+from metrics import StageTimer, MetricsServer, BroadcastProfiler, write_metrics
+from iothread import IOThread, POLICIES
+from asyncclient import AsyncEvolverClient, BACKLOG_POLICIES
+from geometry import DeviceGeometry
+from turbidostat import TurbidostatEngine
+from chemostat import ChemostatEngine
+from calibrations import THREE_DIMENSION
 
 import custom_script
 from custom_script import EXP_NAME
-from custom_script import EVOLVER_PORT, OPERATION_MODE
-from custom_script import STIR_INITIAL, TEMP_INITIAL
+from custom_script import EVOLVER_PORT
 
-# Should not be changed
+# Set through GEOMETRY in custom_script.py, not here
 # vials to be considered/excluded should be handled
 # inside the custom functions
-VIALS = [x for x in range(16)]
+GEOMETRY = DeviceGeometry.from_config(getattr(custom_script, 'GEOMETRY', None))
+VIALS = GEOMETRY.vials
 
 SAVE_PATH = os.path.dirname(os.path.realpath(__file__))
 EXP_DIR = os.path.join(SAVE_PATH, EXP_NAME)
-OD_CAL_PATH = os.path.join(SAVE_PATH, 'od_cal.json')
-TEMP_CAL_PATH = os.path.join(SAVE_PATH, 'temp_cal.json')
-PUMP_CAL_PATH = os.path.join(SAVE_PATH, 'pump_cal.json')
-JSON_PARAMS_FILE = os.path.join(SAVE_PATH, 'eVOLVER_parameters.json')
-
-SIGMOID = 'sigmoid'
-LINEAR = 'linear'
-THREE_DIMENSION = '3d'
+OD_CAL_FILE = 'od_cal.json'
+TEMP_CAL_FILE = 'temp_cal.json'
+PUMP_CAL_FILE = 'pump_cal.json'
+JSON_PARAMS_NAME = 'eVOLVER_parameters.json'
+OD_CAL_PATH = os.path.join(SAVE_PATH, OD_CAL_FILE)
+TEMP_CAL_PATH = os.path.join(SAVE_PATH, TEMP_CAL_FILE)
+PUMP_CAL_PATH = os.path.join(SAVE_PATH, PUMP_CAL_FILE)
+JSON_PARAMS_FILE = os.path.join(SAVE_PATH, JSON_PARAMS_NAME)
+
+# number of recent readings kept in memory per parameter and vial
+RING_BUFFER_SIZE = 128
+
+# series and control-state files rebuilt when resuming an experiment
+RESUME_SERIES = ['OD', 'temp']
+RESUME_STATE = ['ODset', 'pump_log', 'chemo_config', 'temp_config']
+# threads reading files in parallel when resuming
+RESUME_WORKERS = 8
+
+# layouts save_data writes series in, see binstore.py
+DATA_FORMATS = ['text', 'binary', 'both']
 
 logger = logging.getLogger('eVOLVER')
 
@@ -46,8 +79,83 @@ class EvolverNamespace(BaseNamespace):
     use_blank = False
     OD_initial = None
     experiment_params = None
+    # experiment_params compiled into per-vial arrays
+    vial_config = None
+    params_file = None
+    modes = None
+    # mode of each vial from the script's MODE_GROUPS, if any
+    vial_modes = None
+    # where the modes of the vials came from, logged when it changes
+    mode_source = None
     ip_address = None
+    # directory holding the script, calibrations and data directory
     exp_dir = SAVE_PATH
+    # custom script module and the data directory named by its EXP_NAME
+    script = custom_script
+    exp_name = EXP_NAME
+    data_dir = EXP_DIR
+    geometry = GEOMETRY
+    calibrations = None
+    buffers = None
+    writer = None
+    growth_rates = None
+    state = None
+    turbidostat = None
+    chemostat = None
+    checkpoint = None
+    commands = None
+    metrics = None
+    metrics_file = None
+    metrics_interval = 60
+    _metrics_written = None
+    profiler = None
+    recorder = None
+    io = None
+    # rotation and format of the log file, see logsetup.setup_logging
+    log_config = {}
+    data_format = 'text'
+
+    def initialize(self):
+        self.configure(self.exp_dir, self.script)
+
+    def configure(self, exp_dir, script):
+        """
+        Points this namespace at an experiment directory and custom script
+        module. Each eVOLVER unit driven from one process has its own.
+        """
+        self.exp_dir = exp_dir
+        self.script = script
+        self.exp_name = script.EXP_NAME
+        self.data_dir = os.path.join(exp_dir, self.exp_name)
+        self.geometry = DeviceGeometry.from_config(getattr(script, 'GEOMETRY',
+                                                           None))
+        self.calibrations = CalibrationStore(
+            {'od': os.path.join(exp_dir, OD_CAL_FILE),
+             'temperature': os.path.join(exp_dir, TEMP_CAL_FILE),
+             'pump': os.path.join(exp_dir, PUMP_CAL_FILE)})
+        # recent readings per parameter ('OD', 'temp', '<param>_raw')
+        self.buffers = {}
+        self.writer = DataWriter()
+        # latest ODset/pump_log/chemo_config/temp_config records
+        self.state = StateStore(self.data_dir, self.writer)
+        # turbidostat state of every vial as arrays, see turbidostat.py
+        self.turbidostat = TurbidostatEngine(self.geometry.n_vials)
+        # chemostat state and last formatted pump command, see chemostat.py
+        self.chemostat = ChemostatEngine(self.geometry)
+        # log(OD) fit of each vial's current growth curve
+        self.growth_rates = GrowthRateEstimator(self.geometry.n_vials)
+        self.checkpoint = Checkpoint(os.path.join(
+            self.data_dir, '{0}.checkpoint'.format(self.exp_name)))
+        # commands go out once per broadcast
+        self.commands = CommandBatcher(self._send_command)
+        # timings of the broadcast handling stages
+        self.metrics = StageTimer()
+        self.metrics.add_source('commands', self.commands.metrics)
+        # operation modes of the script, looked up once
+        self.modes = ModeRegistry(script)
+        self.vial_modes = script_modes(script, self.geometry.n_vials)
+        self.params_file = ParamsFile(os.path.join(exp_dir, JSON_PARAMS_NAME),
+                                      self.geometry)
 
     def on_connect(self, *args):
         print("Connected to eVOLVER as client")
@@ -61,25 +169,59 @@ class EvolverNamespace(BaseNamespace):
         print("Reconnected to eVOLVER as client")
         logger.info("reconnected to eVOLVER as client")
 
-    def on_broadcast(self, data):
+    def on_broadcast(self, data, received_at=None, control=True):
+        """
+        Saves a broadcast's data and runs the custom functions on it.
+        received_at is the time the broadcast arrived (defaults to now).
+        With control=False only the data is saved, e.g. for a stale
+        broadcast when newer ones are already waiting.
+        """
+        started = time.perf_counter()
+        if received_at is not None:
+            self.metrics.record('receive', max(time.time() - received_at, 0))
+        self._record(BROADCAST, data, received_at)
+        if self.profiler is not None:
+            self.profiler.start()
+        # collect the commands sent while handling it
+        self.commands.begin(data.get('config'))
+        try:
+            self._process_broadcast(data, received_at, control)
+        finally:
+            # sent once, even if handling the broadcast failed
+            with self.metrics.stage('commands'):
+                self.commands.flush()
+            total = time.perf_counter() - started
+            self.metrics.record('total', total)
+            if self.profiler is not None:
+                self.profiler.stop(total, time.strftime('%y%m%d_%H%M%S'))
+            self._export_metrics()
+
+    def _process_broadcast(self, data, received_at, control):
         logger.info('Broadcast received')
-        elapsed_time = round((time.time() - self.start_time) / 3600, 4)
-        logger.info('Elapsed time: %.4f hours' % elapsed_time)
-        print("{0}: {1} Hours".format(EXP_NAME, elapsed_time))
+        if received_at is None:
+            received_at = time.time()
+        elapsed_time = round((received_at - self.start_time) / 3600, 4)
+        logger.info('Elapsed time: %.4f hours', elapsed_time)
+        changed = self.params_file.poll()
+        if changed is not None:
+            self.set_params(*changed, elapsed_time=elapsed_time)
+        print("{0}: {1} Hours".format(self.exp_name, elapsed_time))
         # are the calibrations in yet?
-        if not self.check_for_calibrations():
+        with self.metrics.stage('calibrations'):
+            calibrated = self.check_for_calibrations()
+            if calibrated:
+                od_cal = self.calibrations.get('od')
+                temp_cal = self.calibrations.get('temperature')
+        if not calibrated:
             logger.warning('Calibration files still missing, skipping custom '
                            'functions')
             return
 
-        with open(OD_CAL_PATH) as f:
-            od_cal = json.load(f)
-        with open(TEMP_CAL_PATH) as f:
-            temp_cal = json.load(f)
-
         # apply calibrations
         # update temperatures if needed
-        data = self.transform_data(data, VIALS, od_cal, temp_cal)
+        with self.metrics.stage('transform'):
+            data = self.transform_data(data, self.geometry.vials, od_cal,
+                                       temp_cal)
         if data is None:
             logger.error('could not tranform raw data, skipping user-'
                          'defined functions')
@@ -90,62 +232,176 @@ class EvolverNamespace(BaseNamespace):
             logger.info('setting initial OD reading')
             self.OD_initial = data['transformed']['od']
         elif self.OD_initial is None:
-            self.OD_initial = np.zeros(len(VIALS))
+            self.OD_initial = self.geometry.zeros()
         data['transformed']['od'] = (data['transformed']['od'] -
                                         self.OD_initial)
         # save data
         try:
-            self.save_data(data['transformed']['od'], elapsed_time,
-                            VIALS, 'OD')
-            self.save_data(data['transformed']['temp'], elapsed_time,
-                            VIALS, 'temp')
-
-            for param in od_cal['params']:
-                self.save_data(data['data'].get(param, []), elapsed_time,
-                            VIALS, param + '_raw')
-            for param in temp_cal['params']:
-                self.save_data(data['data'].get(param, []), elapsed_time,
-                            VIALS, param + '_raw')
+            with self.metrics.stage('save_data'):
+                self.save_data(data['transformed']['od'], elapsed_time,
+                                self.geometry.vials, 'OD')
+                self.save_data(data['transformed']['temp'], elapsed_time,
+                                self.geometry.vials, 'temp')
+
+                for param in od_cal.params:
+                    self.save_data(data['data'].get(param, []), elapsed_time,
+                                self.geometry.vials, param + '_raw')
+                for param in temp_cal.params:
+                    self.save_data(data['data'].get(param, []), elapsed_time,
+                                self.geometry.vials, param + '_raw')
         except OSError:
             logger.info("Broadcast received before experiment initialization - skipping custom function...")
             return
+        self.growth_rates.add(elapsed_time, data['transformed']['od'])
 
-        # run custom functions
-        self.custom_functions(data, VIALS, elapsed_time)
+        if control:
+            # run custom functions
+            self.custom_functions(data, self.geometry.vials, elapsed_time)
+        else:
+            logger.info('newer broadcasts waiting, skipping custom functions')
+        # write out this broadcast's rows
+        with self.metrics.stage('flush'):
+            self.writer.flush()
         # save variables
-        self.save_variables(self.start_time, self.OD_initial)
+        with self.metrics.stage('save_variables'):
+            self.save_variables(self.start_time, self.OD_initial)
+
+        # log lines so far reach the file for db/gdrive syncing
+        logsetup.sync()
+        if logger.isEnabledFor(logging.DEBUG):
+            if self.io is not None:
+                logger.debug('I/O queue: %s', self.io.metrics())
+            logger.debug('commands: %s', self.commands.metrics())
+
+    def _record(self, event, data, received_at=None):
+        if self.recorder is None:
+            return
+        if received_at is None:
+            received_at = time.time()
+        self._run_io(self.recorder.write,
+                     self.recorder.encode(event, data, received_at))
 
-        # Restart logging for db/gdrive syncing
-        logging.shutdown()
-        logging.getLogger('eVOLVER')
+    def _export_metrics(self):
+        if self.metrics_file is None:
+            return
+        now = time.monotonic()
+        if (self._metrics_written is not None and
+                now - self._metrics_written < self.metrics_interval):
+            return
+        self._metrics_written = now
+        self._run_io(write_metrics, self.metrics_file,
+                     self.metrics.prometheus())
+
+    def apply_options(self, options):
+        """
+        Applies the data and I/O command line options (see
+        add_run_options).
+        """
+        self.data_format = options.data_format
+        self.writer.flush_interval = options.flush_interval
+        self.writer.fsync_interval = options.fsync_interval
+        if options.io_queue_size > 0:
+            self.start_io_thread(options.io_queue_size, options.io_policy)
+        if options.metrics_file is not None:
+            self.metrics_file = os.path.join(self.data_dir,
+                                             options.metrics_file)
+            self.metrics_interval = options.metrics_interval
+        if options.profile is not None:
+            self.profiler = BroadcastProfiler(
+                options.profile, os.path.join(self.data_dir, 'profiles'))
+        if options.record is not None:
+            self.recorder = BroadcastRecorder(options.record)
+        self.log_config = log_config(options)
+
+    def start_io_thread(self, maxsize=64, policy='block'):
+        """
+        Moves data file writes, variable saving and log syncing off the
+        broadcast handler onto a background thread.
+        """
+        self.io = IOThread(maxsize, policy)
+        self.writer.io = self.io
+        self.metrics.add_source('io', self.io.metrics)
+
+    def stop_io_thread(self):
+        """
+        Runs the writes still queued and stops the background thread, later
+        writes happen on the caller's thread again.
+        """
+        if self.io is None:
+            return
+        io, self.io = self.io, None
+        self.writer.io = None
+        io.close()
+
+    def _run_io(self, func, *args):
+        if self.io is not None:
+            self.io.submit(func, *args)
+        else:
+            func(*args)
 
     def on_activecalibrations(self, data):
         print('Calibrations recieved')
         logger.info('Calibrations recieved')
+        self._record(CALIBRATIONS, data)
         for calibration in data:
-            if calibration['calibrationType'] == 'od':
-                file_path = OD_CAL_PATH
-            elif calibration['calibrationType'] == 'temperature':
-                file_path = TEMP_CAL_PATH
-            elif calibration['calibrationType'] == 'pump':
-                file_path = PUMP_CAL_PATH
-            else:
+            calibration_type = calibration['calibrationType']
+            if calibration_type not in self.calibrations.paths:
                 continue
             for fit in calibration['fits']:
                 if fit['active']:
-                    with open(file_path, 'w') as f:
-                        json.dump(fit, f)
+                    self.calibrations.set(calibration_type, fit)
                     # Create raw data directories and files for params needed
                     for param in fit['params']:
-                        if not os.path.isdir(os.path.join(EXP_DIR, param + '_raw')) and param != 'pump':
-                            os.makedirs(os.path.join(EXP_DIR, param + '_raw'))
+                        if not os.path.isdir(os.path.join(self.data_dir, param + '_raw')) and param != 'pump':
+                            os.makedirs(os.path.join(self.data_dir, param + '_raw'))
                             for x in range(len(fit['coefficients'])):
-                                exp_str = "Experiment: {0} vial {1}, {2}".format(EXP_NAME,
+                                exp_str = "Experiment: {0} vial {1}, {2}".format(self.exp_name,
                                         x,
                                         time.strftime("%c"))
                                 self._create_file(x, param + '_raw', defaults=[exp_str])
                     break
 
+    def set_params(self, experiment_params, vial_config=None,
+                   elapsed_time=None):
+        """
+        Applies new experiment parameters (eVOLVER_parameters.json) to the
+        running experiment: the custom functions use them from the next
+        broadcast on, and changed stir rates and temperatures are sent.
+        """
+        if vial_config is None:
+            vial_config = VialConfig(experiment_params, self.geometry)
+        previous = self.vial_config
+        self.experiment_params = experiment_params
+        self.vial_config = vial_config
+        if previous is not None and previous.mode != vial_config.mode:
+            logger.info('operation mode changed from %s to %s',
+                        previous.mode, vial_config.mode)
+        if elapsed_time is None:
+            elapsed_time = round((time.time() - self.start_time) / 3600, 4)
+        if len(vial_config.changed(previous, 'stir')):
+            self.update_stir_rate([vial['stir'] for vial in
+                                   experiment_params['vial_configuration']])
+        # transform_data sends the temperatures that changed in temp_config
+        for x in vial_config.changed(previous, 'temp'):
+            self.state.append('temp_config', x, elapsed_time,
+                              vial_config['temp'][x])
+        logger.info('experiment parameters updated')
+
+    def reload_params(self):
+        """
+        Loads eVOLVER_parameters.json again, e.g. when the GUI has changed
+        it.
+        """
+        try:
+            params, vial_config = self.params_file.load()
+        except ValueError as e:
+            logger.error('could not reload %s: %s', self.params_file.path, e)
+            return
+        if params is None:
+            logger.warning('no %s to reload', self.params_file.path)
+            return
+        self.set_params(params, vial_config)
+
     def request_calibrations(self):
         logger.debug('requesting active calibrations')
         self.emit('getactivecal',
@@ -153,11 +409,11 @@ class EvolverNamespace(BaseNamespace):
 
     def transform_data(self, data, vials, od_cal, temp_cal):
         od_data_2 = None
-        if od_cal['type'] == THREE_DIMENSION:
-            od_data_2 = data['data'].get(od_cal['params'][1], None)
+        if od_cal.type == THREE_DIMENSION:
+            od_data_2 = data['data'].get(od_cal.params[1], None)
 
-        od_data = data['data'].get(od_cal['params'][0], None)
-        temp_data = data['data'].get(temp_cal['params'][0], None)
+        od_data = data['data'].get(od_cal.params[0], None)
+        temp_data = data['data'].get(temp_cal.params[0], None)
         set_temp_data = data['config'].get('temp', {}).get('value', None)
 
         if od_data is None or temp_data is None or set_temp_data is None:
@@ -169,80 +425,44 @@ class EvolverNamespace(BaseNamespace):
             logger.error('NaN received, error with measurements')
             return None
 
-        od_data = np.array([float(x) for x in od_data])
+        od_data = np.asarray(od_data, dtype=np.float64)
         if od_data_2:
-            od_data_2 = np.array([float(x) for x in od_data_2])
-        temp_data = np.array([float(x) for x in temp_data])
-        set_temp_data = np.array([float(x) for x in set_temp_data])
-
-        temps = []
-        for x in vials:
-            file_name =  "vial{0}_temp_config.txt".format(x)
-            file_path = os.path.join(EXP_DIR, 'temp_config', file_name)
-            temp_set_data = np.genfromtxt(file_path, delimiter=',')
-            temp_set = temp_set_data[len(temp_set_data)-1][1]
-            temps.append(temp_set)
-            od_coefficients = od_cal['coefficients'][x]
-            temp_coefficients = temp_cal['coefficients'][x]
-            try:
-                if od_cal['type'] == SIGMOID:
-                    #convert raw photodiode data into ODdata using calibration curve
-                    od_data[x] = np.real(od_coefficients[2] -
-                                        ((np.log10((od_coefficients[1] -
-                                                    od_coefficients[0]) /
-                                                    (float(od_data[x]) -
-                                                    od_coefficients[0])-1)) /
-                                                    od_coefficients[3]))
-                    if not np.isfinite(od_data[x]):
-                        od_data[x] = 'NaN'
-                        logger.debug('OD from vial %d: %s' % (x, od_data[x]))
-                    else:
-                        logger.debug('OD from vial %d: %.3f' % (x, od_data[x]))
-                elif od_cal['type'] == THREE_DIMENSION:
-                    od_data[x] = np.real(od_coefficients[0] +
-                                        (od_coefficients[1]*od_data[x]) +
-                                        (od_coefficients[2]*od_data_2[x]) +
-                                        (od_coefficients[3]*(od_data[x]**2)) +
-                                        (od_coefficients[4]*od_data[x]*od_data_2[x]) +
-                                        (od_coefficients[5]*(od_data_2[x]**2)))
-                else:
-                    logger.error('OD calibration not of supported type!')
-                    od_data[x] = 'NaN'
-            except ValueError:
-                print("OD Read Error")
-                logger.error('OD read error for vial %d, setting to NaN' % x)
-                od_data[x] = 'NaN'
-            try:
-                temp_data[x] = (float(temp_data[x]) *
-                                temp_coefficients[0]) + temp_coefficients[1]
-                logger.debug('temperature from vial %d: %.3f' % (x, temp_data[x]))
-            except ValueError:
-                print("Temp Read Error")
-                logger.error('temperature read error for vial %d, setting to NaN'
-                            % x)
-                temp_data[x]  = 'NaN'
-            try:
-                set_temp_data[x] = (float(set_temp_data[x]) *
-                                    temp_coefficients[0]) + temp_coefficients[1]
-                logger.debug('set_temperature from vial %d: %.3f' % (x,
-                                                                set_temp_data[x]))
-            except ValueError:
-                print("Set Temp Read Error")
-                logger.error('set temperature read error for vial %d, setting to NaN'
-                            % x)
-                set_temp_data[x]  = 'NaN'
+            od_data_2 = np.asarray(od_data_2, dtype=np.float64)
+        temp_data = np.asarray(temp_data, dtype=np.float64)
+        set_temp_data = np.asarray(set_temp_data, dtype=np.float64)
+
+        temps = [self.state.last('temp_config', x)[1] for x in vials]
+
+        # convert raw photodiode/thermistor data for all vials at once,
+        # vials that fail to convert come back as NaN
+        vials = np.asarray(vials)
+        od_data[vials] = od_cal.apply(od_data, od_data_2, vials)
+        temp_data[vials] = temp_cal.apply(temp_data, vials=vials)
+        set_temp_data[vials] = temp_cal.apply(set_temp_data, vials=vials)
+
+        bad_od = vials[np.isnan(od_data[vials])]
+        if bad_od.size:
+            logger.error('OD read error for vials %s, setting to NaN',
+                         bad_od.tolist())
+        bad_temp = vials[np.isnan(temp_data[vials])]
+        if bad_temp.size:
+            logger.error('temperature read error for vials %s, setting to NaN',
+                         bad_temp.tolist())
+        if logger.isEnabledFor(logging.DEBUG):
+            # the arrays change before a queued record is formatted
+            logger.debug('OD: %s', od_data.tolist())
+            logger.debug('temperature: %s', temp_data.tolist())
+            logger.debug('set temperature: %s', set_temp_data.tolist())
 
         temps = np.array(temps)
         # update temperatures only if difference with expected
         # value is above 0.2 degrees celsius
         delta_t = np.abs(set_temp_data - temps).max()
         if delta_t > 0.2:
-            logger.info('updating temperatures (max. deltaT is %.2f)' %
+            logger.info('updating temperatures (max. deltaT is %.2f)',
                         delta_t)
-            coefficients = temp_cal['coefficients']
-            raw_temperatures = [str(int((temps[x] - temp_cal['coefficients'][x][1]) /
-                                        temp_cal['coefficients'][x][0]))
-                                for x in vials]
+            raw_temperatures = [str(int(raw)) for raw in
+                                temp_cal.invert(temps, vials)]
             self.update_temperature(raw_temperatures)
         else:
             # config from server agrees with local config
@@ -250,9 +470,9 @@ class EvolverNamespace(BaseNamespace):
             delta_t = np.abs(temps - temp_data).max()
             if delta_t > 0.2:
                 logger.debug('actual temperature doesn\'t match configuration '
-                            '(yet? max deltaT is %.2f)' % delta_t)
-                logger.debug('temperature config: %s' % temps)
-                logger.debug('actual temperatures: %s' % temp_data)
+                            '(yet? max deltaT is %.2f)', delta_t)
+                logger.debug('temperature config: %s', temps)
+                logger.debug('actual temperatures: %s', temp_data)
 
         # add a new field in the data dictionary
         data['transformed'] = {}
@@ -263,56 +483,54 @@ class EvolverNamespace(BaseNamespace):
     def update_stir_rate(self, stir_rates, immediate = False):
         data = {'param': 'stir', 'value': stir_rates,
                 'immediate': immediate, 'recurring': True}
-        logger.debug('stir rate command: %s' % data)
-        self.emit('command', data, namespace = '/dpu-evolver')
+        logger.debug('stir rate command: %s', data)
+        self.commands.submit(data)
 
     def update_temperature(self, temperatures, immediate = False):
         data = {'param': 'temp', 'value': temperatures,
                 'immediate': immediate, 'recurring': True}
-        logger.debug('temperature command: %s' % data)
-        self.emit('command', data, namespace = '/dpu-evolver')
+        logger.debug('temperature command: %s', data)
+        self.commands.submit(data)
 
     def fluid_command(self, MESSAGE):
-        logger.debug('fluid command: %s' % MESSAGE)
+        logger.debug('fluid command: %s', MESSAGE)
         command = {'param': 'pump', 'value': MESSAGE,
                    'recurring': False ,'immediate': True}
-        self.emit('command', command, namespace='/dpu-evolver')
+        self.commands.submit(command)
 
     def update_chemo(self, data, vials, bolus_in_s, period_config, immediate = False):
         current_pump = data['config']['pump']['value']
 
-        MESSAGE = {'fields_expected_incoming': 49,
-                   'fields_expected_outgoing': 49,
+        geometry = self.geometry
+        # formats only the vials whose bolus or period changed
+        values = self.chemostat.pump_values(vials, bolus_in_s, period_config)
+        # only these vials' slots, other vials may run in other modes
+        slots = self.chemostat.slots(vials)
+        current = np.asarray(current_pump, dtype=object)[slots]
+        if not (values[slots] != current).any():
+            return
+
+        MESSAGE = {'fields_expected_incoming': geometry.message_size + 1,
+                   'fields_expected_outgoing': geometry.message_size + 1,
                    'recurring': True,
                    'immediate': immediate,
-                   'value': ['--'] * 48,
+                   'value': geometry.message(),
                    'param': 'pump'}
-
-        for x in vials:
-            # stop pumps if period is zero
-            if period_config[x] == 0:
-                # influx
-                MESSAGE['value'][x] = '0|0'
-                # efflux
-                MESSAGE['value'][x + 16] = '0|0'
-            else:
-                # influx
-                MESSAGE['value'][x] = '%.2f|%d' % (bolus_in_s[x], period_config[x])
-                # efflux
-                MESSAGE['value'][x + 16] = '%.2f|%d' % (bolus_in_s[x] * 2,
-                                                        period_config[x])
-
-        if MESSAGE['value'] != current_pump:
-            logger.info('updating chemostat: %s' % MESSAGE)
-            self.emit('command', MESSAGE, namespace = '/dpu-evolver')
+        for slot in slots:
+            MESSAGE['value'][slot] = values[slot]
+        logger.info('updating chemostat: %s', MESSAGE)
+        self.commands.submit(MESSAGE)
 
     def stop_all_pumps(self, ):
         data = {'param': 'pump',
-                'value': ['0'] * 48,
+                'value': self.geometry.message('0'),
                 'recurring': False,
                 'immediate': True}
         logger.info('stopping all pumps')
-        self.emit('command', data, namespace = '/dpu-evolver')
+        self.commands.send_now(data)
+
+    def _send_command(self, command):
+        self.emit('command', command, namespace = '/dpu-evolver')
 
     def _create_file(self, vial, param, directory=None, defaults=None):
         if defaults is None:
@@ -320,7 +538,8 @@ class EvolverNamespace(BaseNamespace):
         if directory is None:
             directory = param
         file_name =  "vial{0}_{1}.txt".format(vial, param)
-        file_path = os.path.join(EXP_DIR, directory, file_name)
+        file_path = os.path.join(self.data_dir, directory, file_name)
+        self.state.invalidate(param, vial)
         text_file = open(file_path, "w")
         for default in defaults:
             text_file.write(default + '\n')
@@ -329,10 +548,14 @@ class EvolverNamespace(BaseNamespace):
     def initialize_exp(self, vials, experiment_params, log_name, quiet, verbose, ip_address, always_yes = False):
         self.ip_address = ip_address
         self.experiment_params = experiment_params
+        if experiment_params is not None:
+            self.vial_config = VialConfig(experiment_params, self.geometry)
+        # later changes to the file are applied as they happen
+        self.params_file.watch()
         logger.info('initializing experiment')
 
-        if os.path.exists(EXP_DIR):
-            setup_logging(log_name, quiet, verbose)
+        if os.path.exists(self.data_dir):
+            setup_logging(log_name, quiet, verbose, **self.log_config)
             logger.info('found an existing experiment')
             exp_continue = None
             if always_yes:
@@ -344,7 +567,7 @@ class EvolverNamespace(BaseNamespace):
             exp_continue = 'n'
 
         if exp_continue == 'n':
-            if os.path.exists(EXP_DIR):
+            if os.path.exists(self.data_dir):
                 exp_overwrite = None
                 if always_yes:
                     exp_overwrite = 'y'
@@ -355,7 +578,7 @@ class EvolverNamespace(BaseNamespace):
                 logger.info('data directory already exists')
                 if exp_overwrite == 'y':
                     logger.info('deleting existing data directory')
-                    shutil.rmtree(EXP_DIR)
+                    shutil.rmtree(self.data_dir)
                 else:
                     print('Change experiment name in custom_script.py '
                         'and then restart...')
@@ -367,16 +590,16 @@ class EvolverNamespace(BaseNamespace):
             self.request_calibrations()
 
             logger.debug('creating data directories')
-            os.makedirs(os.path.join(EXP_DIR, 'OD'))
-            os.makedirs(os.path.join(EXP_DIR, 'temp'))
-            os.makedirs(os.path.join(EXP_DIR, 'temp_config'))
-            os.makedirs(os.path.join(EXP_DIR, 'pump_log'))
-            os.makedirs(os.path.join(EXP_DIR, 'ODset'))
-            os.makedirs(os.path.join(EXP_DIR, 'growthrate'))
-            os.makedirs(os.path.join(EXP_DIR, 'chemo_config'))
-            setup_logging(log_name, quiet, verbose)
+            os.makedirs(os.path.join(self.data_dir, 'OD'))
+            os.makedirs(os.path.join(self.data_dir, 'temp'))
+            os.makedirs(os.path.join(self.data_dir, 'temp_config'))
+            os.makedirs(os.path.join(self.data_dir, 'pump_log'))
+            os.makedirs(os.path.join(self.data_dir, 'ODset'))
+            os.makedirs(os.path.join(self.data_dir, 'growthrate'))
+            os.makedirs(os.path.join(self.data_dir, 'chemo_config'))
+            setup_logging(log_name, quiet, verbose, **self.log_config)
             for x in vials:
-                exp_str = "Experiment: {0} vial {1}, {2}".format(EXP_NAME,
+                exp_str = "Experiment: {0} vial {1}, {2}".format(self.exp_name,
                                                                  x,
                                                            time.strftime("%c"))
                 # make OD file
@@ -386,7 +609,7 @@ class EvolverNamespace(BaseNamespace):
                 # make temperature configuration file
                 self._create_file(x, 'temp_config',
                                   defaults=[exp_str,
-                                            "0,{0}".format(TEMP_INITIAL[x])])
+                                            "0,{0}".format(self.script.TEMP_INITIAL[x])])
                 # make pump log file
                 self._create_file(x, 'pump_log',
                                   defaults=[exp_str,
@@ -406,12 +629,10 @@ class EvolverNamespace(BaseNamespace):
                                             "0,0,0"],
                                   directory='chemo_config')
 
-            stir_rate = STIR_INITIAL
-            temp_values = TEMP_INITIAL
+            stir_rate = self.script.STIR_INITIAL
 
             if self.experiment_params:
                 stir_rate = list(map(lambda x: x['stir'], self.experiment_params['vial_configuration']))
-                temp_values = list(map(lambda x: x['temp'], self.experiment_params['vial_configuration']))
             self.update_stir_rate(stir_rate)
 
             if always_yes:
@@ -427,28 +648,22 @@ class EvolverNamespace(BaseNamespace):
                 self.OD_initial = np.zeros(len(vials))
         else:
             # load existing experiment
-            pickle_name =  "{0}.pickle".format(EXP_NAME)
-            pickle_path = os.path.join(EXP_DIR, pickle_name)
-            logger.info('loading previous experiment data: %s' % pickle_path)
-            with open(pickle_path, 'rb') as f:
-                loaded_var  = pickle.load(f)
-            x = loaded_var
-            start_time = x[0]
-            self.OD_initial = x[1]
+            start_time = self.load_variables()
+            self.resume()
 
         # copy current custom script to txt file
-        backup_filename = '{0}_{1}.txt'.format(EXP_NAME,
+        backup_filename = '{0}_{1}.txt'.format(self.exp_name,
                                             time.strftime('%y%m%d_%H%M'))
-        shutil.copy(os.path.join(SAVE_PATH, 'custom_script.py'), os.path.join(EXP_DIR,
+        shutil.copy(self.script.__file__, os.path.join(self.data_dir,
                                                     backup_filename))
-        logger.info('saved a copy of current custom_script.py as %s' %
-                    backup_filename)
+        logger.info('saved a copy of current %s as %s',
+                    os.path.basename(self.script.__file__), backup_filename)
 
         return start_time
 
     def check_for_calibrations(self):
         result = True
-        if not os.path.exists(OD_CAL_PATH) or not os.path.exists(TEMP_CAL_PATH) or not os.path.exists(PUMP_CAL_PATH):
+        if not self.calibrations.has_all():
             # log and request again
             logger.warning('Calibrations not received yet, requesting again')
             self.request_calibrations()
@@ -458,33 +673,253 @@ class EvolverNamespace(BaseNamespace):
     def save_data(self, data, elapsed_time, vials, parameter):
         if len(data) == 0:
             return
+        # fetch (and warm up) the buffer before this reading hits the file
+        buffer = self._get_buffer(parameter, len(data))
         for x in vials:
             file_name =  "vial{0}_{1}.txt".format(x, parameter)
-            file_path = os.path.join(EXP_DIR, parameter, file_name)
-            text_file = open(file_path, "a+")
-            text_file.write("{0},{1}\n".format(elapsed_time, data[x]))
-            text_file.close()
+            file_path = os.path.join(self.data_dir, parameter, file_name)
+            if self.data_format != 'binary':
+                self.writer.write(file_path,
+                                  "{0},{1}\n".format(elapsed_time, data[x]))
+            if self.data_format != 'text':
+                self.writer.write_record(binstore.binary_path(file_path),
+                                         elapsed_time, float(data[x]))
+        buffer.append(elapsed_time, np.asarray(data, dtype=np.float64))
+
+    def _get_buffer(self, parameter, n_vials):
+        buffer = self.buffers.get(parameter)
+        if buffer is None:
+            # first use (or restart), warm up from the data files
+            buffer = VialRingBuffer(n_vials, RING_BUFFER_SIZE)
+            for x in range(n_vials):
+                self._warm_buffer(buffer, parameter, x)
+            self.buffers[parameter] = buffer
+        return buffer
+
+    def _warm_buffer(self, buffer, parameter, vial):
+        file_name = "vial{0}_{1}.txt".format(vial, parameter)
+        file_path = os.path.join(self.data_dir, parameter, file_name)
+        bin_path = binstore.binary_path(file_path)
+        if self.data_format != 'text' and os.path.exists(bin_path):
+            buffer.extend_vial(vial, binstore.load_tail(bin_path,
+                                                        RING_BUFFER_SIZE))
+        elif os.path.exists(file_path):
+            buffer.extend_vial(vial, read_tail(file_path, RING_BUFFER_SIZE))
+
+    def resume(self, workers=RESUME_WORKERS):
+        """
+        Rebuilds the runtime state of a resumed experiment from the ends of
+        its files, reading them in parallel: the recent OD and temperature
+        readings, the control-state records not restored from the
+        checkpoint and the fit of each vial's current growth curve. Only
+        the tail of each file is read, so this doesn't slow down as the
+        experiment gets longer. Returns how long it took.
+        """
+        start = time.perf_counter()
+        vials = self.geometry.vials
+        with ThreadPoolExecutor(workers) as executor:
+            jobs = []
+            for parameter in RESUME_STATE:
+                for x in vials:
+                    jobs.append(executor.submit(self.state.last, parameter,
+                                                x))
+            for parameter in RESUME_SERIES:
+                buffer = VialRingBuffer(len(vials), RING_BUFFER_SIZE)
+                self.buffers[parameter] = buffer
+                for x in vials:
+                    jobs.append(executor.submit(self._warm_buffer, buffer,
+                                                parameter, x))
+            self._wait_for(jobs)
+            # needs the ODset records
+            self._wait_for([executor.submit(self._resume_growth_rate, x)
+                            for x in vials])
+        elapsed = time.perf_counter() - start
+        print('Resumed experiment in %.3f s' % elapsed)
+        logger.info('resumed experiment in %.3f s', elapsed)
+        return elapsed
+
+    def _wait_for(self, jobs):
+        for job in jobs:
+            try:
+                job.result()
+            except OSError as e:
+                # e.g. a file from an older version of the template, it
+                # is read again on first use
+                logger.warning('could not resume from %s', e)
+
+    def _resume_growth_rate(self, vial):
+        record = self.state.last('ODset', vial)
+        if len(record) < 2:
+            return
+        gr_start, od_set = record[:2]
+        if not od_set > 0 or self.growth_rates.tracks(vial, gr_start):
+            # no growth curve yet, or restored from the checkpoint
+            return
+        data = self._read_since('OD', vial, gr_start)
+        self.growth_rates.reset(vial, gr_start)
+        self.growth_rates.extend(vial, data[:, 0], data[:, 1])
+
+    def _read_since(self, parameter, vial, start_time):
+        """
+        Returns the (time, value) readings of a parameter for a vial taken
+        after start_time, as an (n, 2) array.
+        """
+        file_name = "vial{0}_{1}.txt".format(vial, parameter)
+        file_path = os.path.join(self.data_dir, parameter, file_name)
+        bin_path = binstore.binary_path(file_path)
+        if self.data_format != 'text' and os.path.exists(bin_path):
+            records = binstore.load(bin_path)
+            first = np.searchsorted(records[:, 0], start_time, side='right')
+            return np.array(records[first:])
+        rows = read_since(file_path, start_time)
+        return np.asarray(rows, dtype=np.float64).reshape(-1, 2)
+
+    def recent_data(self, parameter, vial, window=10):
+        """
+        Returns the last 'window' (time, value) readings of a parameter for
+        a vial from memory, same format as tail_to_np. Falls back to reading
+        the data file if the window is larger than the in-memory history.
+        """
+        buffer = self.buffers.get(parameter)
+        if buffer is not None and window <= buffer.size:
+            return buffer.window(vial, window)
+        file_name = "vial{0}_{1}.txt".format(vial, parameter)
+        file_path = os.path.join(self.data_dir, parameter, file_name)
+        if self.data_format == 'text':
+            return self.tail_to_np(file_path, window)
+        bin_path = binstore.binary_path(file_path)
+        self.writer.flush_file(bin_path)
+        data = binstore.load_tail(bin_path, window)
+        if len(data) < window:
+            return np.asarray([])
+        return data
+
+    def recent_values(self, parameter, vials, window=10):
+        """
+        The last 'window' values of a parameter for several vials as a
+        (len(vials), window) array, and a mask of the vials that have that
+        many (see recent_data).
+        """
+        buffer = self.buffers.get(parameter)
+        if buffer is not None and window <= buffer.size:
+            return buffer.windows(vials, window)
+        values = np.empty((len(vials), window))
+        enough = np.zeros(len(vials), dtype=bool)
+        for i, x in enumerate(vials):
+            data = self.recent_data(parameter, x, window)
+            if len(data):
+                values[i] = data[:, 1]
+                enough[i] = True
+        return values, enough
+
+    def rolling_median(self, parameter, vials, window=10, skipna=False,
+                       n_sigmas=None):
+        """
+        The median of the last 'window' values of a parameter for several
+        vials, and a mask of the vials that have that many (see
+        recent_data). NaN if a vial's window holds a NaN, unless skipna.
+        With n_sigmas, outliers are left out (see VialRingBuffer.median).
+        """
+        buffer = self.buffers.get(parameter)
+        if buffer is not None and window <= buffer.size:
+            return buffer.median(vials, window, skipna, n_sigmas)
+        values, enough = self.recent_values(parameter, vials, window)
+        if n_sigmas is not None:
+            # outliers within the window only
+            for i in np.flatnonzero(enough):
+                values[i] = hampel(values[i], window, n_sigmas)
+        medians = np.full(len(vials), np.nan)
+        if enough.any():
+            median = np.nanmedian if skipna else np.median
+            medians[enough] = median(values[enough], axis=1)
+        return medians, enough
+
+    def load_series(self, parameter, vial):
+        """
+        Returns the full (time, value) history of a parameter for a vial,
+        from the binary series if the experiment writes one.
+        """
+        file_name = "vial{0}_{1}.txt".format(vial, parameter)
+        file_path = os.path.join(self.data_dir, parameter, file_name)
+        if self.data_format == 'text':
+            self.writer.flush_file(file_path)
+            return np.genfromtxt(file_path, delimiter=',')
+        bin_path = binstore.binary_path(file_path)
+        self.writer.flush_file(bin_path)
+        return binstore.load(bin_path)
 
     def save_variables(self, start_time, OD_initial):
-        # save variables needed for restarting experiment later
-        save_path = os.path.dirname(os.path.realpath(__file__))
-        pickle_name = "{0}.pickle".format(EXP_NAME)
-        pickle_path = os.path.join(EXP_DIR, pickle_name)
-        logger.debug('saving all variables: %s' % pickle_path)
-        with open(pickle_path, 'wb') as f:
-            pickle.dump([start_time, OD_initial], f)
+        """
+        Checkpoints what is needed to resume the experiment: start time, OD
+        blank, the latest control-state records (ODset, pump_log, ...) and
+        the growth rate fits.
+        """
+        if OD_initial is not None:
+            OD_initial = np.asarray(OD_initial, dtype=np.float64).tolist()
+        state = {'start_time': start_time,
+                 'OD_initial': OD_initial,
+                 'records': self.state.snapshot(),
+                 'growth_rates': self.growth_rates.snapshot()}
+        # queued behind this broadcast's rows, see StateStore.add_sizes
+        self._run_io(self._write_variables, state)
+
+    def _write_variables(self, state):
+        self.state.add_sizes(state['records'])
+        if self.checkpoint.save(state):
+            logger.debug('saved checkpoint %s', self.checkpoint.path)
+
+    def load_variables(self):
+        """
+        Restores the state saved by save_variables and returns the start
+        time. Experiments started before checkpoints existed are resumed
+        from their pickle.
+        """
+        state = self.checkpoint.load()
+        if state is None:
+            pickle_name =  "{0}.pickle".format(self.exp_name)
+            pickle_path = os.path.join(self.data_dir, pickle_name)
+            if not os.path.exists(pickle_path):
+                print('No usable checkpoint ({0}) to resume the experiment '
+                      'from, start a new experiment instead'.format(
+                          self.checkpoint.path))
+                logger.error('no checkpoint %s or pickle %s, cannot resume',
+                             self.checkpoint.path, pickle_path)
+                sys.exit(1)
+            logger.info('loading previous experiment data: %s', pickle_path)
+            with open(pickle_path, 'rb') as f:
+                loaded_var  = pickle.load(f)
+            self.OD_initial = loaded_var[1]
+            return loaded_var[0]
+        logger.info('loading checkpoint %s', self.checkpoint.path)
+        if state['OD_initial'] is not None:
+            self.OD_initial = np.asarray(state['OD_initial'])
+        restored = self.state.restore(state['records'])
+        self.growth_rates.restore(state['growth_rates'])
+        logger.info('restored %d control-state records from the checkpoint',
+                    restored)
+        return state['start_time']
 
     def get_flow_rate(self):
-        pump_cal = None
-        with open(PUMP_CAL_PATH) as f:
-            pump_cal = json.load(f)
-        return pump_cal['coefficients']
+        return self.calibrations.flow_rate()
 
     def calc_growth_rate(self, vial, gr_start, elapsed_time):
-        ODfile_name =  "vial{0}_OD.txt".format(vial)
+        if self.growth_rates.tracks(vial, gr_start):
+            # running fit since the start of the growth curve
+            slope, intercept, r_value, std_err = self.growth_rates.result(vial)
+            logger.debug('growth rate for vial %s: %.2f', vial, slope)
+        else:
+            # curve started before the estimator was reset (e.g. before a
+            # restart), fit it from the data file
+            slope = self._fit_growth_rate(vial, gr_start)
+
+        # Save slope to file
+        file_name =  "vial{0}_gr.txt".format(vial)
+        gr_path = os.path.join(self.data_dir, 'growthrate', file_name)
+        self.writer.write(gr_path, "{0},{1}\n".format(elapsed_time, slope))
+
+    def _fit_growth_rate(self, vial, gr_start):
         # Grab Data and make setpoint
-        OD_path = os.path.join(EXP_DIR, 'OD', ODfile_name)
-        OD_data = np.genfromtxt(OD_path, delimiter=',')
+        OD_data = self.load_series('OD', vial)
         raw_time = OD_data[:, 0]
         raw_OD = OD_data[:, 1]
         raw_time = raw_time[np.isfinite(raw_OD)]
@@ -499,20 +934,15 @@ class EvolverNamespace(BaseNamespace):
         slope, intercept, r_value, p_value, std_err = stats.linregress(
             trim_time[np.isfinite(log_OD)],
             log_OD[np.isfinite(log_OD)])
-        logger.debug('growth rate for vial %s: %.2f' % (vial, slope))
-
-        # Save slope to file
-        file_name =  "vial{0}_gr.txt".format(vial)
-        gr_path = os.path.join(EXP_DIR, 'growthrate', file_name)
-        text_file = open(gr_path, "a+")
-        text_file.write("{0},{1}\n".format(elapsed_time, slope))
-        text_file.close()
+        logger.debug('growth rate for vial %s: %.2f', vial, slope)
+        return slope
 
     def tail_to_np(self, path, window=10, BUFFER_SIZE=512):
         """
         Reads file from the end and returns a numpy array with the data of the last 'window' lines.
         Alternative to np.genfromtxt(path) by loading only the needed lines instead of the whole file.
         """
+        self.writer.flush_file(path)
         f = open(path, 'rb')
         if window == 0:
             return []
@@ -559,59 +989,143 @@ class EvolverNamespace(BaseNamespace):
 
     def custom_functions(self, data, vials, elapsed_time):
         # load user script from custom_script.py
-        mode = self.experiment_params['function'] if self.experiment_params else OPERATION_MODE
-        if mode == 'turbidostat':
-            custom_script.turbidostat(self, data, vials, elapsed_time)
-        elif mode == 'chemostat':
-            custom_script.chemostat(self, data, vials, elapsed_time)
-        elif mode == 'growthcurve':
-            custom_script.growth_curve(self, data, vials, elapsed_time)
-        else:
-            # try to load the user function
-            # if failing report to user
-            logger.info('user-defined operation mode %s' % mode)
-            try:
-                func = getattr(custom_script, mode)
-                func(self, data, vials, elapsed_time)
-            except AttributeError:
-                logger.error('could not find function %s in custom_script.py' %
-                            mode)
-                print('Could not find function %s in custom_script.py '
-                    '- Skipping user defined functions'%
-                    mode)
+        # each group of vials runs in its own mode, their commands go out
+        # together once all have run (see CommandBatcher)
+        for mode, group in self.mode_groups(vials):
+            # missing modes are reported once by the registry
+            func = self.modes.get(mode)
+            if func is None:
+                continue
+            with self.metrics.stage('custom_functions:%s' % mode):
+                func(self, data, group, elapsed_time)
+
+    def mode_groups(self, vials):
+        """
+        Splits vials into (mode, vials) groups: vials in MODE_GROUPS of the
+        custom script run in that mode, the others by their "function" in
+        eVOLVER_parameters.json. Vials without one run in the experiment's
+        mode.
+        """
+        sources = []
+        if self.vial_modes is not None:
+            sources.append('MODE_GROUPS of the custom script')
+        if self.vial_config is not None:
+            sources.append(os.path.basename(self.params_file.path))
+        source = ', then '.join(sources) or 'OPERATION_MODE'
+        if source != self.mode_source:
+            self.mode_source = source
+            logger.info('operation modes of the vials from %s', source)
+        if self.vial_config is not None:
+            return self.vial_config.groups(vials, self.script.OPERATION_MODE,
+                                           self.vial_modes)
+        return group_vials(vials, self.vial_modes, self.script.OPERATION_MODE)
 
     def stop_exp(self):
         self.stop_all_pumps()
-
-def setup_logging(filename, quiet, verbose):
-    if quiet:
-        logging.basicConfig(level=logging.CRITICAL + 10)
-    else:
-        if verbose == 0:
-            level = logging.INFO
-        elif verbose >= 1:
-            level = logging.DEBUG
-        logging.basicConfig(format='%(asctime)s - %(name)s - [%(levelname)s] '
-                            '- %(message)s',
-                            datefmt='%Y-%m-%d %H:%M:%S',
-                            filename=filename,
-                            level=level)
+        if self.recorder is not None:
+            self._run_io(self.recorder.flush)
+        # also waits for queued background writes
+        self.writer.close()
+
+def setup_logging(filename, quiet, verbose, **log_config):
+    # records are written by a background thread, see logsetup.py
+    logsetup.setup_logging(filename, quiet, verbose, **log_config)
+
+def log_config(options):
+    """
+    The log file options (see add_run_options) as arguments for
+    setup_logging.
+    """
+    return {'log_format': options.log_format,
+            'max_bytes': options.log_max_bytes,
+            'backups': options.log_backups,
+            'when': options.log_rotate}
 
 def get_options():
     description = 'Run an eVOLVER experiment from the command line'
     parser = argparse.ArgumentParser(description=description)
 
+    parser.add_argument('-l', '--log-name',
+                        default=os.path.join(EXP_DIR, 'evolver.log'),
+                        help='Log file name directory (default: %(default)s)')
+    parser.add_argument('-i', '--ip-address', action='store', dest='ip_address',
+                        help='IP address of eVOLVER to run experiment on.')
+    add_run_options(parser)
+    return parser.parse_args(), parser
+
+def add_run_options(parser):
+    """
+    Adds the options shared by eVOLVER.py and supervisor.py.
+    """
     parser.add_argument('-y', '--always-yes', action='store_true',
                         default=False,
                         help='Answer yes to all questions '
                              '(i.e. continues from existing experiment, '
                              'overwrites existing data and blanks OD '
                              'measurements)')
-    parser.add_argument('-l', '--log-name',
-                        default=os.path.join(EXP_DIR, 'evolver.log'),
-                        help='Log file name directory (default: %(default)s)')
-    parser.add_argument('-i', '--ip-address', action='store', dest='ip_address',
-                        help='IP address of eVOLVER to run experiment on.')
+
+    parser.add_argument('--data-format', choices=DATA_FORMATS,
+                        default='text',
+                        help='Layout to save OD, temperature and raw data in. '
+                             'Binary series can be converted back with '
+                             'binstore.py (default: %(default)s)')
+    parser.add_argument('--flush-interval', type=float, default=0,
+                        help='Minimum seconds between writes of buffered '
+                             'data rows to disk, 0 writes after every '
+                             'broadcast (default: %(default)s)')
+    parser.add_argument('--fsync-interval', type=float, default=None,
+                        help='Minimum seconds between fsyncs of the data '
+                             'files, 0 fsyncs on every write (default: '
+                             'leave it to the OS)')
+
+    parser.add_argument('--io-queue-size', type=int, default=64,
+                        help='Maximum number of pending background writes, '
+                             '0 writes synchronously (default: %(default)s)')
+    parser.add_argument('--io-policy', choices=POLICIES, default='block',
+                        help='What to do when the background write queue is '
+                             'full: wait for room or drop the write and '
+                             'count it (default: %(default)s)')
+    parser.add_argument('--backlog-policy', choices=BACKLOG_POLICIES,
+                        default='coalesce',
+                        help='What to do with a broadcast when newer ones '
+                             'are already waiting: run the custom functions '
+                             'on all of them, or only save its data '
+                             '(default: %(default)s)')
+
+    parser.add_argument('--metrics-file', default=None,
+                        help='Write broadcast stage timings and queue '
+                             'metrics to this file in the data directory, '
+                             'in the Prometheus text format')
+    parser.add_argument('--metrics-interval', type=float, default=60,
+                        help='Minimum seconds between metrics file writes '
+                             '(default: %(default)s)')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve the metrics over HTTP on this port, at '
+                             '/metrics')
+    parser.add_argument('--profile', type=float, default=None,
+                        metavar='SECONDS',
+                        help='Profile broadcasts with cProfile and keep the '
+                             'profiles of those slower than SECONDS in the '
+                             'profiles directory of the data directory')
+
+    parser.add_argument('--record', default=None, metavar='FILE',
+                        help='Append the raw broadcasts and calibrations '
+                             'received to FILE (gzipped JSON lines), to '
+                             'replay them with replay.py')
+
+    parser.add_argument('--log-format', choices=logsetup.LOG_FORMATS,
+                        default='text',
+                        help='Write the log as text or as JSON lines '
+                             '(default: %(default)s)')
+    parser.add_argument('--log-max-bytes', type=int, default=0,
+                        help='Rotate the log file when it grows past this '
+                             'size, 0 never rotates (default: %(default)s)')
+    parser.add_argument('--log-rotate', default=None, metavar='WHEN',
+                        help='Rotate the log file at this interval instead, '
+                             'e.g. midnight or H (see TimedRotatingFileHandler)')
+    parser.add_argument('--log-backups', type=int, default=5,
+                        help='Rotated log files to keep (default: '
+                             '%(default)s)')
 
     log_nolog = parser.add_mutually_exclusive_group()
     log_nolog.add_argument('-v', '--verbose', action='count',
@@ -621,7 +1135,6 @@ def get_options():
     log_nolog.add_argument('-q', '--quiet', action='store_true',
                            default=False,
                            help='Disable logging to file entirely')
-    return parser.parse_args(), parser
 
 if __name__ == '__main__':
     options, parser = get_options()
@@ -642,11 +1155,12 @@ if __name__ == '__main__':
 
     socketIO = SocketIO(evolver_ip, EVOLVER_PORT)
     EVOLVER_NS = socketIO.define(EvolverNamespace, '/dpu-evolver')
+    EVOLVER_NS.apply_options(options)
 
     # start by stopping any existing chemostat
     EVOLVER_NS.stop_all_pumps()
     #
-    EVOLVER_NS.start_time = EVOLVER_NS.initialize_exp(VIALS,
+    EVOLVER_NS.start_time = EVOLVER_NS.initialize_exp(EVOLVER_NS.geometry.vials,
                                                       experiment_params,
                                                       options.log_name,
                                                       options.quiet,
@@ -655,62 +1169,32 @@ if __name__ == '__main__':
                                                       options.always_yes
                                                       )
 
-    # Using a non-blocking stream reader to be able to listen
-    # for commands from the electron app. 
-    nbsr = NBSR(sys.stdin)
-    paused = False
-
-    # logging setup
+    # broadcasts and commands from the electron app (on stdin) are
+    # handled as they arrive by an asyncio event loop
+    client = AsyncEvolverClient(socketIO, EVOLVER_NS,
+                                backlog_policy=options.backlog_policy)
+    EVOLVER_NS.metrics.add_source('broadcasts', client.metrics)
+    if options.metrics_port is not None:
+        MetricsServer(options.metrics_port, EVOLVER_NS.metrics.prometheus)
 
-    reset_connection_timer = time.time()
-    while True:        
+    while True:
         try:
-            # infinite loop
-
-            # check if a message has come in from the DPU
-            message = nbsr.readline()
-            if 'stop-script' in message:
-                logger.info('Stop message received - halting all pumps');
-                EVOLVER_NS.stop_exp()
-                socketIO.disconnect()
-            if 'pause-script' in message:
-                print('Pausing experiment', flush = True)
-                logger.info('Pausing experiment in dpu')
-                paused = True
-                EVOLVER_NS.stop_exp()
-                socketIO.disconnect()
-                
-            if 'continue-script' in message:
-                print('Restarting experiment', flush = True)
-                logger.info('Restarting experiment')
-                paused = False
-                socketIO.connect()
-
-            if not paused:
-                    socketIO.wait(seconds=0.1)
-                    if time.time() - reset_connection_timer > 3600 and not paused:
-                        # reset connection to avoid buildup of broadcast
-                        # messages (unlikely but could happen for very long
-                        # experiments with slow dpu code/computer)
-                        logger.info('resetting connection to eVOLVER to avoid '
-                                    'potential buildup of broadcast messages')
-                        socketIO.disconnect()
-                        socketIO.connect()
-                        reset_connection_timer = time.time()
+            # runs until Ctrl-C or an error
+            asyncio.run(client.run())
         except KeyboardInterrupt:
             try:
                 print('Ctrl-C detected, pausing experiment')
                 logger.warning('interrupt received, pausing experiment')
                 EVOLVER_NS.stop_exp()
                 # stop receiving broadcasts
-                socketIO.disconnect()
+                client.disconnect()
                 while True:
                     key = input('Experiment paused. Press enter key to restart '
                                 ' or hit Ctrl-C again to terminate experiment')
                     logger.warning('resuming experiment')
                     # no need to have something like "restart_chemo" here
                     # with the new server logic
-                    socketIO.connect()
+                    client.connect()
                     break
             except KeyboardInterrupt:
                 print('Second Ctrl-C detected, shutting down')
@@ -721,7 +1205,7 @@ if __name__ == '__main__':
                 logger.warning('experiment stopped, goodbye!')
                 break
         except Exception as e:
-            logger.critical('exception %s stopped the experiment' % str(e))
+            logger.critical('exception %s stopped the experiment', e)
             print('error "%s" stopped the experiment' % str(e))
             traceback.print_exc(file=sys.stdout)
             EVOLVER_NS.stop_exp()
@@ -731,5 +1215,7 @@ if __name__ == '__main__':
 
     # stop experiment one last time
     # covers corner case where user presses Ctrl-C twice quickly
-    socketIO.connect()
+    client.connect()
     EVOLVER_NS.stop_exp()
+    EVOLVER_NS.stop_io_thread()
+    logsetup.stop()
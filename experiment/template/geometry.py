@@ -0,0 +1,82 @@
+import numpy as np
+
+# pump channels of the standard box: first influx, efflux, second influx
+INFLUX = 'in1'
+EFFLUX = 'efflux'
+INFLUX_2 = 'in2'
+PUMP_CHANNELS = [INFLUX, EFFLUX, INFLUX_2]
+
+class DeviceGeometry:
+    """
+    Layout of an eVOLVER box: how many vials it has and which pump
+    channels each vial has.
+
+    Pump commands are one flat list with a slot per vial and channel,
+    grouped by channel: on the standard 16-vial box slots 0-15 are the
+    first influx pumps, 16-31 the efflux pumps and 32-47 the second influx
+    pumps. Larger boxes or several sleeves only change n_vials.
+    """
+
+    def __init__(self, n_vials=16, pump_channels=PUMP_CHANNELS):
+        if n_vials < 1:
+            raise ValueError('a box needs at least one vial')
+        if len(set(pump_channels)) != len(pump_channels):
+            raise ValueError('duplicate pump channels %s' % pump_channels)
+        self.n_vials = n_vials
+        self.pump_channels = list(pump_channels)
+        self.vials = list(range(n_vials))
+        self.message_size = n_vials * len(self.pump_channels)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds the geometry from a dict like the GEOMETRY setting of
+        custom_script.py, e.g. {'vials': 16, 'pump_channels': ['in1',
+        'efflux', 'in2']}. None gives the standard box.
+        """
+        if config is None:
+            return cls()
+        return cls(config.get('vials', 16),
+                   config.get('pump_channels', PUMP_CHANNELS))
+
+    @property
+    def pumps_per_vial(self):
+        return len(self.pump_channels)
+
+    def pump_slot(self, vial, channel=INFLUX):
+        """
+        Index of a vial's pump channel in pump command messages.
+        """
+        return self.pump_channels.index(channel) * self.n_vials + vial
+
+    def pump_slots(self, channel=INFLUX, vials=None):
+        """
+        Indices of a pump channel for the given vials (default all), as an
+        array.
+        """
+        offset = self.pump_channels.index(channel) * self.n_vials
+        if vials is None:
+            return np.arange(offset, offset + self.n_vials)
+        return offset + np.asarray(vials, dtype=int)
+
+    def message(self, fill='--'):
+        """
+        A pump command with every slot set to fill.
+        """
+        return [fill] * self.message_size
+
+    def per_vial(self, values, dtype=np.float64):
+        """
+        Returns values as an array with one entry per vial; a single value
+        is used for every vial.
+        """
+        values = np.asarray(values, dtype=dtype)
+        if values.ndim == 0:
+            return np.full(self.n_vials, values, dtype=dtype)
+        if len(values) != self.n_vials:
+            raise ValueError('expected %d values, one per vial, got %d' %
+                             (self.n_vials, len(values)))
+        return values
+
+    def zeros(self, dtype=np.float64):
+        return np.zeros(self.n_vials, dtype=dtype)
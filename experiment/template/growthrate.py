@@ -0,0 +1,126 @@
+import numpy as np
+
+# per-vial arrays making up the estimator's state
+FIELDS = ['start', 'n', 'mean_t', 'mean_y', 'm2_t', 'm2_y', 'c_ty']
+
+class GrowthRateEstimator:
+    """
+    Streaming least-squares fit of log(OD) against time for every vial,
+    over the readings taken after the start of the vial's current growth
+    curve. Each reading updates the running means and co-moments (Welford
+    form of n, sum(t), sum(log OD), sum(t^2), sum(t * log OD) and
+    sum(log OD^2)), so the fit is O(1) whenever a curve ends, whatever the
+    length of the experiment. Results match scipy.stats.linregress on the
+    same points.
+    """
+
+    def __init__(self, n_vials):
+        self.n_vials = n_vials
+        # start time of the current segment, NaN until reset() is called
+        self.start = np.full(n_vials, np.nan)
+        self.n = np.zeros(n_vials)
+        self.mean_t = np.zeros(n_vials)
+        self.mean_y = np.zeros(n_vials)
+        self.m2_t = np.zeros(n_vials)
+        self.m2_y = np.zeros(n_vials)
+        self.c_ty = np.zeros(n_vials)
+
+    def reset(self, vial, start_time):
+        """
+        Starts a new segment, only readings taken after start_time count.
+        """
+        self.start[vial] = start_time
+        self.n[vial] = 0
+        self.mean_t[vial] = 0
+        self.mean_y[vial] = 0
+        self.m2_t[vial] = 0
+        self.m2_y[vial] = 0
+        self.c_ty[vial] = 0
+
+    def snapshot(self):
+        return {name: getattr(self, name).tolist() for name in FIELDS}
+
+    def restore(self, state):
+        for name in FIELDS:
+            values = np.asarray(state[name], dtype=np.float64)
+            if len(values) != self.n_vials:
+                raise ValueError('saved estimator has %d vials, expected %d'
+                                 % (len(values), self.n_vials))
+            getattr(self, name)[:] = values
+
+    def tracks(self, vial, start_time):
+        return self.start[vial] == start_time
+
+    def add(self, elapsed_time, od):
+        """
+        Adds one OD reading for every vial (od is indexed by vial).
+        """
+        with np.errstate(all='ignore'):
+            y = np.log(np.asarray(od, dtype=np.float64))
+        mask = np.isfinite(y) & (elapsed_time > self.start)
+        if not mask.any():
+            return
+        n = self.n[mask] + 1
+        dt = elapsed_time - self.mean_t[mask]
+        dy = y[mask] - self.mean_y[mask]
+        mean_t = self.mean_t[mask] + dt / n
+        mean_y = self.mean_y[mask] + dy / n
+        self.m2_t[mask] += dt * (elapsed_time - mean_t)
+        self.m2_y[mask] += dy * (y[mask] - mean_y)
+        self.c_ty[mask] += dt * (y[mask] - mean_y)
+        self.n[mask] = n
+        self.mean_t[mask] = mean_t
+        self.mean_y[mask] = mean_y
+
+    def extend(self, vial, times, od):
+        """
+        Adds a series of readings of one vial at once (e.g. the current
+        growth curve when resuming an experiment), by merging their means
+        and co-moments into the running ones.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        with np.errstate(all='ignore'):
+            y = np.log(np.asarray(od, dtype=np.float64))
+        mask = np.isfinite(y) & (times > self.start[vial])
+        t = times[mask]
+        y = y[mask]
+        m = len(t)
+        if m == 0:
+            return
+        mean_t = t.mean()
+        mean_y = y.mean()
+        dt = t - mean_t
+        dy = y - mean_y
+        n = self.n[vial] + m
+        delta_t = mean_t - self.mean_t[vial]
+        delta_y = mean_y - self.mean_y[vial]
+        weight = self.n[vial] * m / n
+        self.m2_t[vial] += dt.dot(dt) + delta_t * delta_t * weight
+        self.m2_y[vial] += dy.dot(dy) + delta_y * delta_y * weight
+        self.c_ty[vial] += dt.dot(dy) + delta_t * delta_y * weight
+        self.mean_t[vial] += delta_t * m / n
+        self.mean_y[vial] += delta_y * m / n
+        self.n[vial] = n
+
+    def result(self, vial):
+        """
+        Returns (slope, intercept, r_value, std_err) of the current segment,
+        NaN if fewer than two distinct times have been seen.
+        """
+        n = self.n[vial]
+        if n < 2 or self.m2_t[vial] == 0:
+            return np.nan, np.nan, np.nan, np.nan
+        slope = self.c_ty[vial] / self.m2_t[vial]
+        intercept = self.mean_y[vial] - slope * self.mean_t[vial]
+        if self.m2_y[vial] == 0:
+            r_value = 0.0
+        else:
+            r_value = self.c_ty[vial] / np.sqrt(self.m2_t[vial] *
+                                                self.m2_y[vial])
+            r_value = min(max(r_value, -1.0), 1.0)
+        if n > 2:
+            std_err = np.sqrt((1 - r_value**2) * self.m2_y[vial] /
+                              self.m2_t[vial] / (n - 2))
+        else:
+            std_err = 0.0
+        return slope, intercept, r_value, std_err
@@ -0,0 +1,130 @@
+import time
+import queue
+import contextvars
+import logging
+import threading
+
+logger = logging.getLogger('eVOLVER')
+
+BLOCK = 'block'
+DROP = 'drop'
+POLICIES = [BLOCK, DROP]
+
+class IOThread:
+    """
+    Runs disk writes on a dedicated thread fed by a bounded queue, so
+    broadcast handling doesn't wait on a slow SD card.
+
+    When the queue is full, submit() either waits for room (policy 'block')
+    or drops the job and counts it (policy 'drop').
+
+    A job that raises is logged and counted, and its exception is raised
+    again by the next drain() or close(), so a failing write reaches the
+    code waiting on it instead of only the log. close() runs every job
+    still queued before stopping the thread.
+    """
+
+    def __init__(self, maxsize=64, policy=BLOCK):
+        if policy not in POLICIES:
+            raise ValueError('unknown queue policy %s' % policy)
+        self.policy = policy
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        # exceptions of failed jobs not raised by drain()/close() yet
+        self._errors = []
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='eVOLVER-io')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, func, *args):
+        """
+        Queues func(*args) to run on the I/O thread, in the caller's
+        context (see supervisor.py). Returns False if the job was dropped.
+        """
+        if self._closed:
+            raise RuntimeError('I/O thread is closed')
+        job = (time.monotonic(), contextvars.copy_context(), func, args)
+        if self.policy == BLOCK:
+            self._queue.put(job)
+        else:
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                logger.warning('I/O queue full, dropped a write (%d so far)',
+                               self.dropped)
+                return False
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def drain(self):
+        """
+        Waits until every queued job has run, then raises the exception of
+        the first job that failed since the last drain, if any.
+        """
+        self._queue.join()
+        self._raise_errors()
+
+    def close(self):
+        """
+        Runs the jobs still queued and stops the thread. Raises like
+        drain().
+        """
+        if not self._closed:
+            self._closed = True
+            # queued after every pending job, whatever the policy
+            self._queue.put(None)
+            self._thread.join()
+        self._raise_errors()
+
+    def _raise_errors(self):
+        with self._lock:
+            errors, self._errors = self._errors, []
+        if errors:
+            if len(errors) > 1:
+                logger.error('%d background writes failed, raising the '
+                             'first', len(errors))
+            raise errors[0]
+
+    def metrics(self):
+        with self._lock:
+            completed = self.completed
+            return {'queue_depth': self._queue.qsize(),
+                    'submitted': self.submitted,
+                    'completed': completed,
+                    'dropped': self.dropped,
+                    'failed': self.failed,
+                    'mean_latency': (self.total_latency / completed
+                                     if completed else 0.0),
+                    'max_latency': self.max_latency}
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                self._queue.task_done()
+                return
+            queued_at, context, func, args = job
+            try:
+                context.run(func, *args)
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                    self._errors.append(e)
+                logger.exception('background write failed: %s', e)
+            finally:
+                latency = time.monotonic() - queued_at
+                with self._lock:
+                    self.completed += 1
+                    self.total_latency += latency
+                    self.max_latency = max(self.max_latency, latency)
+                self._queue.task_done()
@@ -0,0 +1,150 @@
+import json
+import queue
+import atexit
+import logging
+import threading
+import logging.handlers
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - [%(levelname)s] - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+TEXT = 'text'
+JSON = 'json'
+LOG_FORMATS = [TEXT, JSON]
+
+# listener writing the records queued by the root logger's QueueHandler
+_listener = None
+_configured = False
+
+class JSONFormatter(logging.Formatter):
+    """
+    One JSON object per line: time, level, logger, message, the unit
+    (see supervisor.py) if there is one and the traceback of exceptions.
+    """
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record, DATE_FORMAT),
+                 'created': record.created,
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()}
+        unit = getattr(record, 'unit', None)
+        if unit is not None:
+            entry['unit'] = unit
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+class _SyncRequest:
+    # queued like a record, handled once the records before it are written
+    def __init__(self):
+        self.done = threading.Event()
+
+class SyncingQueueListener(logging.handlers.QueueListener):
+    """
+    A QueueListener that flushes its handlers when it reaches a sync
+    request, so the log files are complete up to that point without
+    closing them.
+    """
+
+    def handle(self, record):
+        if isinstance(record, _SyncRequest):
+            for handler in self.handlers:
+                handler.flush()
+            record.done.set()
+            return
+        super().handle(record)
+
+    def add_handler(self, handler):
+        self.handlers = self.handlers + (handler,)
+
+def make_handler(filename=None, log_format=TEXT, fmt=TEXT_FORMAT,
+                 max_bytes=0, backups=5, when=None):
+    """
+    A handler writing to filename (stderr if None), rotated every 'when'
+    (e.g. 'midnight', 'H', see TimedRotatingFileHandler) or when it grows
+    past max_bytes, keeping backups old files.
+    """
+    if filename is None:
+        handler = logging.StreamHandler()
+    elif when:
+        handler = logging.handlers.TimedRotatingFileHandler(
+            filename, when=when, backupCount=backups)
+    elif max_bytes:
+        handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backups)
+    else:
+        handler = logging.FileHandler(filename)
+    if log_format == JSON:
+        handler.setFormatter(JSONFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(fmt, DATE_FORMAT))
+    return handler
+
+def setup_logging(filename, quiet, verbose, log_format=TEXT, fmt=TEXT_FORMAT,
+                  max_bytes=0, backups=5, when=None, record_filter=None):
+    """
+    Sends log records through a queue to a background thread writing them
+    to filename, so logging never waits on the disk. Only the first call
+    has an effect, like logging.basicConfig.
+
+    record_filter runs on the logging thread before a record is queued,
+    e.g. to tag it with context the background thread doesn't see.
+    """
+    global _listener, _configured
+    if _configured:
+        return
+    _configured = True
+    root = logging.getLogger()
+    if quiet:
+        root.setLevel(logging.CRITICAL + 10)
+        return
+    root.setLevel(logging.DEBUG if verbose >= 1 else logging.INFO)
+    handler = make_handler(filename, log_format, fmt, max_bytes, backups,
+                           when)
+    records = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(records)
+    if record_filter is not None:
+        queue_handler.addFilter(record_filter)
+    root.addHandler(queue_handler)
+    _listener = SyncingQueueListener(records, handler,
+                                     respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop)
+
+def add_handler(handler):
+    """
+    Adds a handler to the background thread, e.g. a per-unit log.
+    """
+    if _listener is None:
+        logging.getLogger().addHandler(handler)
+    else:
+        _listener.add_handler(handler)
+
+def sync(wait=False, timeout=None):
+    """
+    Makes the log files complete up to now, for syncers (database, Google
+    Drive) picking them up. Returns right away unless wait is set, in which
+    case it returns whether the records were written within timeout.
+    """
+    if _listener is None:
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+        return True
+    request = _SyncRequest()
+    _listener.queue.put_nowait(request)
+    if wait:
+        return request.done.wait(timeout)
+    return True
+
+def stop():
+    """
+    Writes out the queued records and stops the background thread.
+    """
+    global _listener
+    listener, _listener = _listener, None
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            handler.close()
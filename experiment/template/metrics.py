@@ -0,0 +1,233 @@
+import os
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+logger = logging.getLogger('eVOLVER')
+
+PREFIX = 'evolver'
+QUANTILES = [0.5, 0.95]
+# recent samples kept per stage for the quantiles
+WINDOW = 1024
+
+class Histogram:
+    """
+    Durations of one stage: count, sum and max since start, and quantiles
+    over the last WINDOW samples.
+    """
+
+    def __init__(self, window=WINDOW):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        with self._lock:
+            self._recent.append(seconds)
+            self.count += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    def summary(self):
+        with self._lock:
+            recent = np.array(self._recent)
+            summary = {'count': self.count, 'sum': self.total,
+                       'max': self.max}
+        for q in QUANTILES:
+            summary['p%d' % round(q * 100)] = (
+                float(np.quantile(recent, q)) if recent.size else 0.0)
+        return summary
+
+class StageTimer:
+    """
+    Times the stages of broadcast handling (see EvolverNamespace.on_broadcast)
+    and other sources of numbers (I/O queue, command batcher, ...) for
+    export in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.stages = OrderedDict()
+        self._sources = OrderedDict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages.setdefault(name, Histogram())
+        histogram.add(seconds)
+
+    def add_source(self, name, metrics):
+        """
+        metrics is a function returning a dict of numbers, exported as
+        evolver_<name>_<key> gauges.
+        """
+        self._sources[name] = metrics
+
+    def summary(self):
+        return OrderedDict((name, histogram.summary())
+                           for name, histogram in list(self.stages.items()))
+
+    def samples(self, labels=None):
+        """
+        Returns (metric, type, labels, value) tuples for to_prometheus().
+        """
+        labels = dict(labels or {})
+        samples = []
+        metric = PREFIX + '_stage_seconds'
+        for name, summary in self.summary().items():
+            stage_labels = dict(labels, stage=name)
+            for q in QUANTILES:
+                samples.append((metric, 'summary',
+                                dict(stage_labels, quantile=str(q)),
+                                summary['p%d' % round(q * 100)]))
+            samples.append((metric + '_sum', 'summary', stage_labels,
+                            summary['sum']))
+            samples.append((metric + '_count', 'summary', stage_labels,
+                            summary['count']))
+            samples.append((metric + '_max', 'gauge', stage_labels,
+                            summary['max']))
+        for source, metrics in list(self._sources.items()):
+            try:
+                values = metrics()
+            except Exception as e:
+                logger.warning('could not collect %s metrics: %s',
+                               source, e)
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)):
+                    samples.append(('%s_%s_%s' % (PREFIX, source, key),
+                                    'gauge', labels, value))
+        return samples
+
+    def prometheus(self, labels=None):
+        return to_prometheus(self.samples(labels))
+
+def to_prometheus(samples):
+    """
+    Formats samples in the Prometheus text exposition format, one TYPE
+    line per metric family.
+    """
+    families = OrderedDict()
+    for metric, metric_type, labels, value in samples:
+        family = metric
+        if metric_type == 'summary':
+            for suffix in ('_sum', '_count'):
+                if family.endswith(suffix):
+                    family = family[:-len(suffix)]
+        families.setdefault((family, metric_type), []).append(
+            (metric, labels, value))
+    lines = []
+    for (family, metric_type), family_samples in families.items():
+        lines.append('# TYPE %s %s' % (family, metric_type))
+        for metric, labels, value in family_samples:
+            if labels:
+                label_text = ','.join('%s="%s"' % (key, labels[key])
+                                      for key in sorted(labels))
+                lines.append('%s{%s} %r' % (metric, label_text, float(value)))
+            else:
+                lines.append('%s %r' % (metric, float(value)))
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(path, text):
+    """
+    Replaces the metrics file atomically, e.g. for the node exporter's
+    textfile collector.
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+class MetricsServer:
+    """
+    Serves the text returned by render() at http://<host>:<port>/metrics
+    from a background thread.
+    """
+
+    def __init__(self, port, render, host=''):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug('metrics request: ' + format, *args)
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever,
+                                        name='eVOLVER-metrics')
+        self._thread.daemon = True
+        self._thread.start()
+        logger.info('serving metrics on port %d', self.server.server_port)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+class BroadcastProfiler:
+    """
+    Profiles every broadcast with cProfile and keeps the profiles of those
+    slower than threshold seconds in directory, the newest 'keep' of them.
+    Open them with python -m pstats or snakeviz.
+    """
+
+    def __init__(self, threshold, directory, keep=20):
+        self.threshold = threshold
+        self.directory = directory
+        self.keep = keep
+        self._profile = None
+        self._saved = deque()
+        self._count = 0
+
+    def start(self):
+        self._profile = cProfile.Profile()
+        self._profile.enable()
+
+    def stop(self, seconds, label):
+        profile, self._profile = self._profile, None
+        if profile is None:
+            return None
+        profile.disable()
+        if seconds < self.threshold:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        # the count keeps names unique within a burst of broadcasts
+        self._count += 1
+        path = os.path.join(self.directory, 'broadcast_%s_%d.prof' %
+                            (label, self._count))
+        pstats.Stats(profile).dump_stats(path)
+        logger.info('broadcast took %.3f s, saved profile %s',
+                    seconds, path)
+        self._saved.append(path)
+        while len(self._saved) > self.keep:
+            old = self._saved.popleft()
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+        return path
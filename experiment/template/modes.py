@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import logging
+import numpy as np
+from collections import OrderedDict
+
+logger = logging.getLogger('eVOLVER')
+
+# operation modes of the template and the custom_script functions they run
+BUILTIN_MODES = {'turbidostat': 'turbidostat',
+                 'chemostat': 'chemostat',
+                 'growthcurve': 'growth_curve'}
+
+# vial_configuration entries of eVOLVER_parameters.json and their types
+VIAL_FIELDS = {'lower': np.float64, 'upper': np.float64,
+               'rate': np.float64, 'stir': np.float64,
+               'temp': np.float64, 'startTime': np.float64,
+               'startOD': np.float64}
+
+def operation_mode(name):
+    """
+    Decorator registering a custom_script function as an operation mode,
+    e.g. @operation_mode('pulse') for "function": "pulse" in
+    eVOLVER_parameters.json. Functions named like the mode need no
+    decorator.
+    """
+    def register(func):
+        func.operation_mode = name
+        return func
+    return register
+
+def group_vials(vials, modes=None, default=None, overrides=None):
+    """
+    Splits vials into (mode, vials) groups, in order of first appearance.
+    modes gives the mode of each vial (None or '' for the default);
+    overrides, in the same form, wins over modes where it has one.
+    """
+    groups = OrderedDict()
+    for x in vials:
+        mode = overrides[x] if overrides is not None else None
+        if not mode and modes is not None:
+            mode = modes[x]
+        groups.setdefault(mode or default, []).append(x)
+    return list(groups.items())
+
+def script_modes(script, n_vials):
+    """
+    The mode of each vial from the MODE_GROUPS setting of a custom script
+    ({mode: [vials]}), or None if it has none.
+    """
+    mode_groups = getattr(script, 'MODE_GROUPS', None)
+    if not mode_groups:
+        return None
+    modes = [None] * n_vials
+    for mode, vials in mode_groups.items():
+        for x in vials:
+            if modes[x] is not None:
+                raise ValueError('vial %d is in both the %s and %s groups' %
+                                 (x, modes[x], mode))
+            modes[x] = mode
+    return modes
+
+class ModeRegistry:
+    """
+    The operation modes of a custom script, looked up once per mode
+    instead of with getattr on every broadcast. Modes missing from the
+    script are reported once and then skipped.
+    """
+
+    def __init__(self, script):
+        self.script = script
+        self._modes = {}
+        for name, attribute in BUILTIN_MODES.items():
+            func = getattr(script, attribute, None)
+            if func is not None:
+                self._modes[name] = func
+        for value in vars(script).values():
+            name = getattr(value, 'operation_mode', None)
+            if callable(value) and name is not None:
+                self._modes[name] = value
+
+    def register(self, name, func):
+        self._modes[name] = func
+
+    def get(self, name):
+        """
+        Returns the function running a mode, or None if the script has
+        none.
+        """
+        try:
+            return self._modes[name]
+        except KeyError:
+            pass
+        func = getattr(self.script, name, None)
+        if not callable(func):
+            func = None
+            logger.error('could not find function %s in custom_script.py',
+                         name)
+            print('Could not find function %s in custom_script.py '
+                  '- Skipping user defined functions' % name)
+        else:
+            logger.info('user-defined operation mode %s', name)
+        self._modes[name] = func
+        return func
+
+    def names(self):
+        return [name for name, func in self._modes.items()
+                if func is not None]
+
+class VialConfig:
+    """
+    eVOLVER_parameters.json compiled into one array per vial_configuration
+    entry (config['lower'], config['rate'], ...), with one value per vial.
+    Entries missing for a vial are NaN; unknown non-numeric entries are
+    kept as object arrays.
+    """
+
+    def __init__(self, params, geometry):
+        self.params = params
+        self.mode = params.get('function')
+        vials = params.get('vial_configuration', [])
+        if len(vials) != geometry.n_vials:
+            raise ValueError('expected a vial configuration per vial (%d), '
+                             'got %d' % (geometry.n_vials, len(vials)))
+        keys = list(VIAL_FIELDS)
+        for vial in vials:
+            keys.extend(key for key in vial if key not in keys)
+        self.arrays = {}
+        for key in keys:
+            values = [vial.get(key) for vial in vials]
+            if all(value is None for value in values):
+                continue
+            dtype = VIAL_FIELDS.get(key, np.float64)
+            try:
+                array = np.array([np.nan if value is None else value
+                                  for value in values], dtype=dtype)
+            except (TypeError, ValueError):
+                if key in VIAL_FIELDS:
+                    raise ValueError('%s of the vial configuration must be '
+                                     'numbers' % key)
+                array = np.array(values, dtype=object)
+            array.setflags(write=False)
+            self.arrays[key] = array
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+    def __contains__(self, key):
+        return key in self.arrays
+
+    def get(self, key, default=None):
+        return self.arrays.get(key, default)
+
+    def groups(self, vials, default=None, overrides=None):
+        """
+        Splits vials by their "function" entry, falling back to the
+        experiment's "function" (or default). Vials with a mode in
+        overrides (see group_vials) run in that mode instead.
+        """
+        return group_vials(vials, self.arrays.get('function'),
+                           self.mode or default, overrides)
+
+    def changed(self, other, key):
+        """
+        Vials whose entry differs from the other configuration's.
+        """
+        new = self.arrays.get(key)
+        if new is None:
+            return np.array([], dtype=int)
+        old = None if other is None else other.arrays.get(key)
+        if old is None:
+            return np.arange(len(new))
+        if new.dtype == object or old.dtype == object:
+            return np.flatnonzero([a != b for a, b in zip(new, old)])
+        return np.flatnonzero(~((new == old) | (np.isnan(new) &
+                                                 np.isnan(old))))
+
+class ParamsFile:
+    """
+    Watches eVOLVER_parameters.json, checking its mtime at most every
+    check_interval seconds, and compiles it again when it changes.
+    """
+
+    def __init__(self, path, geometry, check_interval=30):
+        self.path = path
+        self.geometry = geometry
+        self.check_interval = check_interval
+        self._mtime = None
+        self._last_check = None
+
+    def load(self):
+        """
+        Returns (params, VialConfig), or (None, None) if there is no file.
+        """
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return None, None
+        with open(self.path) as f:
+            params = json.load(f)
+        self._mtime = mtime
+        return params, VialConfig(params, self.geometry)
+
+    def poll(self, force=False):
+        """
+        Returns (params, VialConfig) if the file changed since it was last
+        loaded, otherwise None.
+        """
+        now = time.time()
+        if (not force and self._last_check is not None and
+                now - self._last_check < self.check_interval):
+            return None
+        self._last_check = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return None
+        if mtime == self._mtime:
+            return None
+        try:
+            return self.load()
+        except ValueError as e:
+            # e.g. caught halfway through being written, try again later
+            logger.error('could not load %s: %s', self.path, e)
+            return None
+
+    def watch(self):
+        """
+        Takes the file as it is now as loaded, so poll() only reports later
+        changes.
+        """
+        try:
+            self._mtime = os.stat(self.path).st_mtime
+        except OSError:
+            self._mtime = None
@@ -0,0 +1,56 @@
+import gzip
+import json
+import logging
+
+logger = logging.getLogger('eVOLVER')
+
+# events the namespace records, in the order they arrive
+BROADCAST = 'broadcast'
+CALIBRATIONS = 'activecalibrations'
+
+class BroadcastRecorder:
+    """
+    Appends the raw payloads received from the server to a gzipped JSON
+    lines log, one {"t": received_at, "event": ..., "data": ...} object per
+    line, for replay.py to run them through EvolverNamespace again.
+
+    Payloads are encoded when received (before transform_data adds to
+    them); write() can then run on the I/O thread.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # a new gzip member per run, readers see one stream
+        self._file = gzip.open(path, 'at')
+        self.recorded = 0
+
+    def encode(self, event, data, received_at):
+        return json.dumps({'t': received_at, 'event': event, 'data': data},
+                          separators=(',', ':')) + '\n'
+
+    def write(self, line):
+        self._file.write(line)
+        self.recorded += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def read_recording(path):
+    """
+    Yields (received_at, event, data) for each recorded payload. A log cut
+    short (e.g. by a crash while recording) ends at its last whole line.
+    """
+    with gzip.open(path, 'rt') as f:
+        try:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning('truncated record in %s', path)
+                    return
+                yield record['t'], record['event'], record['data']
+        except EOFError:
+            logger.warning('%s ends early, recording was interrupted', path)
@@ -0,0 +1,169 @@
+import os
+import numpy as np
+
+from rollingstats import VialRolling, HampelFilter
+
+class VialRingBuffer:
+    """
+    Fixed-size, array-backed history of the most recent (time, value)
+    readings of one parameter for every vial.
+    """
+
+    def __init__(self, n_vials, size):
+        self.n_vials = n_vials
+        self.size = size
+        self._times = np.full((n_vials, size), np.nan)
+        self._values = np.full((n_vials, size), np.nan)
+        # next slot to write and number of valid slots, per vial
+        self._head = np.zeros(n_vials, dtype=np.intp)
+        self._count = np.zeros(n_vials, dtype=np.intp)
+        self._rows = np.arange(n_vials)
+        # rolling medians kept up to date per window size (and outlier
+        # threshold), see median()
+        self._medians = {}
+
+    def append(self, elapsed_time, values):
+        """
+        Adds one reading for every vial, values is indexed by vial.
+        """
+        self._times[self._rows, self._head] = elapsed_time
+        self._values[self._rows, self._head] = values
+        self._head = (self._head + 1) % self.size
+        self._count = np.minimum(self._count + 1, self.size)
+        for medians in self._medians.values():
+            medians.push(values)
+
+    def append_vial(self, vial, elapsed_time, value):
+        head = self._head[vial]
+        self._times[vial, head] = elapsed_time
+        self._values[vial, head] = value
+        self._head[vial] = (head + 1) % self.size
+        self._count[vial] = min(self._count[vial] + 1, self.size)
+        for medians in self._medians.values():
+            medians.push_vial(vial, value)
+
+    def extend_vial(self, vial, rows):
+        for row in rows[-self.size:]:
+            self.append_vial(vial, row[0], row[1])
+
+    def count(self, vial):
+        return int(self._count[vial])
+
+    def window(self, vial, n):
+        """
+        Returns the last n readings of a vial as an (n, 2) array of
+        (time, value) rows, oldest first. Like EvolverNamespace.tail_to_np,
+        returns an empty array if fewer than n readings are available.
+        """
+        if n <= 0 or n > self._count[vial]:
+            return np.asarray([])
+        idx = (self._head[vial] - n + np.arange(n)) % self.size
+        return np.column_stack((self._times[vial, idx],
+                                self._values[vial, idx]))
+
+    def windows(self, vials, n):
+        """
+        The last n values of several vials at once, as a (len(vials), n)
+        array, oldest first, and a mask of the vials with n readings (rows
+        of the others hold whatever is in the buffer).
+        """
+        vials = np.asarray(vials, dtype=np.intp)
+        if n <= 0 or n > self.size:
+            return (np.empty((len(vials), max(n, 0))),
+                    np.zeros(len(vials), dtype=bool))
+        idx = (self._head[vials, None] - n + np.arange(n)) % self.size
+        return self._values[vials[:, None], idx], self._count[vials] >= n
+
+    def median(self, vials, n, skipna=False, n_sigmas=None):
+        """
+        The median of the last n values of several vials, and a mask of
+        the vials with n readings, like np.median over windows() (or
+        np.nanmedian with skipna). The medians of each window size asked
+        for are kept up to date as readings are appended, in O(log n) per
+        reading, so a large window costs about the same as a small one.
+
+        With n_sigmas, values more than n_sigmas robust standard
+        deviations off are replaced by the median before them (see
+        HampelFilter), counting from when this window was first asked for.
+        """
+        vials = np.asarray(vials, dtype=np.intp)
+        if n <= 0 or n > self.size:
+            return (np.full(len(vials), np.nan),
+                    np.zeros(len(vials), dtype=bool))
+        key = n if n_sigmas is None else (n, n_sigmas)
+        medians = self._medians.get(key)
+        if medians is None:
+            if n_sigmas is None:
+                medians = VialRolling(self.n_vials, n)
+            else:
+                medians = VialRolling(self.n_vials, n, HampelFilter,
+                                      n_sigmas=n_sigmas)
+            for x in range(self.n_vials):
+                count = min(self._count[x], n)
+                idx = (self._head[x] - count + np.arange(count)) % self.size
+                medians.trackers[x].extend(self._values[x, idx])
+            self._medians[key] = medians
+        return medians.median(vials, skipna), medians.full(vials)
+
+def read_tail(path, n, block_size=4096):
+    """
+    Returns up to the last n numeric rows of a comma separated data file as
+    a list of float tuples, skipping headers and malformed lines.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        chunks = []
+        newlines = 0
+        while position > 0 and newlines <= n:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            chunk = f.read(read_size)
+            chunks.append(chunk)
+            newlines += chunk.count(b'\n')
+    lines = b''.join(reversed(chunks)).decode('utf-8').splitlines()
+    if position > 0:
+        # first line is probably cut
+        lines = lines[1:]
+    return parse_rows(lines[-(n + 1):])[-n:]
+
+def read_since(path, start_time, block_size=65536):
+    """
+    Returns the numeric rows of a comma separated data file whose time
+    (first column) is after start_time, reading back from the end only as
+    far as needed. Rows are assumed to be in time order.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        tail = b''
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            tail = f.read(read_size) + tail
+            # stop once a whole row at or before start_time has been read
+            first = tail.find(b'\n')
+            second = tail.find(b'\n', first + 1)
+            if position > 0 and first != -1 and second != -1:
+                rows = parse_rows([tail[first + 1:second].decode('utf-8')])
+                if rows and rows[0][0] <= start_time:
+                    break
+    lines = tail.decode('utf-8').splitlines()
+    if position > 0:
+        lines = lines[1:]
+    return [row for row in parse_rows(lines) if row[0] > start_time]
+
+def parse_rows(lines):
+    """
+    Parses comma separated lines into float tuples, skipping headers and
+    malformed lines.
+    """
+    rows = []
+    for line in lines:
+        try:
+            rows.append(tuple(float(v) for v in line.split(',')))
+        except ValueError:
+            continue
+    return rows
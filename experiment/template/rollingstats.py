@@ -0,0 +1,301 @@
+import math
+import heapq
+import numpy as np
+from collections import deque
+
+# MAD of normally distributed values, in standard deviations
+MAD_SCALE = 1.4826
+
+class RollingMedian:
+    """
+    Median of the last 'window' values pushed, updated in O(log window)
+    per value with two heaps (the lower half as a max-heap, the upper half
+    as a min-heap). Values leaving the window are only marked and dropped
+    once they reach the top of their heap; the heaps are rebuilt if too
+    many marked values pile up below the tops.
+
+    NaN values take a place in the window but not in the heaps: median()
+    is NaN while the window holds one, like np.median, and the median of
+    the other values with skipna, like np.nanmedian.
+    """
+
+    def __init__(self, window):
+        if window < 1:
+            raise ValueError('window must be at least 1, got %s' % window)
+        self.window = window
+        self.nans = 0
+        self._values = deque()
+        # lower half negated, both may hold values waiting to be dropped
+        self._low = []
+        self._high = []
+        self._low_size = 0
+        self._high_size = 0
+        self._delayed = {}
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def full(self):
+        return len(self._values) >= self.window
+
+    def push(self, value):
+        value = float(value)
+        self._values.append(value)
+        if math.isnan(value):
+            self.nans += 1
+        elif not self._low or value <= -self._low[0]:
+            heapq.heappush(self._low, -value)
+            self._low_size += 1
+        else:
+            heapq.heappush(self._high, value)
+            self._high_size += 1
+        if len(self._values) > self.window:
+            self._remove(self._values.popleft())
+        self._rebalance()
+        if len(self._low) + len(self._high) > 2 * self.window + 8:
+            self._rebuild()
+
+    def extend(self, values):
+        for value in values:
+            self.push(value)
+
+    def median(self, skipna=False):
+        if (self.nans and not skipna) or not self._low_size:
+            return np.nan
+        if self._low_size > self._high_size:
+            return -self._low[0]
+        return (-self._low[0] + self._high[0]) / 2
+
+    def _remove(self, value):
+        if math.isnan(value):
+            self.nans -= 1
+            return
+        self._delayed[value] = self._delayed.get(value, 0) + 1
+        if value <= -self._low[0]:
+            self._low_size -= 1
+            if value == -self._low[0]:
+                self._prune(self._low, -1)
+        else:
+            self._high_size -= 1
+            if value == self._high[0]:
+                self._prune(self._high, 1)
+
+    def _prune(self, heap, sign):
+        # drops the values left the window from the top of a heap
+        while heap:
+            value = sign * heap[0]
+            count = self._delayed.get(value)
+            if not count:
+                return
+            if count == 1:
+                del self._delayed[value]
+            else:
+                self._delayed[value] = count - 1
+            heapq.heappop(heap)
+
+    def _rebalance(self):
+        if self._low_size > self._high_size + 1:
+            heapq.heappush(self._high, -heapq.heappop(self._low))
+            self._low_size -= 1
+            self._high_size += 1
+            self._prune(self._low, -1)
+        elif self._low_size < self._high_size:
+            heapq.heappush(self._low, -heapq.heappop(self._high))
+            self._low_size += 1
+            self._high_size -= 1
+            self._prune(self._high, 1)
+
+    def _rebuild(self):
+        values = sorted(v for v in self._values if not math.isnan(v))
+        half = (len(values) + 1) // 2
+        self._low = [-v for v in reversed(values[:half])]
+        self._high = values[half:]
+        # both are sorted, so already heaps
+        self._low_size, self._high_size = half, len(values) - half
+        self._delayed = {}
+
+class RollingMoments:
+    """
+    Mean and variance of the last 'window' values pushed, in O(1) per
+    value from running sums, which are summed again from the window every
+    'window' values so rounding errors don't build up. NaN values take a
+    place in the window but are left out, like np.nanmean and np.nanvar.
+    """
+
+    def __init__(self, window):
+        if window < 1:
+            raise ValueError('window must be at least 1, got %s' % window)
+        self.window = window
+        self._values = deque()
+        self._count = 0
+        self._sum = 0.0
+        self._squares = 0.0
+        self._removed = 0
+
+    def __len__(self):
+        return len(self._values)
+
+    @property
+    def full(self):
+        return len(self._values) >= self.window
+
+    @property
+    def count(self):
+        return self._count
+
+    def push(self, value):
+        value = float(value)
+        self._values.append(value)
+        if not math.isnan(value):
+            self._count += 1
+            self._sum += value
+            self._squares += value * value
+        if len(self._values) > self.window:
+            old = self._values.popleft()
+            if not math.isnan(old):
+                self._count -= 1
+                self._sum -= old
+                self._squares -= old * old
+            self._removed += 1
+            if self._removed >= self.window:
+                self._resum()
+
+    def extend(self, values):
+        for value in values:
+            self.push(value)
+
+    def mean(self):
+        if not self._count:
+            return np.nan
+        return self._sum / self._count
+
+    def var(self, ddof=0):
+        if self._count <= ddof:
+            return np.nan
+        mean = self._sum / self._count
+        spread = max(self._squares - self._count * mean * mean, 0.0)
+        return spread / (self._count - ddof)
+
+    def std(self, ddof=0):
+        return math.sqrt(self.var(ddof))
+
+    def _resum(self):
+        valid = [v for v in self._values if not math.isnan(v)]
+        self._count = len(valid)
+        self._sum = math.fsum(valid)
+        self._squares = math.fsum(v * v for v in valid)
+        self._removed = 0
+
+class HampelFilter:
+    """
+    Streaming Hampel filter: a value further than n_sigmas robust standard
+    deviations (MAD_SCALE times the median absolute deviation) from the
+    median of the last 'window' values is an outlier and is replaced by
+    that median. Outliers still enter the window, so a real step in the
+    readings is followed after about half a window.
+
+    The MAD is taken over the deviations of each value from the median
+    when it arrived, which keeps it O(log window) per value. median() is
+    the median of the last 'window' filtered values, a rolling median
+    that outliers don't move.
+    """
+
+    def __init__(self, window, n_sigmas=3, min_count=3):
+        self.n_sigmas = n_sigmas
+        self.min_count = min_count
+        self.values = RollingMedian(window)
+        self.deviations = RollingMedian(window)
+        # the values as filtered
+        self.filtered = RollingMedian(window)
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def full(self):
+        return self.values.full
+
+    def push(self, value):
+        """
+        Adds a value and returns (filtered value, whether it was an
+        outlier).
+        """
+        value = float(value)
+        median = self.values.median(skipna=True)
+        outlier = False
+        if not math.isnan(value) and not math.isnan(median):
+            deviation = abs(value - median)
+            mad = self.deviations.median(skipna=True)
+            if (len(self.values) - self.values.nans >= self.min_count and
+                    deviation > self.n_sigmas * MAD_SCALE * mad):
+                outlier = True
+            self.deviations.push(deviation)
+        else:
+            self.deviations.push(np.nan)
+        self.values.push(value)
+        if outlier:
+            value = median
+        self.filtered.push(value)
+        return value, outlier
+
+    def extend(self, values):
+        for value in values:
+            self.push(value)
+
+    def median(self, skipna=False):
+        return self.filtered.median(skipna)
+
+class VialRolling:
+    """
+    One rolling tracker per vial, e.g. VialRolling(16, 6) for the median
+    of each vial's last 6 ODs or VialRolling(16, 20, RollingMoments) for
+    their means. push() takes one value per vial like
+    VialRingBuffer.append.
+    """
+
+    def __init__(self, n_vials, window, tracker=RollingMedian, **kw):
+        self.n_vials = n_vials
+        self.window = window
+        self.trackers = [tracker(window, **kw) for x in range(n_vials)]
+
+    def push(self, values):
+        for tracker, value in zip(self.trackers, values):
+            tracker.push(value)
+
+    def push_vial(self, vial, value):
+        return self.trackers[vial].push(value)
+
+    def full(self, vials):
+        return np.array([self.trackers[x].full for x in vials], dtype=bool)
+
+    def median(self, vials, skipna=False):
+        return np.array([self.trackers[x].median(skipna) for x in vials],
+                        dtype=np.float64)
+
+    def mean(self, vials):
+        return np.array([self.trackers[x].mean() for x in vials],
+                        dtype=np.float64)
+
+    def var(self, vials, ddof=0):
+        return np.array([self.trackers[x].var(ddof) for x in vials],
+                        dtype=np.float64)
+
+def hampel(values, window, n_sigmas=3):
+    """
+    values with their outliers replaced, see HampelFilter.
+    """
+    hampel_filter = HampelFilter(window, n_sigmas)
+    return np.array([hampel_filter.push(value)[0] for value in values])
+
+def rolling_mean(values, window):
+    """
+    The mean of each value and the (window - 1) before it, skipping NaN
+    values; the first values average what there is so far.
+    """
+    moments = RollingMoments(window)
+    means = np.empty(len(values))
+    for i, value in enumerate(values):
+        moments.push(value)
+        means[i] = moments.mean()
+    return means
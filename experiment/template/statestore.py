@@ -0,0 +1,165 @@
+import os
+import logging
+import numpy as np
+
+logger = logging.getLogger('eVOLVER')
+
+class StateStore:
+    """
+    In-memory view of the per-vial control-state files (ODset, pump_log,
+    chemo_config, temp_config, ...) that only ever get appended to.
+
+    For each file it keeps the last row and the number of rows, so
+    controllers don't have to parse the whole file every broadcast. A file
+    is read once, the first time it is used (e.g. when resuming an
+    experiment): the last row is read from the end and only the row count
+    needs a pass over the file. append() writes through to the file via
+    the DataWriter.
+    """
+
+    def __init__(self, exp_dir, writer):
+        self.exp_dir = exp_dir
+        self.writer = writer
+        self._last = {}
+        self._count = {}
+
+    def path(self, parameter, vial):
+        file_name = "vial{0}_{1}.txt".format(vial, parameter)
+        return os.path.join(self.exp_dir, parameter, file_name)
+
+    def last(self, parameter, vial):
+        """
+        Returns the last row of the file as a float array, like the last
+        row of np.genfromtxt(path, delimiter=',').
+        """
+        key = (parameter, vial)
+        if key not in self._last:
+            self._load(key)
+        return self._last[key]
+
+    def count(self, parameter, vial):
+        """
+        Returns the number of rows in the file, headers included, like
+        len(np.genfromtxt(path, delimiter=',')).
+        """
+        key = (parameter, vial)
+        if key not in self._count:
+            self._load(key)
+        return self._count[key]
+
+    def append(self, parameter, vial, *values):
+        key = (parameter, vial)
+        if key not in self._count:
+            self._load(key)
+        line = ','.join(str(v) for v in values)
+        self.writer.write(self.path(parameter, vial), line + '\n')
+        self._last[key] = parse_row(line)
+        self._count[key] += 1
+
+    def snapshot(self):
+        """
+        Returns the cached records as [parameter, vial, last row, row count]
+        entries, for a checkpoint. Only records whose rows have all been
+        flushed are included, so the row count matches the file once the
+        flushed rows are written; the others are read from their file on
+        resume. Records of files that lost rows to a dropped write are read
+        from the file again.
+        """
+        dropped = self.writer.take_dropped()
+        for key in list(self._count):
+            if self.path(*key) in dropped:
+                logger.warning('rows of %s for vial %s were dropped, '
+                               'reading the file again', *key)
+                self.invalidate(*key)
+        entries = []
+        for (parameter, vial), count in self._count.items():
+            if self.writer.pending(self.path(parameter, vial)):
+                continue
+            entries.append([parameter, vial,
+                            self._last[(parameter, vial)].tolist(), count])
+        return entries
+
+    def add_sizes(self, entries):
+        """
+        Appends the current size of each entry's file, once the rows flushed
+        before snapshot() have been written, so restore() can tell if the
+        file changed since.
+        """
+        for entry in entries:
+            try:
+                entry.append(os.path.getsize(self.path(entry[0], entry[1])))
+            except OSError:
+                entry.append(None)
+        return entries
+
+    def restore(self, entries):
+        """
+        Loads records from a checkpoint instead of reading the files. If a
+        file grew since the checkpoint only the new rows are read; an entry
+        whose file shrank is skipped and that file is read on first use as
+        usual.
+        """
+        restored = 0
+        for parameter, vial, last, count, size in entries:
+            file_path = self.path(parameter, vial)
+            try:
+                current_size = os.path.getsize(file_path)
+            except OSError:
+                continue
+            if size is None or current_size < size:
+                logger.info('%s of vial %s changed since the checkpoint',
+                            parameter, vial)
+                continue
+            key = (parameter, vial)
+            if current_size > size:
+                self._last[key] = parse_row(last_line(file_path))
+                self._count[key] = count + count_rows(file_path, size)
+            else:
+                self._last[key] = np.array(last, dtype=np.float64)
+                self._count[key] = count
+            restored += 1
+        return restored
+
+    def invalidate(self, parameter, vial):
+        self._last.pop((parameter, vial), None)
+        self._count.pop((parameter, vial), None)
+
+    def _load(self, key):
+        file_path = self.path(*key)
+        self.writer.flush_file(file_path)
+        self._last[key] = parse_row(last_line(file_path))
+        self._count[key] = count_rows(file_path)
+
+def last_line(path, block_size=512):
+    """
+    Returns the last non-empty line of a file, reading back from the end.
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        tail = b''
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            tail = f.read(read_size) + tail
+            lines = tail.strip().split(b'\n')
+            if len(lines) > 1 or position == 0:
+                return lines[-1].decode('utf-8').strip()
+    return ''
+
+def count_rows(path, offset=0):
+    """
+    Counts the non-empty lines of a file from a byte offset on.
+    """
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        return sum(1 for line in f if line.strip())
+
+def parse_row(line):
+    values = line.split(',')
+    try:
+        return np.array([float(v) for v in values])
+    except ValueError:
+        # header line
+        return np.full(len(values), np.nan)
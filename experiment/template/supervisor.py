@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import logging
+import argparse
+import asyncio
+import traceback
+import contextvars
+import importlib.util
+from socketIO_client import SocketIO
+
+import eVOLVER
+from eVOLVER import EvolverNamespace
+from asyncclient import AsyncEvolverClient
+from metrics import MetricsServer, to_prometheus
+import logsetup
+
+logger = logging.getLogger('eVOLVER')
+
+# name of the unit the running code works for, used to route log records.
+# Event loop tasks, transport threads and I/O jobs inherit it.
+current_unit = contextvars.ContextVar('eVOLVER_unit', default=None)
+
+LOG_FORMAT = ('%(asctime)s - [%(unit)s] %(name)s - [%(levelname)s] '
+              '- %(message)s')
+UNIT_LOG_FORMAT = logsetup.TEXT_FORMAT
+
+class UnitFilter(logging.Filter):
+    """
+    Tags records with the current unit, unless they already are (e.g.
+    when queued for the logging thread). With a unit name, only lets that
+    unit's records through.
+    """
+
+    def __init__(self, unit=None):
+        super().__init__()
+        self.unit = unit
+
+    def filter(self, record):
+        if not hasattr(record, 'unit'):
+            record.unit = current_unit.get() or '-'
+        return self.unit is None or record.unit == self.unit
+
+class Unit:
+    """
+    One eVOLVER box: its connection, EvolverNamespace, custom script and
+    experiment directory (holding the script, calibrations and data).
+    """
+
+    def __init__(self, name, ip_address, exp_dir, script='custom_script.py',
+                 port=None):
+        self.name = name
+        self.ip_address = ip_address
+        self.exp_dir = os.path.abspath(exp_dir)
+        self.script_path = os.path.join(self.exp_dir, script)
+        self.port = port
+        self.script = None
+        self.experiment_params = None
+        self.socketIO = None
+        self.namespace = None
+        self.client = None
+
+    @classmethod
+    def from_config(cls, entry):
+        return cls(entry['name'], entry.get('ip'), entry['exp_dir'],
+                   entry.get('script', 'custom_script.py'),
+                   entry.get('port'))
+
+    def start(self, options):
+        """
+        Loads the custom script, connects to the unit and initializes (or
+        resumes) its experiment.
+        """
+        self.script = load_script(self.script_path,
+                                  'custom_script_%s' % self.name)
+        params_file = os.path.join(self.exp_dir, eVOLVER.JSON_PARAMS_NAME)
+        if os.path.exists(params_file):
+            with open(params_file) as f:
+                self.experiment_params = json.load(f)
+        if self.ip_address is None and self.experiment_params is not None:
+            self.ip_address = self.experiment_params['ip']
+        if self.ip_address is None:
+            raise ValueError('no IP address for unit %s' % self.name)
+        port = self.port if self.port is not None else self.script.EVOLVER_PORT
+
+        self.socketIO = SocketIO(self.ip_address, port)
+        self.namespace = self.socketIO.define(EvolverNamespace,
+                                              '/dpu-evolver')
+        self.namespace.configure(self.exp_dir, self.script)
+        self.namespace.apply_options(options)
+        self.namespace.stop_all_pumps()
+        log_name = os.path.join(self.namespace.data_dir, 'evolver.log')
+        self.namespace.start_time = self.namespace.initialize_exp(
+            self.namespace.geometry.vials, self.experiment_params, log_name,
+            options.quiet, options.verbose, self.ip_address,
+            options.always_yes)
+        if not options.quiet:
+            add_unit_log(self.name, log_name, **self.namespace.log_config)
+        self.client = AsyncEvolverClient(self.socketIO, self.namespace,
+                                         backlog_policy=options.backlog_policy,
+                                         read_stdin=False)
+        self.namespace.metrics.add_source('broadcasts', self.client.metrics)
+
+class Supervisor:
+    """
+    Runs several eVOLVER units from one process and one event loop, so the
+    interpreter, numpy and scipy are loaded once rather than once per box.
+    Each unit keeps its own namespace, data files and log; an error in one
+    unit stops that unit's experiment only.
+    """
+
+    def __init__(self, units):
+        self.units = units
+
+    def start(self, options):
+        for unit in self.units:
+            token = current_unit.set(unit.name)
+            try:
+                logger.info('starting unit %s (%s)', unit.name,
+                            unit.ip_address)
+                unit.start(options)
+            finally:
+                current_unit.reset(token)
+
+    async def run(self):
+        tasks = []
+        for unit in self.units:
+            # tasks copy the current context, so each logs as its unit
+            token = current_unit.set(unit.name)
+            try:
+                tasks.append(asyncio.ensure_future(self._run_unit(unit)))
+            finally:
+                current_unit.reset(token)
+        await asyncio.gather(*tasks)
+
+    async def _run_unit(self, unit):
+        try:
+            await unit.client.run()
+        except Exception as e:
+            logger.critical('exception %s stopped the experiment', e)
+            logger.critical(traceback.format_exc())
+            print('error "%s" stopped the experiment on %s' % (str(e),
+                                                               unit.name))
+            unit.namespace.stop_exp()
+            unit.client.disconnect()
+
+    def prometheus(self):
+        """
+        The metrics of all units, labelled with the unit name.
+        """
+        samples = []
+        for unit in self.units:
+            if unit.namespace is not None:
+                samples.extend(unit.namespace.metrics.samples(
+                    {'unit': unit.name}))
+        return to_prometheus(samples)
+
+    def each(self, method):
+        for unit in self.units:
+            token = current_unit.set(unit.name)
+            try:
+                method(unit)
+            except Exception as e:
+                logger.error('%s', e)
+            finally:
+                current_unit.reset(token)
+
+def load_script(path, module_name):
+    """
+    Imports a custom script from its file under its own module name, so
+    units with different scripts don't share module state.
+    """
+    spec = importlib.util.spec_from_file_location(module_name, path)
+    if spec is None:
+        raise ImportError('could not load custom script %s' % path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def load_units(path):
+    with open(path) as f:
+        config = json.load(f)
+    if isinstance(config, dict):
+        config = config['units']
+    units = [Unit.from_config(entry) for entry in config]
+    names = [unit.name for unit in units]
+    if len(set(names)) != len(names):
+        raise ValueError('unit names must be unique')
+    return units
+
+def setup_logging(filename, quiet, verbose, **log_config):
+    # records are tagged with their unit before they are queued
+    logsetup.setup_logging(filename, quiet, verbose, fmt=LOG_FORMAT,
+                           record_filter=UnitFilter(), **log_config)
+
+def add_unit_log(unit, filename, **log_config):
+    handler = logsetup.make_handler(filename, fmt=UNIT_LOG_FORMAT,
+                                    **log_config)
+    handler.addFilter(UnitFilter(unit))
+    logsetup.add_handler(handler)
+
+def get_options():
+    description = ('Run eVOLVER experiments on several units from one '
+                   'process')
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('units',
+                        help='JSON file listing the units, e.g. '
+                             '[{"name": "box1", "ip": "192.168.1.2", '
+                             '"exp_dir": "box1", "script": '
+                             '"custom_script.py"}]. exp_dir holds the '
+                             'script, calibrations and the data directory; '
+                             'ip defaults to the one in its '
+                             'eVOLVER_parameters.json')
+    parser.add_argument('-l', '--log-name', default=None,
+                        help='Combined log file for all units (default: '
+                             'stderr). Each unit also logs to evolver.log '
+                             'in its data directory.')
+    eVOLVER.add_run_options(parser)
+    return parser.parse_args(), parser
+
+if __name__ == '__main__':
+    options, parser = get_options()
+
+    setup_logging(options.log_name, options.quiet, options.verbose,
+                  **eVOLVER.log_config(options))
+    supervisor = Supervisor(load_units(options.units))
+    supervisor.start(options)
+    if options.metrics_port is not None:
+        MetricsServer(options.metrics_port, supervisor.prometheus)
+
+    while True:
+        try:
+            asyncio.run(supervisor.run())
+            # every unit stopped on an error
+            break
+        except KeyboardInterrupt:
+            try:
+                print('Ctrl-C detected, pausing experiments')
+                supervisor.each(lambda unit: unit.client.pause())
+                input('Experiments paused. Press enter key to restart '
+                      ' or hit Ctrl-C again to terminate experiments')
+                supervisor.each(lambda unit: unit.client.resume())
+            except KeyboardInterrupt:
+                print('Second Ctrl-C detected, shutting down')
+                break
+
+    # stop experiments one last time
+    supervisor.each(lambda unit: unit.client.connect())
+    supervisor.each(lambda unit: unit.namespace.stop_exp())
+    supervisor.each(lambda unit: unit.namespace.stop_io_thread())
+    print('Experiments stopped, goodbye!')
+    logsetup.stop()
@@ -0,0 +1,140 @@
+import logging
+import numpy as np
+
+from geometry import INFLUX, EFFLUX
+
+logger = logging.getLogger('eVOLVER')
+
+# longest influx (s) a single dilution may run
+MAX_TIME_IN = 20
+
+class TurbidostatEngine:
+    """
+    The turbidostat of custom_script.py for all its vials at once.
+
+    Each vial's current ODset record (time and target OD), its number of
+    ODset records and the time of its last dilution are kept in arrays,
+    read once from the control-state files. Records are still appended
+    to the files (through EvolverNamespace.state) for the GUI and for
+    resuming.
+
+    Decisions are the same as the former per-vial loop: the median of the
+    last 'window' ODs ends a growth curve above upper (ODset goes to lower
+    and the growth rate is saved) and starts one near lower (ODset goes to
+    upper). Above ODset, and if fewer than stop_after_n_curves + 2 curves
+    were recorded, a vial is diluted back to lower for at most 20 s unless
+    it was diluted less than pump_wait minutes ago.
+    """
+
+    def __init__(self, n_vials):
+        self.n_vials = n_vials
+        self.od_set_time = np.zeros(n_vials)
+        self.od_set = np.zeros(n_vials)
+        # ODset rows, header included, like StateStore.count
+        self.od_set_rows = np.zeros(n_vials, dtype=np.int64)
+        self.last_pump = np.zeros(n_vials)
+        self._loaded = np.zeros(n_vials, dtype=bool)
+
+    def load(self, state, vials):
+        """
+        Reads the state of vials not seen yet from the control-state
+        records.
+        """
+        for x in vials:
+            # plain ints, vials end up in the checkpoint as record keys
+            x = int(x)
+            if self._loaded[x]:
+                continue
+            od_set_time, od_set = state.last('ODset', x)[:2]
+            self.od_set_time[x] = od_set_time
+            self.od_set[x] = od_set
+            self.od_set_rows[x] = state.count('ODset', x)
+            self.last_pump[x] = state.last('pump_log', x)[0]
+            self._loaded[x] = True
+
+    def forget(self, vials=None):
+        """
+        Reads the state of vials again on next use, e.g. after their files
+        were replaced.
+        """
+        if vials is None:
+            self._loaded[:] = False
+        else:
+            self._loaded[np.asarray(vials, dtype=np.intp)] = False
+
+    def run(self, eVOLVER, vials, elapsed_time, lower_thresh, upper_thresh,
+            flow_rate, volume, window=6, pump_wait=3, time_out=5,
+            stop_after_n_curves=np.inf, n_sigmas=None):
+        """
+        Runs one control step for vials and returns the pump message, or
+        None if no pump needs to run. With n_sigmas, OD outliers are left
+        out of the median (see EvolverNamespace.rolling_median).
+        """
+        vials = np.asarray(vials, dtype=np.intp)
+        if vials.size == 0:
+            return None
+        self.load(eVOLVER.state, vials)
+        lower = np.asarray(lower_thresh, dtype=np.float64)[vials]
+        upper = np.asarray(upper_thresh, dtype=np.float64)[vials]
+
+        # medians of vials without enough readings are never used
+        average_OD, enough = eVOLVER.rolling_median('OD', vials, window,
+                                                    n_sigmas=n_sigmas)
+        for x in vials[~enough]:
+            logger.debug('not enough OD measurements for vial %d', x)
+        num_curves = self.od_set_rows[vials] / 2
+        collecting_more_curves = num_curves <= (stop_after_n_curves + 2)
+
+        with np.errstate(invalid='ignore'):
+            # end of a growth curve, allow dilutions and save growth rate
+            ended = (enough & (average_OD > upper) &
+                     (self.od_set[vials] != lower))
+            for i in np.flatnonzero(ended):
+                x = int(vials[i])
+                eVOLVER.state.append('ODset', x, elapsed_time,
+                                     lower_thresh[x])
+                gr_start = self.od_set_time[x]
+                self._set(x, elapsed_time, lower[i])
+                eVOLVER.calc_growth_rate(x, gr_start, elapsed_time)
+
+            # approx. back at the lower threshold, start of a growth curve
+            started = (enough &
+                       (average_OD < (lower + (upper - lower) / 3)) &
+                       (self.od_set[vials] != upper))
+            for i in np.flatnonzero(started):
+                x = int(vials[i])
+                eVOLVER.state.append('ODset', x, elapsed_time,
+                                     upper_thresh[x])
+                self._set(x, elapsed_time, upper[i])
+                eVOLVER.growth_rates.reset(x, elapsed_time)
+
+            dilute = (enough & (average_OD > self.od_set[vials]) &
+                      collecting_more_curves)
+            waited = (elapsed_time - self.last_pump[vials]) * 60 >= pump_wait
+            dilute &= waited
+        if not dilute.any():
+            return None
+
+        flow = np.asarray(flow_rate, dtype=np.float64)[vials[dilute]]
+        with np.errstate(all='ignore'):
+            time_in = -(np.log(lower[dilute] / average_OD[dilute]) *
+                        volume) / flow
+        capped = time_in > MAX_TIME_IN
+        time_in = np.round(time_in, 2)
+
+        geometry = eVOLVER.geometry
+        MESSAGE = geometry.message()
+        for x, seconds, cap in zip(vials[dilute].tolist(), time_in, capped):
+            # the cap is an int, as the loop wrote it to the files
+            seconds = MAX_TIME_IN if cap else seconds
+            logger.info('turbidostat dilution for vial %d', x)
+            MESSAGE[geometry.pump_slot(x, INFLUX)] = str(seconds)
+            MESSAGE[geometry.pump_slot(x, EFFLUX)] = str(seconds + time_out)
+            eVOLVER.state.append('pump_log', x, elapsed_time, seconds)
+            self.last_pump[x] = elapsed_time
+        return MESSAGE
+
+    def _set(self, vial, elapsed_time, od_set):
+        self.od_set_time[vial] = elapsed_time
+        self.od_set[vial] = od_set
+        self.od_set_rows[vial] += 1
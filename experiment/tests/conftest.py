@@ -0,0 +1,10 @@
+import os
+import sys
+
+EXPERIMENT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+TEMPLATE_DIR = os.path.join(EXPERIMENT_DIR, 'template')
+
+# the tools import the template modules the same way
+for path in (TEMPLATE_DIR, EXPERIMENT_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
@@ -0,0 +1,77 @@
+"""
+Runs EvolverNamespace against simulator.py's culture model, without a
+socket, for the tests.
+"""
+
+import os
+import contextlib
+
+import eVOLVER
+from eVOLVER import EvolverNamespace
+from supervisor import load_script
+from geometry import DeviceGeometry
+from simulator import CultureModel, SimulatedEvolver
+
+SCRIPT = os.path.join(os.path.dirname(os.path.realpath(eVOLVER.__file__)),
+                      'custom_script.py')
+STEP = 20
+
+class Link:
+    """
+    Takes the place of the SocketIO connection of a namespace, applying
+    its commands to a SimulatedEvolver (if any) and keeping them.
+    """
+
+    # read by socketIO_client's namespaces for their log name
+    _url = 'test'
+
+    def __init__(self, evolver=None):
+        self.evolver = evolver
+        self.commands = []
+
+    def emit(self, event, *args, **kw):
+        if event != 'command':
+            return
+        self.commands.append(args[0])
+        if self.evolver is not None:
+            self.evolver.command(args[0])
+
+def load_test_script(name='custom_script_test', **settings):
+    script = load_script(SCRIPT, name)
+    for key, value in settings.items():
+        setattr(script, key, value)
+    return script
+
+def simulated_evolver(script, seed=0, od=0.05):
+    geometry = DeviceGeometry.from_config(getattr(script, 'GEOMETRY', None))
+    return SimulatedEvolver(CultureModel(geometry, od=od, seed=seed))
+
+def start(exp_dir, script, evolver, start_time=0.0):
+    """
+    A namespace running script in exp_dir, starting a new experiment or
+    continuing the one there.
+    """
+    namespace = EvolverNamespace(Link(evolver), '/dpu-evolver')
+    namespace.configure(str(exp_dir), script)
+    resuming = os.path.exists(namespace.data_dir)
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        resumed_time = namespace.initialize_exp(
+            namespace.geometry.vials, None,
+            os.path.join(str(exp_dir), 'test.log'), True, 0, 'test',
+            always_yes=True)
+    if resuming:
+        namespace.start_time = resumed_time
+    else:
+        namespace.start_time = start_time
+        namespace.use_blank = False
+    namespace.on_activecalibrations(evolver.active_calibrations())
+    return namespace
+
+def run(namespace, evolver, broadcasts, step=STEP):
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for i in range(broadcasts):
+            data = evolver.broadcast(step)
+            namespace.on_broadcast(data, received_at=namespace.start_time +
+                                   evolver.model.time)
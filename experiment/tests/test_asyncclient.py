@@ -0,0 +1,148 @@
+import time
+import asyncio
+import threading
+
+import asyncclient
+from asyncclient import AsyncEvolverClient, COALESCE
+
+class FakeSocketIO:
+    """
+    The parts of socketIO_client 0.7.2's SocketIO the client uses. Like the
+    real one, a wait() whose connection was closed under it opens a new
+    session before returning.
+    """
+
+    def __init__(self):
+        self.sessions = 1
+        self._opened = True
+        self._lock = threading.Lock()
+
+    def _open(self):
+        with self._lock:
+            if not self._opened:
+                self.sessions += 1
+                self._opened = True
+
+    def wait(self, seconds=None):
+        start = time.monotonic()
+        while self._opened and (seconds is None or
+                                time.monotonic() - start < seconds):
+            time.sleep(0.005)
+        # self._transport.set_timeout()
+        self._open()
+
+    def connect(self):
+        self._open()
+
+    def disconnect(self):
+        self._opened = False
+
+class FakeNamespace:
+    def __init__(self):
+        self.handlers = {}
+        self.broadcasts = []
+        self.stopped = 0
+
+    def on(self, event, handler):
+        self.handlers[event] = handler
+
+    def on_broadcast(self, data, received_at=None, control=True):
+        self.broadcasts.append((data, received_at, control))
+
+    def on_activecalibrations(self, data):
+        pass
+
+    def stop_exp(self):
+        self.stopped += 1
+
+def make_client(monkeypatch):
+    monkeypatch.setattr(asyncclient, 'WAIT_SECONDS', 0.05)
+    namespace = FakeNamespace()
+    client = AsyncEvolverClient(FakeSocketIO(), namespace,
+                                backlog_policy=COALESCE, read_stdin=False)
+    return client, namespace
+
+async def until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, 'timed out'
+        await asyncio.sleep(0.01)
+
+def run_with(client, scenario):
+    async def main():
+        task = asyncio.ensure_future(client.run())
+        await until(lambda: client._loop is not None)
+        try:
+            await scenario()
+        finally:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    asyncio.run(main())
+
+def test_only_the_newest_broadcast_of_a_backlog_drives_control(monkeypatch):
+    client, namespace = make_client(monkeypatch)
+
+    async def scenario():
+        now = time.time()
+        handler = namespace.on_broadcast
+        for i in range(5):
+            client._enqueue('broadcast', handler, ({'i': i},), now - 10 + i)
+        assert client.metrics()['queued'] == 5
+        await until(lambda: client.broadcasts == 5)
+    run_with(client, scenario)
+
+    assert [control for data, received_at, control in
+            namespace.broadcasts] == [False] * 4 + [True]
+    assert [data['i'] for data, received_at, control in
+            namespace.broadcasts] == list(range(5))
+    metrics = client.metrics()
+    assert metrics['coalesced'] == 4
+    assert metrics['queued'] == 0
+    assert 10 <= metrics['max_lag'] < 11
+    assert 6 <= metrics['last_lag'] < 7
+
+def test_pause_stays_disconnected(monkeypatch):
+    client, namespace = make_client(monkeypatch)
+    socketIO = client.socketIO
+
+    async def scenario():
+        # let the transport thread start waiting
+        await asyncio.sleep(0.1)
+        handler = namespace.on_broadcast
+        for i in range(3):
+            client._enqueue('broadcast', handler, ({'i': i},), time.time())
+        client.handle_message('pause-script')
+        await until(lambda: client._closed.is_set())
+        # several waits' worth
+        await asyncio.sleep(0.3)
+        assert not socketIO._opened
+        assert socketIO.sessions == 1
+        assert namespace.broadcasts == []
+        assert namespace.stopped == 1
+        assert client.metrics()['dropped'] == 3
+
+        client.handle_message('continue-script')
+        assert socketIO._opened and socketIO.sessions == 2
+        client._enqueue('broadcast', handler, ({'i': 3},), time.time())
+        await until(lambda: client.broadcasts == 1)
+    run_with(client, scenario)
+    assert [data['i'] for data, received_at, control in
+            namespace.broadcasts] == [3]
+
+def test_stop_drops_queued_broadcasts(monkeypatch):
+    client, namespace = make_client(monkeypatch)
+
+    async def scenario():
+        handler = namespace.on_broadcast
+        client._enqueue('broadcast', handler, ({'i': 0},), time.time())
+        client.handle_message('stop-script')
+        client._enqueue('broadcast', handler, ({'i': 1},), time.time())
+        await until(lambda: client._closed.is_set())
+        await asyncio.sleep(0.1)
+    run_with(client, scenario)
+    assert namespace.broadcasts == []
+    assert client.metrics()['dropped'] == 2
+    assert client.socketIO.sessions == 1
@@ -0,0 +1,66 @@
+import os
+import sys
+import subprocess
+import numpy as np
+
+import binstore
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))), 'template')
+HEADER = 'Experiment: test vial 0, Mon Jan  4 10:00:00 2021'
+
+def make_experiment(tmp_path, rows):
+    od_dir = tmp_path / 'data' / 'OD'
+    od_dir.mkdir(parents=True)
+    text_file = od_dir / 'vial0_OD.txt'
+    # as initialize_exp leaves it when the experiment writes binary only
+    text_file.write_text(HEADER + '\n')
+    binstore.append_rows(binstore.binary_path(str(text_file)), rows[:5])
+    binstore.append_rows(binstore.binary_path(str(text_file)), rows[5:])
+    return tmp_path / 'data', text_file
+
+def run_binstore(*args):
+    return subprocess.run([sys.executable,
+                           os.path.join(TEMPLATE_DIR, 'binstore.py')] +
+                          [str(arg) for arg in args],
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          universal_newlines=True, timeout=60)
+
+def test_round_trip(tmp_path):
+    rows = np.column_stack([np.arange(12) / 60.0,
+                            np.linspace(0.1, 0.9, 12)])
+    exp_dir, text_file = make_experiment(tmp_path, rows)
+    bin_path = binstore.binary_path(str(text_file))
+
+    assert np.array_equal(binstore.load(bin_path), rows)
+    assert np.array_equal(binstore.load(bin_path, mmap=False), rows)
+    assert np.array_equal(binstore.load_tail(bin_path, 4), rows[-4:])
+
+    result = run_binstore('to-text', exp_dir)
+    assert result.returncode == 0, result.stdout
+    assert 'Converted 1 files' in result.stdout
+    # the header written when the experiment started is kept
+    assert text_file.read_text().splitlines()[0] == HEADER
+    assert np.array_equal(binstore.read_text_rows(str(text_file)), rows)
+
+    # and back again
+    os.remove(bin_path)
+    assert binstore.convert(str(exp_dir), to_binary=True) == (1, [])
+    assert np.array_equal(binstore.load(bin_path), rows)
+
+def test_refuses_to_overwrite(tmp_path):
+    rows = np.column_stack([np.arange(6.0), np.ones(6)])
+    exp_dir, text_file = make_experiment(tmp_path, rows)
+    text_file.write_text(HEADER + '\n0.0,0.5\n')
+
+    result = run_binstore('to-text', exp_dir)
+    assert result.returncode == 1
+    assert 'use --force' in result.stdout
+    assert text_file.read_text() == HEADER + '\n0.0,0.5\n'
+    bin_path = binstore.binary_path(str(text_file))
+    assert binstore.convert(str(exp_dir), to_binary=True) == (0, [bin_path])
+
+    result = run_binstore('to-text', exp_dir, '--force')
+    assert result.returncode == 0, result.stdout
+    assert text_file.read_text().splitlines()[0] == HEADER
+    assert np.array_equal(binstore.read_text_rows(str(text_file)), rows)
@@ -0,0 +1,86 @@
+import json
+import numpy as np
+import pytest
+
+from benchmark_transform import make_fits, legacy_transform, N_VIALS
+from calibrations import Calibration, CalibrationStore, SIGMOID, CONSTANT
+
+def readings(seed=0):
+    rng = np.random.default_rng(seed)
+    # some below the sigmoid's lower asymptote, which have no OD
+    od_data = rng.uniform(1000, 60000, N_VIALS)
+    od_data[3] = 1200
+    od_data_2 = rng.uniform(20000, 60000, N_VIALS)
+    temp_data = rng.uniform(1500, 2500, N_VIALS)
+    return od_data, od_data_2, temp_data
+
+@pytest.mark.parametrize('fit', [0, 1])
+def test_od_fits_match_per_vial_formulas(fit):
+    od_cal = make_fits()[fit]
+    temp_cal = make_fits()[2]
+    for seed in range(5):
+        od_data, od_data_2, temp_data = readings(seed)
+        with np.errstate(all='ignore'):
+            expected_od, expected_temp = legacy_transform(
+                od_cal, temp_cal, od_data, od_data_2, temp_data)
+        od = Calibration(od_cal).apply(od_data, od_data_2)
+        np.testing.assert_allclose(od, expected_od, rtol=1e-12)
+        temp = Calibration(temp_cal).apply(temp_data)
+        np.testing.assert_allclose(temp, expected_temp, rtol=1e-12)
+    if od_cal['type'] == SIGMOID:
+        assert np.isnan(od[3])
+
+def test_linear_invert():
+    calibration = Calibration(make_fits()[2])
+    raw = np.array([1800.0] * N_VIALS)
+    np.testing.assert_allclose(calibration.invert(calibration.apply(raw)),
+                               raw)
+
+def test_sigmoid_invert():
+    calibration = Calibration(make_fits()[0])
+    raw = np.linspace(2000, 60000, N_VIALS)
+    od = calibration.apply(raw)
+    np.testing.assert_allclose(calibration.invert(od), raw, rtol=1e-9)
+
+def test_sigmoid_invert_nan_and_out_of_range():
+    fit = make_fits()[0]
+    fit['coefficients'] = list(fit['coefficients'])
+    fit['coefficients'][2] = ['bad']
+    calibration = Calibration(fit)
+    od = np.full(N_VIALS, 0.5)
+    od[0] = np.nan
+    # far beyond either asymptote
+    od[1] = 1e6
+    od[4] = -1e6
+    raw = calibration.invert(od)
+    assert np.isnan(raw[0])
+    # malformed coefficients
+    assert np.isnan(raw[2])
+    c = calibration.coefficients[1]
+    lower, upper = sorted(c[:2])
+    finite = np.isfinite(raw)
+    assert ((raw[finite] >= lower) & (raw[finite] <= upper)).all()
+    assert np.isfinite(raw[[1, 4]]).all()
+
+def test_3d_and_constant_cannot_be_inverted():
+    with pytest.raises(ValueError):
+        Calibration(make_fits()[1]).invert(np.zeros(N_VIALS))
+    with pytest.raises(ValueError):
+        Calibration({'type': CONSTANT, 'params': ['pump'],
+                     'coefficients': [1.0] * N_VIALS}).invert([1.0])
+
+def test_constant_fits_only_give_flow_rates(tmp_path):
+    constant = {'type': CONSTANT, 'params': ['pump'],
+                'coefficients': [1.1] * N_VIALS}
+    with pytest.raises(ValueError):
+        Calibration(constant).apply(np.zeros(N_VIALS))
+
+    store = CalibrationStore({'od': str(tmp_path / 'od_cal.json'),
+                              'pump': str(tmp_path / 'pump_cal.json')})
+    store.set('pump', constant)
+    np.testing.assert_array_equal(store.flow_rate(), [1.1] * N_VIALS)
+    # not a way to convert ODs
+    store.set('od', dict(constant, params=['od_135']))
+    assert store.get('od') is None
+    with open(str(tmp_path / 'od_cal.json')) as f:
+        assert json.load(f)['type'] == CONSTANT
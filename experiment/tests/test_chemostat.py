@@ -0,0 +1,39 @@
+import argparse
+import numpy as np
+
+import benchmark_chemostat
+from geometry import DeviceGeometry
+from chemostat import ChemostatEngine
+from statestore import parse_row
+
+def options(**kw):
+    defaults = dict(broadcasts=1500, vials=16, step=20, window=6,
+                    change_every=200, noise=0.005, seed=0)
+    defaults.update(kw)
+    return argparse.Namespace(**defaults)
+
+def test_engine_matches_per_vial_loop():
+    assert benchmark_chemostat.run(options()) is None
+
+def test_engine_matches_per_vial_loop_large_box():
+    assert benchmark_chemostat.run(options(vials=48, window=3,
+                                           seed=1)) is None
+
+def test_engine_records_plain_int_vials():
+    # the vials of records end up in the checkpoint, which is JSON
+    geometry = DeviceGeometry(4)
+    controller = benchmark_chemostat.Controller(geometry)
+    for x in geometry.vials:
+        controller.state._last[('chemo_config', x)] = parse_row('0,0,0')
+        controller.state._count[('chemo_config', x)] = 2
+    for i in range(6):
+        controller.buffers['OD'].append(i / 180, np.full(4, 0.5))
+    engine = ChemostatEngine(geometry)
+    bolus_in_s, period_config = engine.run(
+        controller, np.arange(4), 0.1, geometry.per_vial(0.5),
+        geometry.per_vial(1.0), geometry.zeros(), geometry.zeros(),
+        benchmark_chemostat.BOLUS, benchmark_chemostat.VOLUME)
+    assert (period_config > 0).all()
+    assert len(controller.state.appends) == 4
+    assert all(type(vial) is int
+               for parameter, vial, line in controller.state.appends)
@@ -0,0 +1,67 @@
+from commands import CommandBatcher, KEEP
+
+def command(param, value, recurring=True, immediate=False):
+    return {'param': param, 'value': value, 'recurring': recurring,
+            'immediate': immediate}
+
+def batcher():
+    sent = []
+    return CommandBatcher(sent.append), sent
+
+def test_sends_right_away_outside_a_broadcast():
+    commands, sent = batcher()
+    commands.submit(command('stir', ['8', '8']))
+    assert sent == [command('stir', ['8', '8'])]
+
+def test_merges_commands_for_the_same_parameter():
+    commands, sent = batcher()
+    commands.begin()
+    commands.submit(command('temp', ['2000', KEEP, KEEP]))
+    commands.submit(command('temp', [KEEP, '2100', KEEP], immediate=True))
+    commands.submit(command('temp', [KEEP, '2200', KEEP]))
+    assert sent == []
+    commands.flush()
+    assert sent == [command('temp', ['2000', '2200', KEEP], immediate=True)]
+    assert commands.metrics() == {'sent': 1, 'merged': 2, 'dropped': 0}
+
+def test_drops_recurring_commands_the_server_runs():
+    commands, sent = batcher()
+    commands.begin({'stir': {'value': ['8', '8']},
+                    'temp': {'value': ['2000', '2000']}})
+    commands.submit(command('stir', [8, KEEP]))
+    commands.submit(command('temp', ['2000', '2100']))
+    commands.flush()
+    assert sent == [command('temp', ['2000', '2100'])]
+    assert commands.dropped == 1
+
+def test_pumps_go_first():
+    commands, sent = batcher()
+    commands.begin()
+    commands.submit(command('stir', ['8', '8']))
+    commands.submit(command('pump', ['5', KEEP], recurring=False))
+    commands.flush()
+    assert [c['param'] for c in sent] == ['pump', 'stir']
+
+def test_keeps_one_off_and_recurring_pumps_apart():
+    # e.g. turbidostat and chemostat vial groups in the same broadcast
+    commands, sent = batcher()
+    commands.begin({'pump': {'value': ['--', '--', '--', '--']}})
+    commands.submit(command('pump', ['10.5', KEEP, '15.5', KEEP],
+                            recurring=False))
+    commands.submit(command('pump', [KEEP, '0.50|720', KEEP, '1.00|720']))
+    commands.flush()
+    assert sent == [
+        command('pump', ['10.5', KEEP, '15.5', KEEP], recurring=False),
+        command('pump', [KEEP, '0.50|720', KEEP, '1.00|720'])]
+
+def test_send_now_drops_collected_commands():
+    commands, sent = batcher()
+    commands.begin()
+    commands.submit(command('pump', ['5', '5'], recurring=False))
+    commands.submit(command('stir', ['8', '8']))
+    commands.send_now(command('pump', ['0', '0'], recurring=False,
+                              immediate=True))
+    commands.flush()
+    assert sent == [command('pump', ['0', '0'], recurring=False,
+                            immediate=True),
+                    command('stir', ['8', '8'])]
@@ -0,0 +1,73 @@
+import numpy as np
+from scipy import stats
+
+from growthrate import GrowthRateEstimator
+
+def curves(n_vials=4, n=400, seed=0):
+    rng = np.random.default_rng(seed)
+    times = np.round(np.arange(n) * 20 / 3600, 4)
+    rates = rng.uniform(0.3, 1.2, n_vials)
+    od = 0.05 * np.exp(np.outer(times, rates))
+    od *= np.exp(rng.normal(0, 0.02, od.shape))
+    # failed readings and a blank gone wrong
+    od[rng.random(od.shape) < 0.02] = np.nan
+    od[rng.random(od.shape) < 0.005] = -0.01
+    return times, od
+
+def expected(times, od, start, end):
+    # what the former code fit: the log ODs read after start
+    y = np.log(od[(times > start) & (times <= end)])
+    t = times[(times > start) & (times <= end)]
+    finite = np.isfinite(y)
+    return stats.linregress(t[finite], y[finite])
+
+def assert_fit(estimator, vial, fit):
+    slope, intercept, r_value, std_err = estimator.result(vial)
+    np.testing.assert_allclose([slope, intercept, r_value, std_err],
+                               [fit.slope, fit.intercept, fit.rvalue,
+                                fit.stderr], rtol=1e-9, atol=1e-12)
+
+def test_matches_linregress_over_each_growth_curve():
+    times, od = curves()
+    estimator = GrowthRateEstimator(od.shape[1])
+    starts = np.zeros(od.shape[1])
+    for vial in range(od.shape[1]):
+        estimator.reset(vial, 0)
+    with np.errstate(invalid='ignore'):
+        for i, elapsed_time in enumerate(times):
+            estimator.add(elapsed_time, od[i])
+            if i % 37 != 36:
+                continue
+            for vial in range(od.shape[1]):
+                assert_fit(estimator, vial, expected(
+                    times, od[:, vial], starts[vial], elapsed_time))
+            # a new curve starts in one of the vials
+            vial = (i // 37) % od.shape[1]
+            starts[vial] = elapsed_time
+            estimator.reset(vial, elapsed_time)
+
+def test_extend_matches_linregress():
+    times, od = curves(n_vials=1, seed=1)
+    with np.errstate(invalid='ignore'):
+        for split in (0, 1, 150, 399):
+            estimator = GrowthRateEstimator(1)
+            estimator.reset(0, times[20])
+            # resumed: the curve so far from the file, then live readings
+            estimator.extend(0, times[:split], od[:split, 0])
+            for i in range(split, len(times)):
+                estimator.add(times[i], od[i])
+            assert_fit(estimator, 0, expected(times, od[:, 0], times[20],
+                                              times[-1]))
+
+def test_snapshot_round_trip():
+    times, od = curves(n_vials=2, n=50)
+    estimator = GrowthRateEstimator(2)
+    estimator.reset(0, 0)
+    estimator.reset(1, 0)
+    with np.errstate(invalid='ignore'):
+        for i, elapsed_time in enumerate(times):
+            estimator.add(elapsed_time, od[i])
+    restored = GrowthRateEstimator(2)
+    restored.restore(estimator.snapshot())
+    for vial in range(2):
+        assert restored.result(vial) == estimator.result(vial)
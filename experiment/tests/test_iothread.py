@@ -0,0 +1,77 @@
+import threading
+import pytest
+
+from iothread import IOThread, DROP
+from datawriter import DataWriter
+
+def test_close_runs_every_queued_job():
+    io = IOThread(maxsize=4)
+    gate = threading.Event()
+    done = []
+    io.submit(gate.wait)
+    for i in range(4):
+        io.submit(done.append, i)
+    # all queued behind the blocked job
+    assert done == []
+    gate.set()
+    io.close()
+    assert done == [0, 1, 2, 3]
+    assert io.metrics()['completed'] == 5
+    assert not io._thread.is_alive()
+    with pytest.raises(RuntimeError):
+        io.submit(done.append, 4)
+
+def test_close_runs_queued_jobs_with_drop_policy():
+    io = IOThread(maxsize=1, policy=DROP)
+    started = threading.Event()
+    gate = threading.Event()
+    done = []
+
+    def blocked():
+        started.set()
+        gate.wait()
+    io.submit(blocked)
+    started.wait(5)
+    assert io.submit(done.append, 0)
+    assert not io.submit(done.append, 1)
+    # the sentinel waits for room instead of being dropped
+    closer = threading.Thread(target=io.close)
+    closer.start()
+    gate.set()
+    closer.join(5)
+    assert done == [0]
+    assert not io._thread.is_alive()
+
+def fail(message):
+    raise OSError(message)
+
+def test_drain_raises_failed_jobs():
+    io = IOThread()
+    done = []
+    io.submit(fail, 'disk full')
+    io.submit(done.append, 1)
+    with pytest.raises(OSError, match='disk full'):
+        io.drain()
+    # later jobs still ran, and the error is raised only once
+    assert done == [1]
+    assert io.metrics()['failed'] == 1
+    io.drain()
+
+    io.submit(fail, 'read-only file system')
+    with pytest.raises(OSError, match='read-only'):
+        io.close()
+
+def test_writer_close_surfaces_failed_writes(tmp_path, monkeypatch):
+    io = IOThread()
+    writer = DataWriter(io=io)
+    path = str(tmp_path / 'vial0_OD.txt')
+    writer.write(path, '0,0.1\n')
+
+    def failing_write(batch, fsync):
+        raise OSError('disk full')
+    monkeypatch.setattr(writer, '_write_batch', failing_write)
+    with pytest.raises(OSError, match='disk full'):
+        writer.close()
+    # the files are closed anyway
+    assert writer._files == {}
+    io.close()
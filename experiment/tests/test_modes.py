@@ -0,0 +1,39 @@
+from eVOLVER import EvolverNamespace
+from geometry import DeviceGeometry
+from harness import Link, load_test_script
+from modes import VialConfig, group_vials
+
+def params(functions, mode='turbidostat'):
+    return {'function': mode,
+            'vial_configuration': [{'function': f} if f else {}
+                                   for f in functions]}
+
+def test_group_vials():
+    assert group_vials(range(4), [None, 'chemostat', '', 'chemostat'],
+                       'turbidostat') == [('turbidostat', [0, 2]),
+                                          ('chemostat', [1, 3])]
+    assert group_vials(range(2), None, 'growthcurve') == [
+        ('growthcurve', [0, 1])]
+
+def test_overrides_win_over_the_parameters_file():
+    config = VialConfig(params([None, 'chemostat', 'chemostat', None]),
+                        DeviceGeometry(4))
+    assert config.groups(range(4), 'growthcurve') == [
+        ('turbidostat', [0, 3]), ('chemostat', [1, 2])]
+    overrides = [None, None, 'growthcurve', 'pulse']
+    assert config.groups(range(4), 'growthcurve', overrides) == [
+        ('turbidostat', [0]), ('chemostat', [1]), ('growthcurve', [2]),
+        ('pulse', [3])]
+
+def test_mode_groups_of_the_script_win(tmp_path):
+    script = load_test_script(MODE_GROUPS={'chemostat': [8, 9, 10, 11]})
+    namespace = EvolverNamespace(Link(), '/dpu-evolver')
+    namespace.configure(str(tmp_path), script)
+    vials = namespace.geometry.vials
+    assert namespace.mode_groups(vials) == [
+        ('turbidostat', vials[:8] + vials[12:]), ('chemostat', vials[8:12])]
+
+    namespace.vial_config = VialConfig(params(['growthcurve'] * 16),
+                                       namespace.geometry)
+    assert namespace.mode_groups(vials) == [
+        ('growthcurve', vials[:8] + vials[12:]), ('chemostat', vials[8:12])]
@@ -0,0 +1,65 @@
+import numpy as np
+
+from harness import load_test_script, simulated_evolver, start, run
+
+def records(namespace, parameter):
+    return [(namespace.state.count(parameter, x),
+             namespace.state.last(parameter, x).tolist())
+            for x in namespace.geometry.vials]
+
+def file_records(namespace, parameter):
+    rows = []
+    for x in namespace.geometry.vials:
+        with open(namespace.state.path(parameter, x)) as f:
+            lines = [l for l in f.read().splitlines() if l.strip()]
+        last = [float(v) for v in lines[-1].split(',')]
+        rows.append((len(lines), last))
+    return rows
+
+def test_turbidostat_resumes_from_checkpoint(tmp_path):
+    script = load_test_script(OPERATION_MODE='turbidostat')
+    # starts above upper, to end a growth curve and dilute right away
+    evolver = simulated_evolver(script, od=0.5)
+    namespace = start(tmp_path, script, evolver)
+    run(namespace, evolver, 300)
+    namespace.writer.close()
+    dilutions = sum(count - 2 for count, last in
+                    records(namespace, 'pump_log'))
+    assert dilutions > 0
+    saved = records(namespace, 'ODset'), records(namespace, 'pump_log')
+
+    state = namespace.checkpoint.load()
+    assert state is not None and state['records']
+    assert all(type(entry[1]) is int for entry in state['records'])
+
+    resumed = start(tmp_path, script, evolver)
+    assert resumed.start_time == namespace.start_time
+    assert (records(resumed, 'ODset'), records(resumed, 'pump_log')) == saved
+    assert records(resumed, 'ODset') == file_records(resumed, 'ODset')
+    np.testing.assert_array_equal(resumed.OD_initial, namespace.OD_initial)
+
+    # and keeps controlling where the first run left off
+    run(resumed, evolver, 100)
+    resumed.writer.close()
+    assert records(resumed, 'pump_log') == file_records(resumed, 'pump_log')
+    assert resumed.checkpoint.load() is not None
+
+def test_chemostat_resumes_from_checkpoint(tmp_path):
+    script = load_test_script(OPERATION_MODE='chemostat')
+    evolver = simulated_evolver(script, od=0.3)
+    namespace = start(tmp_path, script, evolver)
+    run(namespace, evolver, 50)
+    namespace.writer.close()
+    saved = records(namespace, 'chemo_config')
+    assert all(count == 3 for count, last in saved)
+
+    state = namespace.checkpoint.load()
+    assert state is not None
+    assert all(type(entry[1]) is int for entry in state['records'])
+
+    resumed = start(tmp_path, script, evolver)
+    assert records(resumed, 'chemo_config') == saved
+    run(resumed, evolver, 20)
+    resumed.writer.close()
+    # same rates, no new records
+    assert records(resumed, 'chemo_config') == saved
@@ -0,0 +1,71 @@
+import numpy as np
+
+from ringbuffer import VialRingBuffer
+from rollingstats import (RollingMedian, RollingMoments, HampelFilter,
+                          hampel, rolling_mean)
+
+def readings(n, seed=0, nan_fraction=0.05):
+    rng = np.random.default_rng(seed)
+    values = np.round(rng.normal(0.3, 0.05, n), 3)
+    values[rng.random(n) < nan_fraction] = np.nan
+    return values
+
+def test_rolling_median_matches_numpy():
+    values = readings(2000)
+    for window in (1, 2, 6, 25):
+        median = RollingMedian(window)
+        for i, value in enumerate(values):
+            median.push(value)
+            last = values[max(i - window + 1, 0):i + 1]
+            np.testing.assert_equal(median.median(), np.median(last))
+            if not np.isnan(last).all():
+                np.testing.assert_equal(median.median(skipna=True),
+                                        np.nanmedian(last))
+
+def test_rolling_moments_match_numpy():
+    values = readings(1000, seed=1)
+    moments = RollingMoments(20)
+    for i, value in enumerate(values):
+        moments.push(value)
+        last = values[max(i - 19, 0):i + 1]
+        last = last[~np.isnan(last)]
+        if len(last) > 1:
+            np.testing.assert_allclose(moments.mean(), np.mean(last))
+            np.testing.assert_allclose(moments.var(), np.var(last),
+                                       atol=1e-12)
+
+def test_hampel_filter_replaces_outliers():
+    values = readings(200, seed=2, nan_fraction=0)
+    values[[50, 120]] = [5.0, -1.0]
+    hampel_filter = HampelFilter(9)
+    outliers = [i for i, value in enumerate(values)
+                if hampel_filter.push(value)[1]]
+    assert {50, 120} <= set(outliers)
+    filtered = hampel(values, 9)
+    assert abs(filtered[50] - 0.3) < 0.2 and abs(filtered[120] - 0.3) < 0.2
+    # the median of the filtered values ignores the spikes
+    np.testing.assert_equal(hampel_filter.median(),
+                            np.median(filtered[-9:]))
+
+def test_buffer_median_without_outliers():
+    buffer = VialRingBuffer(2, 32)
+    values = readings(40, seed=3, nan_fraction=0)
+    for value in values:
+        buffer.append(0, [value, value])
+        buffer.median([0, 1], 3, n_sigmas=3)
+    # two bad readings in a row on vial 0
+    buffer.append(0, [50.0, 0.3])
+    buffer.append(0, [50.0, 0.3])
+    medians, enough = buffer.median([0, 1], 3)
+    assert medians[0] == 50.0
+    filtered, enough = buffer.median([0, 1], 3, n_sigmas=3)
+    assert enough.all()
+    assert abs(filtered[0] - np.median(values[-3:])) < 0.1
+
+def test_rolling_mean_matches_slide_mean():
+    # the loop of the graphing view it replaces
+    values = readings(300, seed=4)
+    wsize = 5
+    slide_mean = [np.nanmean(values[max(i - wsize, 0):i + 1])
+                  for i in range(len(values))]
+    np.testing.assert_allclose(rolling_mean(values, wsize + 1), slide_mean)
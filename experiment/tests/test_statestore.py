@@ -0,0 +1,121 @@
+import os
+import numpy as np
+import pytest
+
+import custom_script
+from eVOLVER import EvolverNamespace
+from harness import Link
+from checkpoint import Checkpoint
+from datawriter import DataWriter
+from statestore import StateStore
+
+class DroppingIO:
+    """
+    IOThread whose queue is always full.
+    """
+
+    def submit(self, func, *args):
+        return False
+
+    def drain(self):
+        pass
+
+def make_store(tmp_path, writer, vials=(0, 1)):
+    for parameter in ('ODset', 'pump_log'):
+        os.makedirs(os.path.join(str(tmp_path), parameter), exist_ok=True)
+        for x in vials:
+            with open(os.path.join(str(tmp_path), parameter,
+                                   'vial{0}_{1}.txt'.format(x, parameter)),
+                      'w') as f:
+                f.write('Experiment: test vial {0}, {1}\n0,0\n'.format(
+                    x, parameter))
+    return StateStore(str(tmp_path), writer)
+
+def checkpoint_records(store, tmp_path):
+    # what save_variables/load_variables do with the records
+    checkpoint = Checkpoint(os.path.join(str(tmp_path), 'test.checkpoint'),
+                            fsync=False)
+    records = store.add_sizes(store.snapshot())
+    checkpoint.save({'records': records})
+    return Checkpoint(checkpoint.path).load()['records']
+
+def file_rows(store, parameter, vial):
+    with open(store.path(parameter, vial)) as f:
+        return [line for line in f.read().splitlines() if line.strip()]
+
+def test_round_trip(tmp_path):
+    writer = DataWriter()
+    store = make_store(tmp_path, writer)
+    store.append('ODset', 0, 1.5, 0.4)
+    store.append('ODset', 1, 2.0, 0.2)
+    store.append('ODset', 1, 2.5, 0.4)
+    writer.flush()
+    records = checkpoint_records(store, tmp_path)
+
+    restored = StateStore(str(tmp_path), DataWriter())
+    assert restored.restore(records) == 2
+    assert restored.count('ODset', 0) == 3
+    assert restored.count('ODset', 1) == 4
+    np.testing.assert_array_equal(restored.last('ODset', 1), [2.5, 0.4])
+
+def test_restore_reads_rows_written_after_the_checkpoint(tmp_path):
+    writer = DataWriter()
+    store = make_store(tmp_path, writer)
+    store.append('ODset', 0, 1.5, 0.4)
+    writer.flush()
+    records = checkpoint_records(store, tmp_path)
+    store.append('ODset', 0, 3.0, 0.2)
+    writer.flush()
+
+    restored = StateStore(str(tmp_path), DataWriter())
+    restored.restore(records)
+    assert restored.count('ODset', 0) == len(file_rows(store, 'ODset', 0))
+    np.testing.assert_array_equal(restored.last('ODset', 0), [3.0, 0.2])
+
+def test_pending_rows_are_not_checkpointed(tmp_path):
+    # rows queued until the next flush are not in the file yet
+    writer = DataWriter(flush_interval=3600)
+    store = make_store(tmp_path, writer)
+    store.append('ODset', 0, 1.0, 0.4)
+    writer.flush()
+    store.append('ODset', 0, 2.0, 0.2)
+    writer.flush()
+    records = checkpoint_records(store, tmp_path)
+    assert records == []
+
+    writer.flush(force=True)
+    restored = StateStore(str(tmp_path), DataWriter())
+    restored.restore(records)
+    assert restored.count('ODset', 0) == len(file_rows(store, 'ODset', 0))
+    assert restored.count('ODset', 0) == 4
+
+def test_dropped_rows_are_read_again(tmp_path):
+    writer = DataWriter(io=DroppingIO())
+    store = make_store(tmp_path, writer)
+    store.append('ODset', 0, 1.0, 0.4)
+    store.append('ODset', 0, 2.0, 0.2)
+    writer.flush()
+    records = checkpoint_records(store, tmp_path)
+    assert records == []
+    assert store.count('ODset', 0) == len(file_rows(store, 'ODset', 0)) == 2
+
+    records = checkpoint_records(store, tmp_path)
+    restored = StateStore(str(tmp_path), DataWriter())
+    restored.restore(records)
+    assert restored.count('ODset', 0) == 2
+    np.testing.assert_array_equal(restored.last('ODset', 0), [0, 0])
+
+def test_checkpoint_skips_unchanged_state(tmp_path):
+    checkpoint = Checkpoint(os.path.join(str(tmp_path), 'test.checkpoint'),
+                            fsync=False)
+    assert checkpoint.load() is None
+    assert checkpoint.save({'start_time': 1.0, 'records': []})
+    assert not checkpoint.save({'start_time': 1.0, 'records': []})
+    assert Checkpoint(checkpoint.path).load()['start_time'] == 1.0
+
+def test_resume_without_checkpoint_fails(tmp_path):
+    namespace = EvolverNamespace(Link(), '/dpu-evolver')
+    namespace.configure(str(tmp_path), custom_script)
+    os.makedirs(namespace.data_dir)
+    with pytest.raises(SystemExit):
+        namespace.load_variables()
@@ -0,0 +1,103 @@
+import os
+import json
+import shutil
+import argparse
+import contextlib
+
+import eVOLVER
+import supervisor
+from supervisor import Supervisor, load_units
+from harness import Link, SCRIPT, simulated_evolver, run
+
+class FakeSocketIO(Link):
+    """
+    Connects each unit to its own simulated eVOLVER, by IP address.
+    """
+
+    evolvers = {}
+
+    def __init__(self, ip_address, port):
+        super().__init__(self.evolvers[ip_address])
+
+    def define(self, namespace_class, path):
+        return namespace_class(self, path)
+
+def make_unit_dir(tmp_path, name, **settings):
+    exp_dir = tmp_path / name
+    exp_dir.mkdir()
+    shutil.copy(SCRIPT, str(exp_dir / 'custom_script.py'))
+    with open(str(exp_dir / 'custom_script.py'), 'a') as f:
+        for key, value in settings.items():
+            f.write('\n{0} = {1!r}\n'.format(key, value))
+    return str(exp_dir)
+
+def run_options():
+    parser = argparse.ArgumentParser()
+    eVOLVER.add_run_options(parser)
+    return parser.parse_args(['-q', '-y'])
+
+def test_units_keep_separate_state(tmp_path, monkeypatch):
+    config = [{'name': 'box1', 'ip': 'box1',
+               'exp_dir': make_unit_dir(tmp_path, 'box1')},
+              {'name': 'box2', 'ip': 'box2',
+               'exp_dir': make_unit_dir(tmp_path, 'box2',
+                                        OPERATION_MODE='chemostat')}]
+    units_file = tmp_path / 'units.json'
+    units_file.write_text(json.dumps(config))
+    units = load_units(str(units_file))
+    evolvers = {}
+    monkeypatch.setattr(FakeSocketIO, 'evolvers', evolvers)
+    monkeypatch.setattr(supervisor, 'SocketIO', FakeSocketIO)
+
+    box1, box2 = units
+    supervisor_ = Supervisor(units)
+    with open(os.devnull, 'w') as devnull, \
+            contextlib.redirect_stdout(devnull):
+        for unit, od in ((box1, 0.5), (box2, 0.3)):
+            evolvers[unit.ip_address] = simulated_evolver(
+                supervisor.load_script(unit.script_path, 'script'), od=od)
+        supervisor_.start(run_options())
+    for unit in units:
+        evolver = evolvers[unit.ip_address]
+        unit.namespace.on_activecalibrations(evolver.active_calibrations())
+
+    # each unit loads its own copy of its script
+    assert box1.script is not box2.script
+    assert box1.script.OPERATION_MODE == 'turbidostat'
+    assert box2.script.OPERATION_MODE == 'chemostat'
+    assert box1.namespace.state is not box2.namespace.state
+    assert box1.namespace.writer is not box2.namespace.writer
+    assert box1.namespace.io is not box2.namespace.io
+
+    # interleaved like the event loop runs them
+    for i in range(10):
+        run(box1.namespace, evolvers['box1'], 3)
+        run(box2.namespace, evolvers['box2'], 1)
+    for unit in units:
+        unit.namespace.stop_exp()
+        unit.namespace.stop_io_thread()
+
+    for unit, broadcasts in ((box1, 30), (box2, 10)):
+        data_dir = unit.namespace.data_dir
+        assert data_dir == os.path.join(unit.exp_dir, 'data')
+        for x in unit.namespace.geometry.vials:
+            path = os.path.join(data_dir, 'OD', 'vial{0}_OD.txt'.format(x))
+            with open(path) as f:
+                lines = f.read().splitlines()
+            # the header, then this unit's readings only
+            assert len(lines) == broadcasts + 1
+            assert 'vial {0}'.format(x) in lines[0]
+        assert os.path.exists(unit.namespace.checkpoint.path)
+        assert os.path.dirname(unit.namespace.checkpoint.path) == data_dir
+
+    # turbidostat dilutions on box1, chemostat settings only on box2
+    assert any(box1.namespace.state.count('pump_log', x) > 1
+               for x in box1.namespace.geometry.vials)
+    assert all(box1.namespace.state.count('chemo_config', x) == 2
+               for x in box1.namespace.geometry.vials)
+    assert any(box2.namespace.state.count('chemo_config', x) > 2
+               for x in box2.namespace.geometry.vials)
+
+    # and show up separately in the metrics
+    metrics = supervisor_.prometheus()
+    assert 'unit="box1"' in metrics and 'unit="box2"' in metrics
@@ -0,0 +1,57 @@
+import os
+import sys
+import subprocess
+
+from harness import load_test_script, simulated_evolver, STEP
+from recording import BroadcastRecorder, BROADCAST, CALIBRATIONS
+
+EXPERIMENT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+def run_tool(name, *args):
+    return subprocess.run([sys.executable,
+                           os.path.join(EXPERIMENT_DIR, name)] +
+                          [str(arg) for arg in args],
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          universal_newlines=True, timeout=300)
+
+def record(path, broadcasts):
+    evolver = simulated_evolver(load_test_script(), od=0.3)
+    recorder = BroadcastRecorder(str(path))
+    received_at = 1.6e9
+    recorder.write(recorder.encode(CALIBRATIONS,
+                                   evolver.active_calibrations(),
+                                   received_at))
+    for i in range(broadcasts):
+        received_at += STEP
+        recorder.write(recorder.encode(BROADCAST, evolver.broadcast(STEP),
+                                       received_at))
+    recorder.close()
+
+def test_replay(tmp_path):
+    recording = tmp_path / 'broadcasts.jsonl.gz'
+    commands = tmp_path / 'commands.jsonl'
+    record(recording, 100)
+    result = run_tool('replay.py', recording, '--save-commands', commands)
+    assert result.returncode == 0, result.stdout
+    assert '100 broadcasts in' in result.stdout
+    assert commands.read_text()
+
+    # the same recording makes the same decisions
+    result = run_tool('replay.py', recording, '--expect-commands', commands,
+                      '--min-rate', 1, '--max-p95', 'total=10')
+    assert result.returncode == 0, result.stdout
+
+def test_backtest(tmp_path):
+    output = tmp_path / 'results.csv'
+    result = run_tool('backtest.py', '--hours', 1, '--settle', 0.2,
+                      '-j', 1, '--grid', 'lower=0.2,0.3', '-o', output)
+    assert result.returncode == 0, result.stdout
+    rows = output.read_text().splitlines()
+    assert rows[0].startswith('lower,dilutions')
+    assert len(rows) == 3
+
+def test_backtest_chemostat():
+    result = run_tool('backtest.py', '--mode', 'chemostat', '--hours', 1,
+                      '-j', 1, '--grid', 'rate=0.5')
+    assert result.returncode == 0, result.stdout
+    assert 'rate=0.5' in result.stdout
@@ -0,0 +1,33 @@
+import argparse
+import numpy as np
+
+import benchmark_turbidostat
+from geometry import DeviceGeometry
+
+def options(**kw):
+    defaults = dict(broadcasts=1500, vials=16, step=20, window=6,
+                    pump_wait=3, noise=0.005, seed=0)
+    defaults.update(kw)
+    return argparse.Namespace(**defaults)
+
+def test_engine_matches_per_vial_loop():
+    assert benchmark_turbidostat.run(options()) is None
+
+def test_engine_matches_per_vial_loop_large_box():
+    assert benchmark_turbidostat.run(options(vials=48, window=3,
+                                             seed=1)) is None
+
+def test_engine_records_plain_int_vials():
+    # the vials of records end up in the checkpoint, which is JSON
+    geometry = DeviceGeometry(4)
+    controller = benchmark_turbidostat.Controller(geometry)
+    for i in range(6):
+        controller.buffers['OD'].append(i / 180, np.full(4, 0.5))
+    message = controller.turbidostat.run(
+        controller, np.arange(4), 0.1, geometry.per_vial(0.2),
+        geometry.per_vial(0.4), geometry.per_vial(1.0), 25)
+    assert message is not None
+    assert {parameter for parameter, vial, line in
+            controller.state.appends} == {'ODset', 'pump_log'}
+    assert all(type(vial) is int
+               for parameter, vial, line in controller.state.appends)
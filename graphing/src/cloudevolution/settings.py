@@ -12,9 +12,17 @@ https://docs.djangoproject.com/en/1.8/ref/settings/
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
+import sys
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# the DPU's experiment modules, the views share rollingstats.py with the
+# experiment scripts
+EVOLVER_TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(BASE_DIR)),
+                                    'experiment', 'template')
+if EVOLVER_TEMPLATE_DIR not in sys.path:
+    sys.path.append(EVOLVER_TEMPLATE_DIR)
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/1.8/howto/deployment/checklist/
@@ -8,6 +8,9 @@ import itertools
 import os
 import time
 import math
+# from experiment/template, see EVOLVER_TEMPLATE_DIR in settings.py
+from rollingstats import rolling_mean
+import binstore
 
 # Create your views here.
 def home(request):
@@ -33,10 +36,10 @@ def simple_chart(request):
 
 def vial_num(request, experiment, vial):
 	sidebar_links, subdir_log = file_scan('expt')
-	vial_count = range(0, 16)
 	expt_dir, expt_subdir = file_scan(experiment)
 	rootdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 	evolver_dir = os.path.join(rootdir, 'experiment')
+	vial_count = vial_range(os.path.join(evolver_dir, expt_subdir[0], experiment))
 	OD_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "OD", "vial{0}_OD.txt".format(vial))
 	gr_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "growthrate", "vial{0}_gr.txt".format(vial))
 	temp_dir = os.path.join(evolver_dir, expt_subdir[0], experiment, "temp", "vial{0}_temp.txt".format(vial))
@@ -45,12 +48,9 @@ def vial_num(request, experiment, vial):
 	OD PLOT
 	"""
 
-	with open(OD_dir) as f_in:
-		data = np.genfromtxt(itertools.islice(f_in, 0, None, 5), delimiter=',')
-	if len(data) < 1000:
-		data = np.genfromtxt(OD_dir, delimiter=',')
+	data, OD_file = read_series(OD_dir, 5)
 
-	last_OD_update = time.ctime(os.path.getmtime(OD_dir))
+	last_OD_update = time.ctime(os.path.getmtime(OD_file))
 
 	p = figure(plot_width=700, plot_height=400)
 	p.y_range = Range1d(-.05, 2)
@@ -85,16 +85,10 @@ def vial_num(request, experiment, vial):
 	# p.line(gr_data[:, 0], math.log(2) / gr_data[:, 1], legend="growth rate")  # Generation time
 
 	# Sliding window for average growth rate calculation
-	slide_mean = []
 	wsize = 10  # Customize window size to calculate the mean
-	for i in range(0, len(gr_data[:, 1])):
-		if i - wsize < 0:
-			j = 0  # Allows plotting first incomplete windows
-		else:
-			j = i - wsize
-
-		slide_mean.append(np.nanmean(gr_data[j:i+1, 1]))  # Growth rate
-		# slide_mean.append(np.nanmean(math.log(2) / gr_data[j:i+1, 1]))  # Generation time
+	# mean of each value and the wsize before it, first incomplete windows included
+	slide_mean = rolling_mean(gr_data[:, 1], wsize + 1)  # Growth rate
+	# slide_mean = rolling_mean(math.log(2) / gr_data[:, 1], wsize + 1)  # Generation time
 
 	p.line(gr_data[:, 0], slide_mean, legend="{0} values mean".format(wsize), line_width=1, line_color="red")
 
@@ -106,12 +100,9 @@ def vial_num(request, experiment, vial):
 	TEMPERATURE PLOT
 	"""
 
-	with open(temp_dir) as f_in:
-		data = np.genfromtxt(itertools.islice(f_in, 0, None, 10), delimiter=',')
-	if len(data) < 1000:
-		data = np.genfromtxt(temp_dir, delimiter=',')
+	data, temp_file = read_series(temp_dir, 10)
 
-	last_temp_update = time.ctime(os.path.getmtime(temp_dir))
+	last_temp_update = time.ctime(os.path.getmtime(temp_file))
 
 	p = figure(plot_width=700, plot_height=400)
 	p.y_range = Range1d(25, 45)
@@ -142,7 +133,10 @@ def vial_num(request, experiment, vial):
 
 def expt_name(request, experiment):
 	sidebar_links, subdir_log = file_scan('expt')
-	vial_count = range(0, 16)
+	expt_dir, expt_subdir = file_scan(experiment)
+	rootdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+	evolver_dir = os.path.join(rootdir, 'experiment')
+	vial_count = vial_range(os.path.join(evolver_dir, expt_subdir[0], experiment))
 
 	context = {
 		"sidebar_links": sidebar_links,
@@ -155,10 +149,10 @@ def expt_name(request, experiment):
 
 def dilutions(request, experiment):
 	sidebar_links, subdir_log = file_scan('expt')
-	vial_count = range(0, 16)
 	expt_dir, expt_subdir = file_scan(experiment)
 	rootdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 	evolver_dir = os.path.join(rootdir, 'experiment')
+	vial_count = vial_range(os.path.join(evolver_dir, expt_subdir[0], experiment))
 	pump_cal = os.path.join(evolver_dir, expt_subdir[0], "pump_cal.txt")
 
 	cal = np.genfromtxt(pump_cal, delimiter="\t")
@@ -194,7 +188,7 @@ def dilutions(request, experiment):
 
 	last_dilution = max(last)
 
-	if efficiency == ['0']*16:
+	if efficiency == ['0']*len(vial_count):
 		# All vials were chemostats or not used
 		efficiency = None
 
@@ -210,6 +204,36 @@ def dilutions(request, experiment):
 	return render(request, "dilutions.html", context)
 
 
+def vial_range(experiment_dir):
+	# vials of an experiment, from its OD files (0-15 on a standard box),
+	# text or binary
+	vials = []
+	for file_name in os.listdir(os.path.join(experiment_dir, "OD")):
+		name, extension = os.path.splitext(file_name)
+		if (name.startswith("vial") and name.endswith("_OD") and
+				extension in (binstore.TEXT_EXTENSION, binstore.BINARY_EXTENSION)):
+			vials.append(int(name[len("vial"):-len("_OD")]))
+	return range(0, max(vials) + 1) if vials else range(0)
+
+
+def read_series(path, step):
+	# (time, value) rows of a data file, only every step-th one of long
+	# series, and the file they were read from. Experiments run with
+	# --data-format binary write OD and temperature readings to a binary
+	# series next to the text file (see binstore.py), read that instead.
+	bin_path = binstore.binary_path(path)
+	if os.path.exists(bin_path):
+		data = binstore.load(bin_path, mmap=False)
+		if len(data) >= step * 1000:
+			data = data[::step]
+		return data, bin_path
+	with open(path) as f_in:
+		data = np.genfromtxt(itertools.islice(f_in, 0, None, step), delimiter=',')
+	if len(data) < 1000:
+		data = np.genfromtxt(path, delimiter=',')
+	return data, path
+
+
 def file_scan(tag):
 	rootdir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 	evolver_dir = os.path.join(rootdir, "experiment")